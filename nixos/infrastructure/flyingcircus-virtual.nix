@@ -159,9 +159,7 @@ mkIf (cfg.infrastructureModule == "flyingcircus") {
   flyingcircus.services.sensu-client.checks = {
     cpu_steal = {
       notification = "CPU has high amount of `%steal` ";
-      command =
-        "${pkgs.fc.sensuplugins}/bin/check_cpu_steal " +
-        "--mpstat ${pkgs.sysstat}/bin/mpstat";
+      command = "${pkgs.fc.sensuplugins}/bin/check_cpu_steal";
       interval = 600;
     };
   };
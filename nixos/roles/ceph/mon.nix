@@ -94,7 +94,7 @@ in
       flyingcircus.services.sensu-client.checks = with pkgs; {
         ceph = {
           notification = "Ceph cluster is healthy";
-          command = "sudo ${pkgs.fc.check-ceph}/bin/check_ceph -v -R 200 -A 300";
+          command = "sudo ${pkgs.fc.check-ceph}/bin/check_ceph -v -R 200 -A 300 -b rados --cache /run/check_ceph_status.json";
           interval = 60;
         };
       };
@@ -50,7 +50,7 @@
 
     flyingcircus.services.sensu-client.checks.megaraid_cache = {
       notification = "RAID (MegaRAID) cache status";
-      command = "sudo ${pkgs.fc.sensuplugins}/bin/check_megaraid_cache -v -r -e 'MegaCli64 -LdPdInfo -aALL' -b 'MegaCli64 -AdpBbuCmd -GetBbuStatus -aALL' -W 50 -C 70";
+      command = "sudo ${pkgs.fc.sensuplugins}/bin/check_megaraid_cache -v -r -m MegaCli64 -W 50 -C 70";
     };
 
   };
@@ -1,6 +1,9 @@
-{ lib, stdenv, python3Full, megacli, lvm2, makeWrapper }:
+{ lib, stdenv, python3Packages, megacli, lvm2, makeWrapper, megacli-inventory }:
 
+let
+  python = python3Packages.python.withPackages (ps: [ megacli-inventory ]);
 
+in
 stdenv.mkDerivation rec {
   version = "0.1";
   name = "fc-blockdev";
@@ -11,7 +14,7 @@ stdenv.mkDerivation rec {
   dontConfigure = true;
 
   nativeBuildInputs = [ makeWrapper ];
-  buildInputs = [ python3Full ];
+  buildInputs = [ python ];
 
   installPhase = ''
     mkdir -p $out/bin
@@ -12,6 +12,8 @@ import sys
 import time
 from glob import glob
 
+from fc.megacli_inventory.inventory import DEFAULT_CACHE, Inventory
+
 _log = logging.getLogger()
 
 
@@ -122,34 +124,16 @@ def query_sysfs():
 
 
 def query_controller(megacli):
-    out = subprocess.check_output([megacli, "-LdPdInfo", "-aALL"])
-    return out.decode("ascii")
-
+    """Returns the (possibly cached) controller inventory.
 
-class Tokenizer:
-    def __init__(self, out):
-        self.raw = out.splitlines()
-        self.ptr = -1
+    The inventory is shared with the megaraid checks, so MegaCLI is not
+    queried again if they did so recently.
+    """
+    return Inventory(megacli, DEFAULT_CACHE).load()
 
-    def __iter__(self):
-        return self
 
-    def __next__(self):
-        while True:
-            self.ptr += 1
-            if self.ptr >= len(self.raw):
-                raise StopIteration
-            try:
-                key, val = self.raw[self.ptr].split(":", 1)
-            except ValueError:
-                continue
-            key = key.strip()
-            val = val.strip()
-            if key == "":
-                continue
-            return key, val
-
-    next = __next__  # compatibility with older Python versions
+def invalidate_controller_cache():
+    Inventory(cache=DEFAULT_CACHE).invalidate()
 
 
 class ControllerInfo:
@@ -159,26 +143,21 @@ class ControllerInfo:
         self.is_multi = is_multi
 
 
-def parse_ldpd(ldpd_info):
-    tok = Tokenizer(ldpd_info)
-    ld = None
-    media_type = None
+def parse_ldpd(inventory):
     res = []
-    for key, val in tok:
-        if key == "Virtual Drive":
-            ld = int(val.split()[0])
-            media_type = None
-        if key == "Media Type":
-            if not media_type:
-                media_type = val
-                res.append(
-                    ControllerInfo(ld, val == "Solid State Device", False)
-                )
-            else:
-                # additional PDs in a RAID device
-                if media_type != val:
-                    raise RuntimeError("mixed media types in LD {}".format(ld))
-                res[-1].is_multi = True
+    for ld in inventory["logical_drives"]:
+        media_types = [pd["Media Type"] for pd in ld["physical_drives"]]
+        if not media_types:
+            continue
+        if len(set(media_types)) > 1:
+            raise RuntimeError("mixed media types in LD {}".format(ld["id"]))
+        res.append(
+            ControllerInfo(
+                ld["id"],
+                media_types[0] == "Solid State Device",
+                len(media_types) > 1,
+            )
+        )
     return res
 
 
@@ -208,6 +187,8 @@ def auto_tune_lsi(devs, megacli):
     rc += updater.set_ld_properties(
         multi, ["ADRA", "WB", "Cached", "NoCachedBadBBU"]
     )
+    # Cache policies have changed.
+    invalidate_controller_cache()
     if max(rc) > 0:
         raise RuntimeError("MegaCLI failure")
 
@@ -294,161 +275,45 @@ if __name__ == "__main__":
 
 # === Tests ===
 
-MEGACLI_OUT = """\
-Adapter #0
-
-Number of Virtual Disks: 5
-Virtual Drive: 0 (Target Id: 0)
-Name                :
-RAID Level          : Primary-1, Secondary-0, RAID Level Qualifier-0
-Number Of Drives    : 2
-Span Depth          : 1
-Default Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Current Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Disk Cache Policy   : Disabled
-Number of Spans: 1
-Span: 0 - Number of PDs: 2
-
-PD: 0 Information
-Enclosure Device ID: 252
-Slot Number: 0
-Drive's position: DiskGroup: 0, Span: 0, Arm: 0
-PD Type: SATA
-
-Raw Size: 465.761 GB [0x3a386030 Sectors]
-Media Type: Hard Disk Device
-Drive has flagged a S.M.A.R.T alert : No
-
-
-
-
-PD: 1 Information
-Enclosure Device ID: 252
-Slot Number: 1
-Drive's position: DiskGroup: 0, Span: 0, Arm: 1
-PD Type: SATA
-
-Raw Size: 465.761 GB [0x3a386030 Sectors]
-Media Type: Hard Disk Device
-Drive has flagged a S.M.A.R.T alert : No
+HDD = "Hard Disk Device"
+SSD = "Solid State Device"
 
 
+def logical_drive(ld, *media_types):
+    return {
+        "adapter": 0,
+        "id": ld,
+        "properties": {},
+        "physical_drives": [{"Media Type": t} for t in media_types],
+    }
 
-Virtual Drive: 1 (Target Id: 1)
-Name                :
-RAID Level          : Primary-0, Secondary-0, RAID Level Qualifier-0
-Number Of Drives    : 1
-Span Depth          : 1
-Default Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Current Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Disk Cache Policy   : Disabled
-Number of Spans: 1
-Span: 0 - Number of PDs: 1
-
-PD: 0 Information
-Enclosure Device ID: 252
-Slot Number: 3
-Drive's position: DiskGroup: 5, Span: 0, Arm: 0
-PD Type: SAS
-
-Raw Size: 558.911 GB [0x45dd2fb0 Sectors]
-Media Type: Solid State Device
-Drive has flagged a S.M.A.R.T alert : No
-
-
-
-Virtual Drive: 2 (Target Id: 2)
-Name                :
-RAID Level          : Primary-0, Secondary-0, RAID Level Qualifier-0
-Number Of Drives    : 1
-Span Depth          : 1
-Default Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Current Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Number of Spans: 1
-Span: 0 - Number of PDs: 1
-
-PD: 0 Information
-Enclosure Device ID: 252
-Slot Number: 4
-Drive's position: DiskGroup: 6, Span: 0, Arm: 0
-PD Type: SAS
-
-Raw Size: 558.911 GB [0x45dd2fb0 Sectors]
-Media Type: Hard Disk Device
-Drive has flagged a S.M.A.R.T alert : No
-
-
-
-Virtual Drive: 3 (Target Id: 3)
-Name                :
-RAID Level          : Primary-0, Secondary-0, RAID Level Qualifier-0
-Number Of Drives    : 1
-Span Depth          : 1
-Default Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Current Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Number of Spans: 1
-Span: 0 - Number of PDs: 1
-
-PD: 0 Information
-Enclosure Device ID: 252
-Slot Number: 2
-Drive's position: DiskGroup: 4, Span: 0, Arm: 0
-PD Type: SATA
-
-Raw Size: 238.474 GB [0x1dcf32b0 Sectors]
-Media Type: Solid State Device
-Drive has flagged a S.M.A.R.T alert : No
-
-
-
-Virtual Drive: 4 (Target Id: 4)
-Name                :
-RAID Level          : Primary-0, Secondary-0, RAID Level Qualifier-0
-Number Of Drives    : 1
-Span Depth          : 1
-Default Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Current Cache Policy: WriteBack, ReadAheadNone, Cached, No Write Cache if Bad BBU
-Number of Spans: 1
-Span: 0 - Number of PDs: 1
-
-PD: 0 Information
-Enclosure Device ID: 252
-Slot Number: 5
-Drive's position: DiskGroup: 1, Span: 0, Arm: 0
-PD Type: SATA
-
-Raw Size: 931.512 GB [0x74706db0 Sectors]
-Media Type: Hard Disk Device
-Drive has flagged a S.M.A.R.T alert : No
-
-
-
-Exit Code: 0x00
-"""
-
-
-def test_tokenize_iter():
-    t = Tokenizer(MEGACLI_OUT)
-    assert next(t) == ("Number of Virtual Disks", "5")
-    assert next(t) == ("Virtual Drive", "0 (Target Id: 0)")
-    assert next(t) == ("Name", "")
-    assert next(t) == (
-        "RAID Level",
-        "Primary-1, Secondary-0, RAID Level Qualifier-0",
-    )
 
-
-def test_tokenize_stopiteration():
-    t = Tokenizer(MEGACLI_OUT)
-    assert len(list(t)) == 97
+INVENTORY = {
+    "logical_drives": [
+        logical_drive(0, HDD, HDD),
+        logical_drive(1, SSD),
+        logical_drive(2, HDD),
+        logical_drive(3, SSD),
+        logical_drive(4, HDD),
+    ],
+}
 
 
 def test_parse_ldpdinfo():
-    info = parse_ldpd(MEGACLI_OUT)
+    info = parse_ldpd(INVENTORY)
     assert [ld.is_ssd for ld in info] == [False, True, False, True, False]
     assert [ld.is_multi for ld in info] == [True, False, False, False, False]
 
 
+def test_parse_ldpdinfo_mixed_media():
+    inventory = {"logical_drives": [logical_drive(0, HDD, SSD)]}
+    try:
+        parse_ldpd(inventory)
+    except RuntimeError:
+        return
+    assert False, "RuntimeError expected"
+
+
 def test_fix_mediatype():
     devs = [
         BlockDev("sda", "ATA"),
@@ -459,7 +324,7 @@ def test_fix_mediatype():
         BlockDev("sdb", "LSI"),
         BlockDev("nvme0n0", "Intel", ssd=True),
     ]
-    update_media_type(devs, parse_ldpd(MEGACLI_OUT))
+    update_media_type(devs, parse_ldpd(INVENTORY))
     assert [(d.ssd, d.lsi_ld) for d in devs] == [
         (False, None),  # no LSI dev
         (False, 0),  # 5 LSI devs follow
@@ -477,7 +342,7 @@ def test_lsi_count_mismatch():
         BlockDev("sdb", "LSI"),
     ]
     try:
-        update_media_type(devs, parse_ldpd(MEGACLI_OUT))
+        update_media_type(devs, parse_ldpd(INVENTORY))
     except RuntimeError:
         return
     assert False, "RuntimeError expected"
@@ -0,0 +1,142 @@
+"""Benchmark delta_update with and without a block hash manifest.
+
+Usage: python benchmarks/images.py [--size MiB] [--changed FRACTION]
+
+Writes an image generation into a local sparse file that stands in for
+the RBD image, then updates it to the next generation in which a
+fraction of the 4 MiB blocks differ. Verification mode reads every
+allocated block back from the destination, manifest mode only hashes
+the new content. On a cluster, the bytes read back are network I/O.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from fc.ceph.images import BLOCKSIZE, delta_update
+
+
+class Completion:
+    def get_return_value(self):
+        return 0
+
+
+class FileImage:
+    """Stand-in for rbd.Image on a local sparse file.
+
+    Asynchronous requests complete immediately. Discarded blocks are
+    overwritten with zeros instead of punching holes.
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR)
+        self.bytes_read = 0
+
+    def close(self):
+        os.close(self.fd)
+
+    def size(self):
+        return os.fstat(self.fd).st_size
+
+    def resize(self, size):
+        os.ftruncate(self.fd, size)
+
+    def read(self, offset, length):
+        data = os.pread(self.fd, length, offset)
+        self.bytes_read += len(data)
+        return data
+
+    def aio_write(self, data, offset, oncomplete):
+        os.pwrite(self.fd, data, offset)
+        oncomplete(Completion())
+
+    def aio_discard(self, offset, length, oncomplete):
+        os.pwrite(self.fd, bytes(length), offset)
+        oncomplete(Completion())
+
+    def diff_iterate(self, offset, length, from_snapshot, iterate_cb):
+        end = offset + length
+        while offset < end:
+            try:
+                start = os.lseek(self.fd, offset, os.SEEK_DATA)
+            except OSError:
+                # No data after offset.
+                return
+            if start >= end:
+                return
+            stop = min(os.lseek(self.fd, start, os.SEEK_HOLE), end)
+            iterate_cb(start, stop - start, True)
+            offset = stop
+
+    def flush(self):
+        pass
+
+
+class NoThrottle:
+    def wait(self):
+        pass
+
+
+def generation(blocks, changed, seed):
+    """Yields image content where every `changed` block differs per seed."""
+    for i in range(blocks):
+        key = b"%d-%d" % (i, seed if changed and i % changed == 0 else 0)
+        yield hashlib.sha256(key).digest() * (BLOCKSIZE // 32)
+
+
+def update(path, blocks, manifest):
+    image = FileImage(path)
+    started = time.perf_counter()
+    try:
+        result = delta_update(blocks, image, manifest, throttle=NoThrottle())
+    finally:
+        image.close()
+    return result, time.perf_counter() - started, image.bytes_read
+
+
+def report(label, elapsed, bytes_read):
+    print(
+        "{:<14} {:8.2f}s {:8.0f} MiB read from destination".format(
+            label, elapsed, bytes_read / 2**20
+        )
+    )
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--size", type=int, default=1024, help="MiB")
+    argp.add_argument("--changed", type=float, default=0.03)
+    args = argp.parse_args()
+    blocks = args.size * 2**20 // BLOCKSIZE
+    changed = max(int(1 / args.changed), 1) if args.changed else 0
+    with tempfile.TemporaryDirectory() as tmp:
+        verify = os.path.join(tmp, "verify.img")
+        open(verify, "w").close()
+        manifest, elapsed, _ = update(
+            verify, generation(blocks, changed, 0), None
+        )
+        report("initial", elapsed, 0)
+        indexed = os.path.join(tmp, "manifest.img")
+        shutil.copyfile(verify, indexed)
+
+        print(
+            "{} blocks, {} changed".format(
+                blocks, len(range(0, blocks, changed)) if changed else 0
+            )
+        )
+        verified, elapsed, bytes_read = update(
+            verify, generation(blocks, changed, 1), None
+        )
+        report("verification", elapsed, bytes_read)
+        hashed, elapsed, bytes_read = update(
+            indexed, generation(blocks, changed, 1), manifest
+        )
+        report("manifest", elapsed, bytes_read)
+        assert verified.digests == hashed.digests
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-{ lib, stdenv, python3Full, python3Packages, lz4, blockdev, lvm2, util-linux, ceph, agent, util-physical }:
+{ lib, stdenv, python3Full, python3Packages, blockdev, lvm2, util-linux, ceph, agent, util-physical }:
 
 let
   py = python3Packages;
@@ -12,11 +12,11 @@ py.buildPythonApplication rec {
   propagatedBuildInputs = [
     blockdev
     ceph
-    lz4
     lvm2
     agent
     util-linux
     util-physical
+    python3Packages.lz4
     python3Packages.requests
   ];
 
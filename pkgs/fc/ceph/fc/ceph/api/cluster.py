@@ -1,9 +1,13 @@
 """Access to a specific Ceph cluster."""
 
 import configparser
+import json
 import socket
 import subprocess
 import sys
+import tempfile
+
+import rados
 
 CEPH_ID = socket.gethostname()
 CEPH_CONF = "/etc/ceph/ceph.conf"
@@ -13,6 +17,84 @@ class CephCmdError(RuntimeError):
     pass
 
 
+SURE = "--yes-i-really-really-mean-it"
+
+
+def _osd_id(value):
+    """Converts `osd.N` or `N` to N like the ceph CLI does."""
+    return int(str(value).replace("osd.", "", 1))
+
+
+# ceph CLI words -> names and types of the mon command's arguments.
+# A type given as a list collects all remaining words. Commands not
+# listed here are passed to the ceph CLI.
+MON_COMMANDS = {
+    ("auth", "del"): [("entity", str)],
+    ("auth", "import"): [],
+    ("auth", "list"): [],
+    ("health",): [("detail", str)],
+    ("mon", "remove"): [("name", str)],
+    ("osd", "create"): [],
+    ("osd", "crush", "add"): [
+        ("id", _osd_id),
+        ("weight", float),
+        ("args", [str]),
+    ],
+    ("osd", "crush", "dump"): [],
+    ("osd", "crush", "remove"): [("name", str)],
+    ("osd", "dump"): [],
+    ("osd", "find"): [("id", int)],
+    ("osd", "lspools"): [],
+    ("osd", "perf"): [],
+    ("osd", "pool", "create"): [("pool", str), ("pg_num", int)],
+    ("osd", "pool", "delete"): [("pool", str), ("pool2", str), ("sure", str)],
+    ("osd", "pool", "get"): [("pool", str), ("var", str)],
+    ("osd", "pool", "set"): [("pool", str), ("var", str), ("val", str)],
+    ("osd", "rm"): [("ids", [str])],
+    ("osd", "set"): [("key", str)],
+    ("osd", "tree"): [],
+    ("osd", "unset"): [("key", str)],
+    ("pg", "stat"): [],
+    ("status",): [],
+}
+
+
+def mon_command_for(args):
+    """Translates ceph CLI arguments into a mon command.
+
+    Returns None if the command is unknown or uses options we can't
+    translate.
+    """
+    args = list(args)
+    for length in range(min(len(args), 3), 0, -1):
+        prefix = tuple(args[:length])
+        if prefix in MON_COMMANDS:
+            break
+    else:
+        return None
+    spec = MON_COMMANDS[prefix]
+    params = args[length:]
+    for param in params:
+        if str(param).startswith("-") and param != SURE:
+            # CLI options like `-i <file>`.
+            return None
+    command = {"prefix": " ".join(prefix), "format": "json"}
+    try:
+        for name, type_ in spec:
+            if not params:
+                break
+            if isinstance(type_, list):
+                command[name] = [type_[0](p) for p in params]
+                params = []
+            else:
+                command[name] = type_(params.pop(0))
+    except ValueError:
+        return None
+    if params:
+        return None
+    return command
+
+
 class Cluster(object):
     """Exposes configuration and provides access to admin commands."""
 
@@ -28,6 +110,19 @@ class Cluster(object):
         self.ceph_id = ceph_id
         self.dry_run = dry_run
         self.default_encoding = default_encoding
+        self._rados = None  # lazy librados connection
+        # Send known ceph commands over librados instead of forking the CLI.
+        self.use_rados = True
+
+    def connect(self):
+        """Returns shared librados connection to the cluster."""
+        if self._rados is None:
+            connection = rados.Rados(
+                conffile=self.ceph_conf, name="client.{}".format(self.ceph_id)
+            )
+            connection.connect()
+            self._rados = connection
+        return self._rados
 
     def parse_config(self):
         self.config = configparser.ConfigParser()
@@ -99,19 +194,73 @@ class Cluster(object):
             ignore_dry_run,
         )
 
-    def ceph_osd(self, args, accept_failure=False, ignore_dry_run=False):
-        """Ceph OSD command line wrapper."""
-        return self.generic_ceph_cmd(
-            [
-                "ceph",
-                "--id",
-                self.ceph_id,
-                "-c",
-                self.ceph_conf,
-                "--format=json",
-                "osd",
-            ],
-            args,
-            accept_failure,
-            ignore_dry_run,
+    def ceph(
+        self, args, accept_failure=False, ignore_dry_run=False, inbuf=None
+    ):
+        """Ceph command wrapper.
+
+        Known commands are sent to the monitors over the shared librados
+        connection, everything else (and everything if we can't connect)
+        goes through the ceph command line tool. Both return the same
+        results as `generic_ceph_cmd`. `inbuf` is passed to the command
+        as input file (`-i`).
+        """
+        command = mon_command_for(args) if self.use_rados else None
+        if command is None or (self.dry_run and not ignore_dry_run):
+            return self._ceph_cli(args, accept_failure, ignore_dry_run, inbuf)
+        try:
+            stdout, stderr, returncode = self.mon_command(
+                command, inbuf or b""
+            )
+        except rados.Error as e:
+            print(
+                "librados unavailable ({}), using the ceph CLI".format(e),
+                file=sys.stderr,
+            )
+            self.use_rados = False
+            return self._ceph_cli(args, accept_failure, ignore_dry_run, inbuf)
+        if accept_failure:
+            return (stdout, stderr, returncode)
+        if returncode != 0:
+            raise CephCmdError("ceph failed", args, stdout, stderr, returncode)
+        return (stdout, stderr)
+
+    def _ceph_cli(self, args, accept_failure, ignore_dry_run, inbuf=None):
+        base_args = [
+            "ceph",
+            "--id",
+            self.ceph_id,
+            "-c",
+            self.ceph_conf,
+            "--format=json",
+        ]
+        if inbuf is None:
+            return self.generic_ceph_cmd(
+                base_args, args, accept_failure, ignore_dry_run
+            )
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(inbuf)
+            f.flush()
+            return self.generic_ceph_cmd(
+                base_args,
+                list(args) + ["-i", f.name],
+                accept_failure,
+                ignore_dry_run,
+            )
+
+    def mon_command(self, command, inbuf=b""):
+        """Sends a JSON mon command over the librados connection.
+
+        Returns (stdout, stderr, returncode) with a positive errno as
+        return code, as the ceph command line tool would.
+        """
+        ret, outbuf, outs = self.connect().mon_command(
+            json.dumps(command), inbuf
         )
+        if isinstance(outs, str):
+            outs = outs.encode(self.default_encoding)
+        return (outbuf, outs, -ret)
+
+    def ceph_osd(self, args, accept_failure=False, ignore_dry_run=False):
+        """Ceph OSD command wrapper."""
+        return self.ceph(["osd"] + list(args), accept_failure, ignore_dry_run)
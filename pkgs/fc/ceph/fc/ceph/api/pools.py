@@ -1,7 +1,14 @@
+import collections
+import concurrent.futures
 import json
 import random
+import sys
+import threading
 import time
 
+import rados
+import rbd
+
 from .rbdimage import RBDImage
 
 
@@ -15,6 +22,7 @@ class Pools(object):
         self.cluster = cluster
         self._cache = {}
         self._names = set()
+        self._index = None
 
     def lookup(self, pool):
         """Deprecated. Use pools[poolname] instead."""
@@ -50,6 +58,13 @@ class Pools(object):
         """Short form for `for i in pools.all():`."""
         return self.all()
 
+    @property
+    def index(self):
+        """Cluster-wide image index, built on first access."""
+        if self._index is None:
+            self._index = ImageIndex(self)
+        return self._index
+
     def pick(self):
         """Returns randomly picked pool (as Pool object)."""
         return self[random.choice(list(self.names()))]
@@ -66,14 +81,19 @@ class Pools(object):
 class Pool(object):
     """Single pool listing.
 
-    The contents of the pool is queried via `rbd` and then broken up for
-    easy access.
+    Image names are listed via the rbd bindings. Details (size, locks,
+    snapshots, parent) are only loaded for images that are looked up, or
+    for all images at once when iterating over `images`.
     """
 
     def __init__(self, poolname, cluster):
         self.name = poolname
         self.cluster = cluster
-        self._images = None
+        self._image_names = None
+        self._images = {}
+        self._loaded = set()  # image names whose details are in _images
+        self._complete = False
+        self._ioctx = None
         self._pg_num = None
         self._pgp_num = None
 
@@ -82,40 +102,142 @@ class Pool(object):
         return self[imagename]
 
     def __getitem__(self, imagename):
-        """Looks up image `imagename`."""
-        if not self._images:
-            self._images = self.load()
+        """Looks up image `imagename` (optionally `image@snapshot`)."""
+        if not self._complete:
+            image = imagename.split("@", 1)[0]
+            if image not in self._loaded:
+                if image not in self.image_names():
+                    raise KeyError(imagename)
+                self._add(image, self._query_image(image))
         return self._images[imagename]
 
     @property
     def images(self):
-        """Returns an iterator over all images in the pool."""
-        if not self._images:
+        """Returns a list of all images (including snapshots) in the pool."""
+        if not self._complete:
             self._images = self.load()
+            self._loaded = set(i.image for i in self._images.values())
+            self._complete = True
         return list(self._images.values())
 
     def load(self):
-        """Loads all images found in this pool."""
+        """Loads details of all images found in this pool."""
         images = {}
-        poollist = json.loads(self._rbd_query())
-        for i in poollist:
-            image = RBDImage.from_dict(i)
-            images[image.name] = image
+        with concurrent.futures.ThreadPoolExecutor(16) as executor:
+            for records in executor.map(self._query_image, self.image_names()):
+                for image in records:
+                    images[image.name] = image
         return images
 
-    def _rbd_query(self):
-        stdout, stderr, returncode = self.cluster.rbd(
-            ["--format=json", "ls", "-l", self.name],
-            accept_failure=True,
-            ignore_dry_run=True,
-        )
-        if returncode == 0:
-            return stdout
-        if returncode == 2 and "error opening pool" in stderr:
-            raise KeyError(self.name, stdout)
-        if returncode == 2 and "doesn't contain rbd images" in stderr:
-            return "[]"
-        raise RuntimeError("rbd execution failed", stdout, stderr, returncode)
+    def snapshots(self, names=None):
+        """Returns RBDImage records of all snapshots in the pool.
+
+        Only lists the snapshots of the images (all or those in `names`)
+        instead of loading their details. The records carry name, size and
+        protection only.
+        """
+        if names is None:
+            names = self.image_names()
+        if self._complete:
+            names = set(names)
+            return [
+                i
+                for i in self._images.values()
+                if i.snapshot and i.image in names
+            ]
+        with concurrent.futures.ThreadPoolExecutor(16) as executor:
+            return [
+                snapshot
+                for records in executor.map(self._query_snapshots, names)
+                for snapshot in records
+            ]
+
+    def records(self, image):
+        """Returns RBDImage records for `image` and all its snapshots."""
+        self[image]
+        return [i for i in self._images.values() if i.image == image]
+
+    def _add(self, image, records):
+        self._loaded.add(image)
+        for record in records:
+            self._images[record.name] = record
+
+    def invalidate(self):
+        """Forget everything we know about the pool's images."""
+        self._image_names = None
+        self._images = {}
+        self._loaded = set()
+        self._complete = False
+
+    @property
+    def ioctx(self):
+        """Returns I/O context for this pool. Raises KeyError if missing."""
+        if self._ioctx is None:
+            try:
+                self._ioctx = self.cluster.connect().open_ioctx(self.name)
+            except rados.ObjectNotFound:
+                raise KeyError(self.name)
+        return self._ioctx
+
+    def image_names(self):
+        """Returns names of all images without loading any details."""
+        if self._image_names is None:
+            self._image_names = set(rbd.RBD().list(self.ioctx))
+        return self._image_names
+
+    def _query_image(self, name):
+        """Returns RBDImage records for image `name` and its snapshots."""
+        try:
+            image = rbd.Image(self.ioctx, name, read_only=True)
+        except rbd.ImageNotFound:
+            # Removed while we were looking.
+            return []
+        try:
+            size = image.size()
+            format = 1 if image.old_format() else 2
+            lockers = image.list_lockers()
+            lock_type = None
+            if lockers and lockers["lockers"]:
+                lock_type = "exclusive" if lockers["exclusive"] else "shared"
+            try:
+                parent = "{}/{}@{}".format(*image.parent_info())
+            except rbd.ImageNotFound:
+                parent = None
+            records = [RBDImage(name, size, format, lock_type, parent=parent)]
+            for snap in image.list_snaps():
+                records.append(
+                    RBDImage(
+                        name,
+                        snap["size"],
+                        format,
+                        snapshot=snap["name"],
+                        protected=image.is_protected_snap(snap["name"]),
+                        parent=parent,
+                    )
+                )
+            return records
+        finally:
+            image.close()
+
+    def _query_snapshots(self, name):
+        """Returns RBDImage records for the snapshots of image `name`."""
+        try:
+            image = rbd.Image(self.ioctx, name, read_only=True)
+        except rbd.ImageNotFound:
+            # Removed while we were looking.
+            return []
+        try:
+            return [
+                RBDImage(
+                    name,
+                    snap["size"],
+                    snapshot=snap["name"],
+                    protected=image.is_protected_snap(snap["name"]),
+                )
+                for snap in image.list_snaps()
+            ]
+        finally:
+            image.close()
 
     def fix_options(self):
         """Adapt important pool properties to most up-to-date values."""
@@ -176,22 +298,35 @@ class Pool(object):
     def size_total_gb(self):
         return sum(i.size_gb for i in self.images if not i.snapshot)
 
+    def _dry_run(self, args):
+        """Returns True (after telling so) if we must not change anything."""
+        if not self.cluster.dry_run:
+            return False
+        print("*** dry-run: {}".format(["rbd"] + args), file=sys.stderr)
+        return True
+
     def snap_rm(self, rbdimage):
-        self.cluster.rbd(
-            [
-                "snap",
-                "rm",
-                "{}/{}@{}".format(
-                    self.name, rbdimage.image, rbdimage.snapshot
-                ),
-            ]
-        )
-        self._images = None
+        spec = "{}/{}@{}".format(self.name, rbdimage.image, rbdimage.snapshot)
+        if not self._dry_run(["snap", "rm", spec]):
+            image = rbd.Image(self.ioctx, rbdimage.image)
+            try:
+                image.remove_snap(rbdimage.snapshot)
+            finally:
+                image.close()
+        # Keep the listing valid instead of querying the whole pool again.
+        self._images.pop(rbdimage.name, None)
 
     def image_rm(self, rbdimage):
         assert rbdimage.snapshot is None
-        self.cluster.rbd(["rm", "{}/{}".format(self.name, rbdimage.image)])
-        self._images = None
+        spec = "{}/{}".format(self.name, rbdimage.image)
+        if not self._dry_run(["rm", spec]):
+            rbd.RBD().remove(self.ioctx, rbdimage.image)
+        for name, image in list(self._images.items()):
+            if image.image == rbdimage.image:
+                del self._images[name]
+        self._loaded.discard(rbdimage.image)
+        if self._image_names is not None:
+            self._image_names.discard(rbdimage.image)
 
     def delete(self):
         if self.images:
@@ -208,3 +343,140 @@ class Pool(object):
                 "--yes-i-really-really-mean-it",
             ]
         )
+
+
+class DeletionPlan(object):
+    """Collects image and snapshot removals and executes them per pool.
+
+    Snapshots of an image are removed before the image itself. Different
+    images of a pool are processed in parallel, bounded by `parallel`.
+    """
+
+    def __init__(self, parallel=4):
+        self.parallel = parallel
+        # pool -> image name -> list of RBDImage records to remove
+        self.plans = collections.OrderedDict()
+        self.scanned = 0
+        self.deleted = 0
+        self.failed = 0
+        self.duration = 0
+        self._lock = threading.Lock()
+
+    def add(self, pool, rbdimage):
+        images = self.plans.setdefault(pool, collections.OrderedDict())
+        images.setdefault(rbdimage.image, []).append(rbdimage)
+
+    def __len__(self):
+        return sum(
+            len(records)
+            for images in self.plans.values()
+            for records in images.values()
+        )
+
+    def _remove(self, pool, records):
+        # Snapshots first, the image itself can only go if it has none.
+        records = sorted(records, key=lambda r: r.snapshot is None)
+        for rbdimage in records:
+            if rbdimage.snapshot:
+                print(
+                    "Purging snapshot {}/{}".format(pool.name, rbdimage.name)
+                )
+                pool.snap_rm(rbdimage)
+            else:
+                print("Purging volume {}/{}".format(pool.name, rbdimage.name))
+                pool.image_rm(rbdimage)
+            with self._lock:
+                self.deleted += 1
+
+    def execute(self):
+        started = time.time()
+        for pool, images in self.plans.items():
+            with concurrent.futures.ThreadPoolExecutor(
+                self.parallel
+            ) as executor:
+                futures = {
+                    executor.submit(self._remove, pool, records): image
+                    for image, records in images.items()
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.failed += 1
+                        print(
+                            "Failed to purge {}/{}: {!r}".format(
+                                pool.name, futures[future], e
+                            ),
+                            file=sys.stderr,
+                        )
+        self.duration = time.time() - started
+
+    def report(self):
+        print(
+            "Scanned {} images, deleted {}, {} failed in {:.1f}s".format(
+                self.scanned, self.deleted, self.failed, self.duration
+            )
+        )
+
+
+class ImageIndex(object):
+    """Cluster-wide index of image names to the pools containing them.
+
+    The index is built once from the cheap name listings of all pools.
+    Image details are loaded lazily through the pools and cached there.
+    """
+
+    def __init__(self, pools):
+        self.pools = pools
+        self._index = None
+
+    def build(self):
+        index = {}
+        for pool in self.pools:
+            try:
+                names = pool.image_names()
+            except KeyError:
+                # The pool has vanished in the meantime.
+                continue
+            for name in names:
+                index.setdefault(name, []).append(pool)
+        self._index = index
+
+    def pools_for(self, image):
+        """Returns all pools that contain an image called `image`."""
+        if self._index is None:
+            self.build()
+        return list(self._index.get(image, []))
+
+    def lookup(self, image):
+        """Returns list of (pool, RBDImage records) for `image`.
+
+        The records contain the image itself and all of its snapshots.
+        """
+        result = []
+        for pool in self.pools_for(image):
+            try:
+                result.append((pool, pool.records(image)))
+            except KeyError:
+                continue
+        return result
+
+    def snapshots(self):
+        """Iterates over (pool, RBDImage) for all snapshots in the cluster.
+
+        Lists the snapshots of the indexed images pool by pool without
+        loading any other image details.
+        """
+        if self._index is None:
+            self.build()
+        names = collections.OrderedDict()
+        for image, pools in sorted(self._index.items()):
+            for pool in pools:
+                names.setdefault(pool, []).append(image)
+        for pool, images in names.items():
+            try:
+                snapshots = pool.snapshots(images)
+            except KeyError:
+                continue
+            for snapshot in snapshots:
+                yield pool, snapshot
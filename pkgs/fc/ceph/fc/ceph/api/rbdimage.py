@@ -8,7 +8,15 @@ import re
 class RBDImage(
     collections.namedtuple(
         "RBDImage",
-        ["image", "size", "format", "lock_type", "snapshot", "protected"],
+        [
+            "image",
+            "size",
+            "format",
+            "lock_type",
+            "snapshot",
+            "protected",
+            "parent",
+        ],
     )
 ):
     """Represents a single RBD image from the pool listing."""
@@ -21,10 +29,11 @@ class RBDImage(
         lock_type=None,
         snapshot=None,
         protected=None,
+        parent=None,
     ):
-        protected = protected in ["true", "True"]
+        protected = protected in ["true", "True", True]
         return super(RBDImage, _cls).__new__(
-            _cls, image, size, format, lock_type, snapshot, protected
+            _cls, image, size, format, lock_type, snapshot, protected, parent
         )
 
     @classmethod
@@ -37,6 +46,15 @@ class RBDImage(
             params.get("lock_type", None),
             params.get("snapshot", None),
             params.get("protected", None),
+            cls._format_parent(params.get("parent", None)),
+        )
+
+    @staticmethod
+    def _format_parent(parent):
+        if not parent:
+            return None
+        return "{}/{}@{}".format(
+            parent["pool"], parent["image"], parent["snapshot"]
         )
 
     @property
@@ -1,8 +1,28 @@
+import json
+
 import mock
 import pkg_resources
 import pytest
 
-from ..cluster import CephCmdError, Cluster
+from .. import cluster as cluster_module
+from ..cluster import CephCmdError, Cluster, mon_command_for
+
+
+class FakeRados(object):
+    """Fake librados connection answering mon commands from a table.
+
+    Responses are looked up by the command prefix and are (ret, outbuf,
+    outs) triples like from rados.Rados.mon_command().
+    """
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.commands = []
+
+    def mon_command(self, cmd, inbuf):
+        command = json.loads(cmd)
+        self.commands.append(command)
+        return self.responses.get(command["prefix"], (0, b"", ""))
 
 
 @pytest.fixture
@@ -62,3 +82,115 @@ class TestCluster(object):
             "-c",
             "/path/to/ceph.conf",
         ] == cluster.rbd(["ls"])
+
+
+class TestMonCommand(object):
+    @pytest.fixture
+    def rados(self, cluster):
+        cluster._rados = FakeRados(
+            {
+                "osd lspools": (0, b'[{"poolnum":0,"poolname":"rbd"}]', ""),
+                "osd rm": (-16, b"", "osd.3 is still up"),
+            }
+        )
+        return cluster._rados
+
+    def test_translate_known_command(self):
+        assert mon_command_for(["osd", "pool", "set", "rbd", "size", "3"]) == {
+            "prefix": "osd pool set",
+            "format": "json",
+            "pool": "rbd",
+            "var": "size",
+            "val": "3",
+        }
+
+    def test_translate_converts_types(self):
+        assert mon_command_for(
+            ["osd", "crush", "add", "osd.3", "1.5", "host=a", "rack=b"]
+        ) == {
+            "prefix": "osd crush add",
+            "format": "json",
+            "id": 3,
+            "weight": 1.5,
+            "args": ["host=a", "rack=b"],
+        }
+        assert (
+            mon_command_for(["osd", "pool", "create", "rbd", "32"])["pg_num"]
+            == 32
+        )
+
+    def test_translate_pool_delete(self):
+        command = mon_command_for(
+            [
+                "osd",
+                "pool",
+                "delete",
+                "a",
+                "a",
+                "--yes-i-really-really-mean-it",
+            ]
+        )
+        assert command["sure"] == "--yes-i-really-really-mean-it"
+
+    def test_translate_falls_back_for_unknown_commands(self):
+        assert mon_command_for(["mon", "getmap", "-o", "/tmp/x"]) is None
+        assert mon_command_for(["auth", "add", "osd.1", "-i", "kr"]) is None
+        assert mon_command_for(["osd", "find", "osd.x"]) is None
+        assert mon_command_for(["osd", "tree", "1", "2"]) is None
+
+    def test_ceph_osd_uses_mon_command(self, cluster, rados):
+        out, err = cluster.ceph_osd(["lspools"], ignore_dry_run=True)
+        assert json.loads(out) == [{"poolnum": 0, "poolname": "rbd"}]
+        assert rados.commands == [{"prefix": "osd lspools", "format": "json"}]
+
+    def test_mon_command_failure_returns_errno(self, cluster, rados):
+        out, err, returncode = cluster.ceph(
+            ["osd", "rm", "3"], accept_failure=True
+        )
+        assert returncode == 16
+        assert err == b"osd.3 is still up"
+        with pytest.raises(CephCmdError):
+            cluster.ceph(["osd", "rm", "3"])
+
+    def test_dry_run_only_sends_read_commands(self, cluster, rados, capsys):
+        cluster.dry_run = True
+        cluster.ceph_osd(["lspools"], ignore_dry_run=True)
+        assert ("", "") == cluster.ceph_osd(["pool", "create", "new", "32"])
+        assert [c["prefix"] for c in rados.commands] == ["osd lspools"]
+        out, err = capsys.readouterr()
+        assert err.startswith("*** dry-run: ['ceph'")
+
+    @mock.patch("subprocess.Popen")
+    def test_unknown_commands_use_cli(self, popen, cluster, rados):
+        p = popen.return_value
+        p.communicate.return_value = ("out", "err")
+        p.returncode = 0
+        cluster.ceph(["mon", "getmap", "-o", "/tmp/monmap"])
+        assert popen.call_args[0][0][-4:] == [
+            "mon",
+            "getmap",
+            "-o",
+            "/tmp/monmap",
+        ]
+        assert rados.commands == []
+
+    @mock.patch("subprocess.Popen")
+    def test_falls_back_to_cli_without_connection(
+        self, popen, cluster, monkeypatch
+    ):
+        class Error(Exception):
+            pass
+
+        def connect():
+            raise Error("no monitors")
+
+        monkeypatch.setattr(
+            cluster_module.rados, "Error", Error, raising=False
+        )
+        monkeypatch.setattr(cluster, "connect", connect)
+        p = popen.return_value
+        p.communicate.return_value = ("[]", "")
+        p.returncode = 0
+        assert ("[]", "") == cluster.ceph_osd(["lspools"])
+        assert not cluster.use_rados
+        assert popen.call_args[0][0][-2:] == ["osd", "lspools"]
@@ -3,10 +3,90 @@ import time
 import pkg_resources
 import pytest
 
+from .. import pools as pools_module
 from ..cluster import Cluster
 from ..pools import Pool, Pools
 from ..rbdimage import RBDImage
 
+# pool -> image -> image properties
+FAKE_POOLS = {
+    "test": {
+        "test04.root": dict(size=21474836480, format=1),
+        "test04.tmp": dict(size=5368709120, lock_type="exclusive"),
+    },
+    "data": {
+        "test04.root": dict(size=1073741824),
+        "test05.root": dict(
+            size=1073741824,
+            parent=("rbd", "base", "v1"),
+            snaps=[("backy-1", False), ("keep", True)],
+        ),
+    },
+    "empty": {},
+}
+
+
+class FakeRados(object):
+    def __init__(self, pools):
+        self.pools = pools
+
+    def open_ioctx(self, name):
+        if name not in self.pools:
+            raise pools_module.rados.ObjectNotFound(name)
+        return name
+
+
+class FakeRBD(object):
+    listed = []
+    removed = []
+
+    def list(self, ioctx):
+        self.listed.append(ioctx)
+        return list(FAKE_POOLS[ioctx])
+
+    def remove(self, ioctx, name):
+        self.removed.append((ioctx, name))
+
+
+class FakeRBDImage(object):
+    def __init__(self, ioctx, name, read_only=False):
+        assert read_only
+        try:
+            self.props = FAKE_POOLS[ioctx][name]
+        except KeyError:
+            raise pools_module.rbd.ImageNotFound(name)
+
+    def size(self):
+        return self.props["size"]
+
+    def old_format(self):
+        return self.props.get("format", 2) == 1
+
+    def list_lockers(self):
+        if "lock_type" not in self.props:
+            return []
+        return {
+            "lockers": [("client.1", "cookie", "addr")],
+            "exclusive": self.props["lock_type"] == "exclusive",
+        }
+
+    def parent_info(self):
+        if "parent" not in self.props:
+            raise pools_module.rbd.ImageNotFound()
+        return self.props["parent"]
+
+    def list_snaps(self):
+        return [
+            dict(name=name, size=self.props["size"])
+            for name, _ in self.props.get("snaps", [])
+        ]
+
+    def is_protected_snap(self, snap):
+        return dict(self.props["snaps"])[snap]
+
+    def close(self):
+        pass
+
 
 @pytest.fixture
 def cluster():
@@ -17,13 +97,13 @@ def cluster():
 
 @pytest.fixture
 def pools(cluster, monkeypatch):
+    monkeypatch.setattr(cluster, "connect", lambda: FakeRados(FAKE_POOLS))
+    monkeypatch.setattr(pools_module.rbd, "RBD", FakeRBD, raising=False)
+    monkeypatch.setattr(pools_module.rbd, "Image", FakeRBDImage, raising=False)
+    monkeypatch.setattr(FakeRBD, "listed", [])
+    monkeypatch.setattr(FakeRBD, "removed", [])
     monkeypatch.setattr(
-        Pool,
-        "_rbd_query",
-        lambda self: """\
-[{"image":"test04.root","size":21474836480,"format":1},
- {"image":"test04.tmp","size":5368709120,"format":2,"lock_type":"exclusive"}]
-""",
+        Pools, "names", lambda self: set(["test", "data", "empty", "gone"])
     )
     return Pools(cluster)
 
@@ -141,31 +221,45 @@ class TestPool(object):
         with pytest.raises(KeyError):
             p["unknown"]
 
-    def test_unknown_pool_gives_keyerror(self, cluster):
-        setattr(
-            cluster,
-            "rbd",
-            lambda args, accept_failure, ignore_dry_run: (
-                "",
-                "rbd: error opening pool test2: (2) No such file or "
-                "directory\n",
-                2,
-            ),
-        )
+    def test_unknown_pool_gives_keyerror(self, pools):
         with pytest.raises(KeyError):
-            Pool("test2", cluster)._rbd_query()
-
-    def test_empty_pool_returns_empty_set(self, cluster):
-        setattr(
-            cluster,
-            "rbd",
-            lambda args, accept_failure, ignore_dry_run: (
-                "",
-                "rbd: pool t3 doesn't contain rbd images\n",
-                2,
-            ),
+            pools["test2"].image_names()
+        with pytest.raises(KeyError):
+            pools["test2"]["test04.root"]
+
+    def test_empty_pool_returns_empty_set(self, pools):
+        assert set() == pools["empty"].image_names()
+        assert [] == pools["empty"].images
+
+    def test_lookup_only_queries_requested_image(self, pools, monkeypatch):
+        queried = []
+        query = Pool._query_image
+
+        def record_query(self, name):
+            queried.append(name)
+            return query(self, name)
+
+        monkeypatch.setattr(Pool, "_query_image", record_query)
+        p = pools["data"]
+        assert p["test05.root@keep"].protected
+        assert not p["test05.root@backy-1"].protected
+        assert p["test05.root"].parent == "rbd/base@v1"
+        assert queried == ["test05.root"]
+
+    def test_records_contain_snapshots(self, pools):
+        records = pools["data"].records("test05.root")
+        assert set(r.name for r in records) == set(
+            ["test05.root", "test05.root@backy-1", "test05.root@keep"]
         )
-        assert "[]" == Pool("t3", cluster)._rbd_query()
+
+    def test_removing_image_updates_listing_in_place(self, pools):
+        p = pools["test"]
+        assert len(p.images) == 2
+        p.image_rm(p["test04.tmp"])
+        assert FakeRBD.removed == [("test", "test04.tmp")]
+        assert p.image_names() == set(["test04.root"])
+        assert [i.name for i in p.images] == ["test04.root"]
+        assert FakeRBD.listed == ["test"]
 
     def test_get_pg_num(self, cluster):
         setattr(
@@ -214,16 +308,64 @@ class TestPool(object):
     def test_total_size(self, pools):
         assert 25 == pools["test"].size_total_gb
 
-    def test_total_size_should_exclude_snapshots(self, cluster, monkeypatch):
+    def test_total_size_should_exclude_snapshots(self, pools):
+        assert 2 == pools["data"].size_total_gb
+
+
+class TestImageIndex(object):
+    def test_pools_for_image(self, pools):
+        index = pools.index
+        assert set(["test", "data"]) == set(
+            p.name for p in index.pools_for("test04.root")
+        )
+        assert [] == index.pools_for("unknown")
+
+    def test_index_lists_each_pool_once(self, pools):
+        pools.index.pools_for("test04.root")
+        pools.index.pools_for("test05.root")
+        assert sorted(FakeRBD.listed) == ["data", "empty", "test"]
+
+    def test_index_is_cached(self, pools):
+        assert pools.index is pools.index
+
+    def test_lookup(self, pools):
+        result = dict(
+            (pool.name, set(r.name for r in records))
+            for pool, records in pools.index.lookup("test05.root")
+        )
+        assert result == {
+            "data": set(
+                ["test05.root", "test05.root@backy-1", "test05.root@keep"]
+            )
+        }
+
+    def test_lookup_skips_removed_images(self, pools):
+        index = pools.index
+        index.pools_for("test04.tmp")
+        pools["test"].image_rm(pools["test"]["test04.tmp"])
+        assert [] == index.lookup("test04.tmp")
+
+    def test_snapshots(self, pools, monkeypatch):
+        queried = []
         monkeypatch.setattr(
-            Pool,
-            "_rbd_query",
-            lambda self: """\
-[{"image":"test04.root","size":21474836480,"format":1},
- {"format":2,"image":"test03.root","size":10737418240,"protected":"false",\
-  "snapshot":"backy-ZEQmgR6PsqPyj6235sUBAK"},
- {"image":"test04.tmp","size":5368709120,"format":2,"lock_type":"exclusive"}]
-""",
+            Pool, "_query_image", lambda self, name: queried.append(name)
+        )
+        snapshots = set(
+            (p.name, i.name, i.protected) for p, i in pools.index.snapshots()
+        )
+        assert snapshots == set(
+            [
+                ("data", "test05.root@backy-1", False),
+                ("data", "test05.root@keep", True),
+            ]
+        )
+        # No image details are loaded.
+        assert queried == []
+
+    def test_snapshots_reuses_loaded_pool(self, pools, monkeypatch):
+        for pool in ["test", "data"]:
+            pools[pool].images
+        monkeypatch.setattr(Pool, "_query_snapshots", None)
+        assert set(i.name for _, i in pools.index.snapshots()) == set(
+            ["test05.root@backy-1", "test05.root@keep"]
         )
-        pools = Pools(cluster)
-        assert 25 == pools["test"].size_total_gb
@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import contextlib
 import hashlib
+import inspect
+import json
 import logging
 import os
-import os.path as p
+import queue
 import socket
-import stat
-import subprocess
 import sys
-import tempfile
+import threading
 import time
 
+import lz4.frame
 import rados
 import rbd
 import requests
@@ -34,6 +36,9 @@ CEPH_CONF = "/etc/ceph/ceph.conf"
 CEPH_CLIENT = socket.gethostname()
 CEPH_POOL = "rbd.hdd"
 LOCK_COOKIE = "{}.{}".format(CEPH_CLIENT, os.getpid())
+BLOCKSIZE = 4 * 2**20
+RESIZE_STEP = 2**30
+ZERO_BLOCK = bytes(BLOCKSIZE)
 
 logger = logging.getLogger(__name__)
 
@@ -97,72 +102,632 @@ def hydra_build_info(build_id):
     return buildproduct
 
 
-def download_image(build_id):
-    """Fetches compressed image from Hydra.
+def decompress_lz4(chunks):
+    """Decompresses a stream of lz4 frame data chunk by chunk.
 
-    Returns tmpdir handle and filename.
+    Output is produced in pieces of at most BLOCKSIZE bytes, regardless of
+    how well the input compresses.
     """
-    buildproduct = hydra_build_info(build_id)
-    url = build_url(build_id, download=True)
-    logging.debug("\t\tGetting %s", url)
-    r = requests.get(url, stream=True)
-    r.raise_for_status()
-    chksum = hashlib.sha256()
-    size = 0
-    td = tempfile.TemporaryDirectory(prefix="image.")
-    outfile = p.join(td.name, buildproduct["name"])
-    logging.debug("\t\tSaving to %s", outfile)
-    with open(outfile, "wb") as out:
-        for chunk in r.iter_content(4 * 2**20):
-            out.write(chunk)
+    decompressor = None
+    for chunk in chunks:
+        while chunk or (decompressor and not decompressor.needs_input):
+            if decompressor is None:
+                decompressor = lz4.frame.LZ4FrameDecompressor()
+            data = decompressor.decompress(chunk, max_length=BLOCKSIZE)
+            chunk = b""
+            if data:
+                yield data
+            if decompressor.eof:
+                # Concatenated frames are valid lz4 files, too.
+                chunk = decompressor.unused_data
+                decompressor = None
+    if decompressor is not None:
+        raise RuntimeError("Truncated lz4 image data")
+
+
+def rechunk(chunks, size=BLOCKSIZE):
+    """Regroups a stream of byte strings into blocks of `size` bytes.
+
+    Only the last block may be shorter.
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+
+class ImageStream:
+    """Downloads, verifies and decompresses an image from Hydra on the fly.
+
+    Iterating yields uncompressed blocks while the download is still in
+    progress. A background thread stays at most `queue_size` blocks ahead
+    of the consumer, so neither scratch space nor much memory is needed.
+
+    Size and checksum of the download are verified before the last block
+    is handed out. A mismatch raises RuntimeError from the iteration, so
+    callers must not publish the data (i.e. create a snapshot) before the
+    iteration has finished.
+    """
+
+    def __init__(self, build_id, queue_size=8):
+        self.build_id = build_id
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.cancelled = threading.Event()
+        self.size = 0  # uncompressed
+
+    def _download(self):
+        buildproduct = hydra_build_info(self.build_id)
+        url = build_url(self.build_id, download=True)
+        logger.debug("\t\tGetting %s", url)
+        r = requests.get(url, stream=True)
+        r.raise_for_status()
+        chksum = hashlib.sha256()
+        size = 0
+        for chunk in r.iter_content(2**20):
             chksum.update(chunk)
             size += len(chunk)
-    expected_size = buildproduct["filesize"]
-    if expected_size != size:
-        raise RuntimeError(
-            "Image size mismatch: expect={}, got={}", expected_size, size
+            yield chunk
+        expected_size = buildproduct["filesize"]
+        if expected_size != size:
+            raise RuntimeError(
+                "Image size mismatch: expect={}, got={}", expected_size, size
+            )
+        expected_hash = buildproduct["sha256hash"]
+        if expected_hash != chksum.hexdigest():
+            raise RuntimeError(
+                "Image checksum mismatch: expect={}, got={}",
+                expected_hash,
+                chksum.hexdigest(),
+            )
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _produce(self):
+        try:
+            for block in rechunk(decompress_lz4(self._download())):
+                if self.cancelled.is_set():
+                    return
+                self._put(block)
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(None)
+
+    def __iter__(self):
+        producer = threading.Thread(
+            target=self._produce,
+            name=threading.current_thread().name + "-download",
+            daemon=True,
         )
-    expected_hash = buildproduct["sha256hash"]
-    if expected_hash != chksum.hexdigest():
-        raise RuntimeError(
-            "Image checksum mismatch: expect={}, got={}",
-            expected_hash,
-            chksum.hexdigest(),
+        producer.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                self.size += len(item)
+                yield item
+        finally:
+            self.cancelled.set()
+            producer.join()
+
+
+class Manifest:
+    """Block hash list describing the content of an image snapshot.
+
+    Stored next to each snapshot so that the next update can find changed
+    blocks by hashing only the new image instead of reading the old one
+    back from the cluster.
+    """
+
+    VERSION = 1
+
+    def __init__(self, blocksize=BLOCKSIZE, digests=None):
+        self.blocksize = blocksize
+        self.digests = digests if digests is not None else []
+
+    def __len__(self):
+        return len(self.digests)
+
+    @staticmethod
+    def digest(block):
+        return hashlib.sha256(block).digest()
+
+    def matches(self, index, digest):
+        return index < len(self.digests) and self.digests[index] == digest
+
+    def dumps(self):
+        payload = b"".join(self.digests)
+        header = json.dumps(
+            {
+                "version": self.VERSION,
+                "blocksize": self.blocksize,
+                "blocks": len(self.digests),
+                "sha256": hashlib.sha256(payload).hexdigest(),
+            }
         )
-    return td, outfile
+        return header.encode("ascii") + b"\n" + payload
+
+    @classmethod
+    def loads(cls, data):
+        """Parses serialized manifest. Raises ValueError if corrupt."""
+        try:
+            header, payload = data.split(b"\n", 1)
+            header = json.loads(header.decode("ascii"))
+            version = header["version"]
+            blocksize = header["blocksize"]
+            blocks = header["blocks"]
+            checksum = header["sha256"]
+        except (KeyError, TypeError, UnicodeDecodeError) as e:
+            raise ValueError("Cannot parse manifest header", e)
+        if version != cls.VERSION:
+            raise ValueError("Unknown manifest version", version)
+        if blocksize != BLOCKSIZE:
+            raise ValueError("Unexpected manifest blocksize", blocksize)
+        if hashlib.sha256(payload).hexdigest() != checksum:
+            raise ValueError("Manifest checksum mismatch")
+        size = hashlib.sha256().digest_size
+        if len(payload) != blocks * size:
+            raise ValueError("Manifest length mismatch")
+        digests = [payload[i : i + size] for i in range(0, len(payload), size)]
+        return cls(blocksize, digests)
+
 
+class Throttle:
+    """Paces background I/O to keep OSD latencies below a target.
 
-def delta_update(from_, to):
-    """Update changed blocks between image files.
+    Every `interval` seconds, the commit/apply latencies of all OSDs are
+    sampled from the monitors. While the slowest OSD is above `target_ms`,
+    the delay between operations is doubled (starting from `base`, up to
+    `max_delay`). While it is below half the target, the delay is halved
+    and eventually dropped completely.
+
+    Adjustments are logged and, if `stats` names a file, appended to it as
+    JSON lines so the parameters can be tuned later.
+    """
+
+    def __init__(
+        self,
+        name,
+        cluster,
+        target_ms,
+        base,
+        max_delay,
+        interval=5,
+        stats=None,
+    ):
+        self.name = name
+        self.cluster = cluster
+        self.target_ms = target_ms
+        self.base = base
+        self.max_delay = max_delay
+        self.interval = interval
+        self.stats = stats
+        self.delay = base
+        self.next_sample = 0
+
+    def osd_latency(self):
+        """Returns the highest commit/apply latency of all OSDs in ms."""
+        ret, out, err = self.cluster.mon_command(
+            json.dumps({"prefix": "osd perf", "format": "json"}), b""
+        )
+        if ret != 0:
+            raise RuntimeError("osd perf failed", ret, err)
+        perf = json.loads(out)
+        # Newer releases wrap the list into another object.
+        infos = perf.get("osdstats", perf)["osd_perf_infos"]
+        return max(
+            (
+                max(
+                    i["perf_stats"]["commit_latency_ms"],
+                    i["perf_stats"]["apply_latency_ms"],
+                )
+                for i in infos
+            ),
+            default=0,
+        )
+
+    def adjust(self):
+        try:
+            latency = self.osd_latency()
+        except Exception:
+            logger.warning("\t\tCould not sample OSD latency", exc_info=True)
+            return
+        delay = self.delay
+        if latency > self.target_ms:
+            delay = min(self.max_delay, max(2 * delay, self.base))
+        elif latency < self.target_ms / 2:
+            delay = delay / 2 if delay > self.base / 8 else 0
+        if delay != self.delay:
+            logger.info(
+                "\t\t%s throttle: OSD latency %dms (target %dms), "
+                "delay %.3fs",
+                self.name,
+                latency,
+                self.target_ms,
+                delay,
+            )
+        self.delay = delay
+        if self.stats:
+            with open(self.stats, "a") as f:
+                record = {
+                    "time": time.time(),
+                    "throttle": self.name,
+                    "latency_ms": latency,
+                    "target_ms": self.target_ms,
+                    "delay": delay,
+                }
+                f.write(json.dumps(record) + "\n")
+
+    def wait(self):
+        """Pauses between two operations."""
+        now = time.monotonic()
+        if now >= self.next_sample:
+            self.adjust()
+            self.next_sample = now + self.interval
+        if self.delay:
+            time.sleep(self.delay)
+
+
+class AioWriter:
+    """Writes to an RBD image with a bounded number of requests in flight."""
+
+    def __init__(self, image, max_inflight=16):
+        self.image = image
+        self.max_inflight = max_inflight
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.errors = []
+
+    def _complete(self, completion):
+        ret = completion.get_return_value()
+        if ret < 0:
+            self.errors.append(ret)
+        self.slots.release()
+
+    def _check(self):
+        if self.errors:
+            raise RuntimeError("Asynchronous RBD I/O failed", self.errors)
+
+    def _submit(self, aio_function, *args):
+        self._check()
+        self.slots.acquire()
+        try:
+            aio_function(*args, self._complete)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def write(self, data, offset):
+        self._submit(self.image.aio_write, data, offset)
+
+    def discard(self, offset, length):
+        self._submit(self.image.aio_discard, offset, length)
+
+    def drain(self):
+        """Waits until no requests are in flight anymore."""
+        for _ in range(self.max_inflight):
+            self.slots.acquire()
+        for _ in range(self.max_inflight):
+            self.slots.release()
+
+    def wait(self):
+        """Waits until all requests are done and flushes the image."""
+        self.drain()
+        self._check()
+        self.image.flush()
+
+
+def allocated_blocks(image):
+    """Returns indexes of all blocks that contain data.
+
+    Uses librbd's allocation information instead of reading the image. All
+    other blocks are known to read as zeros.
+    """
+    allocated = set()
+
+    def mark(offset, length, exists):
+        if exists:
+            first = offset // BLOCKSIZE
+            last = (offset + length - 1) // BLOCKSIZE
+            allocated.update(range(first, last + 1))
+
+    image.diff_iterate(0, image.size(), None, mark)
+    return allocated
+
+
+def delta_update(blocks, image, manifest=None, max_inflight=16, throttle=None):
+    """Update changed blocks of an RBD image.
 
     We assume that one generation of a VM image does not differ
     fundamentatlly from the generation before. We only update
     changed blocks. Additionally, we use a stuttering technique to
-    improve fairness.
+    improve fairness. The stutter is controlled by `throttle` if given.
+
+    `blocks` is an iterable of BLOCKSIZE chunks of the new image content.
+    If `manifest` describes the current content of `image`, changed blocks
+    are found by comparing block hashes and `image` is never read. Without
+    a manifest (first run, lost or corrupted manifest) every allocated
+    block is read back and compared instead (verification mode).
+
+    Changed blocks are written asynchronously with at most `max_inflight`
+    requests outstanding. Blocks that contain only zeros are discarded to
+    keep the image thin. The image is grown as needed but never shrunk.
+
+    Returns a manifest describing the updated content of `image`.
     """
-    logger.debug("\t\tUpdating...")
-    blocksize = 4 * 2**20
+    logger.debug(
+        "\t\tUpdating (%s)...", "manifest" if manifest else "verifying"
+    )
+    allocated = allocated_blocks(image) if manifest is None else None
+    writer = AioWriter(image, max_inflight)
+    result = Manifest()
     total = 0
     written = 0
-    with open(from_, "rb") as source:
-        with open(to, "r+b") as dest:
-            while True:
-                a = source.read(blocksize)
-                if not a:
-                    break
-                total += 1
-                b = dest.read(blocksize)
-                if a != b:
-                    dest.seek(-len(b), os.SEEK_CUR)
-                    dest.write(a)
-                    written += 1
+    try:
+        for a in blocks:
+            digest = Manifest.digest(a)
+            offset = total * BLOCKSIZE
+            end = offset + len(a)
+            if end > image.size():
+                image.resize(-(-end // RESIZE_STEP) * RESIZE_STEP)
+            zero = a == ZERO_BLOCK[: len(a)]
+            if manifest is not None:
+                changed = not manifest.matches(total, digest)
+            elif total in allocated:
+                changed = image.read(offset, len(a)) != a
+            else:
+                changed = not zero
+            if changed:
+                if zero:
+                    writer.discard(offset, len(a))
+                else:
+                    writer.write(a, offset)
+                written += 1
+                if throttle:
+                    throttle.wait()
+                else:
                     time.sleep(0.01)
+            result.digests.append(digest)
+            total += 1
+    except BaseException:
+        # Completion callbacks must not run after the caller has
+        # closed the image.
+        writer.drain()
+        raise
+    writer.wait()
     logger.debug(
         "\t\t%d/%d 4MiB blocks updated (%d%%)",
         written,
         total,
         100 * written / (max(total, 1)),
     )
+    return result
+
+
+def supports_progress(function):
+    """Tells whether an rbd function accepts an `on_progress` callback.
+
+    Older bindings do not. Cython functions may not expose a signature,
+    their docstring mentions the parameter instead.
+    """
+    try:
+        return "on_progress" in inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        return "on_progress" in (function.__doc__ or "")
+
+
+class FlattenScheduler:
+    """Flattens child images of a base image's snapshots concurrently.
+
+    Children are flattened smallest first by up to `concurrency` workers.
+    The queue of pending children is persisted in the RADOS object
+    `<release>.flatten` next to the base image. An interrupted run resumes
+    with the remaining children, merged with children that have been
+    created since. Children that failed to flatten stay queued and are
+    retried by the next run.
+    """
+
+    def __init__(self, base, concurrency=4, throttle=None):
+        self.base = base
+        self.concurrency = concurrency
+        self.throttle = throttle
+        self.pending = []
+        self.report = []
+        self._progress = False
+
+    @property
+    def _queue_object(self):
+        return "{}.flatten".format(self.base.release)
+
+    def load(self):
+        """Returns persisted queue or None if there is none."""
+        try:
+            size, _mtime = self.base.ioctx.stat(self._queue_object)
+            data = self.base.ioctx.read(self._queue_object, size)
+            return [tuple(x) for x in json.loads(data)["pending"]]
+        except rados.ObjectNotFound:
+            return None
+        except (ValueError, KeyError, TypeError):
+            logger.warning("\tIgnoring corrupted flatten queue")
+            return None
+
+    def save(self):
+        if not self.pending:
+            try:
+                self.base.ioctx.remove_object(self._queue_object)
+            except rados.ObjectNotFound:
+                pass
+            return
+        data = json.dumps({"pending": self.pending}).encode("ascii")
+        self.base.ioctx.write_full(self._queue_object, data)
+
+    def discover(self):
+        """Lists (pool, image, size) of all children, smallest first.
+
+        Children that cannot be opened, e.g. because they have been deleted
+        meanwhile, are skipped and picked up again by the next run.
+        """
+        children = []
+        for snap in self.base.image.list_snaps():
+            snap = rbd.Image(
+                self.base.ioctx, self.base.release, snap["name"], True
+            )
+            try:
+                for child_pool, child_image in snap.list_children():
+                    try:
+                        with self._open(child_pool, child_image) as image:
+                            size = image.size()
+                    except (rbd.Error, rados.Error) as e:
+                        logger.warning(
+                            "\tSkipping %s/%s: %s", child_pool, child_image, e
+                        )
+                        continue
+                    children.append((child_pool, child_image, size))
+            finally:
+                snap.close()
+        children.sort(key=lambda x: x[2])
+        return children
+
+    @contextlib.contextmanager
+    def _open(self, pool, image):
+        ioctx = self.base.cluster.open_ioctx(pool)
+        try:
+            image = rbd.Image(ioctx, image)
+            try:
+                yield image
+            finally:
+                image.close()
+        finally:
+            ioctx.close()
+
+    def _flatten(self, child):
+        pool, name, size = child
+        logger.info("\tFlattening %s/%s (%d MiB)", pool, name, size // 2**20)
+        started = time.monotonic()
+
+        def progress(offset, total):
+            logger.debug("\t\t%s/%s: %d%%", pool, name, 100 * offset / total)
+            return 0
+
+        try:
+            with self._open(pool, name) as image:
+                if self._progress:
+                    image.flatten(on_progress=progress)
+                else:
+                    image.flatten()
+        except Exception:
+            logger.exception("Error trying to flatten %s/%s", pool, name)
+            return child, time.monotonic() - started, False
+        return child, time.monotonic() - started, True
+
+    def _finished(self, futures):
+        for future in futures:
+            child, duration, success = future.result()
+            pool, name, size = child
+            self.report.append((child, duration, success))
+            if not success:
+                # Keep the child queued for the next run.
+                logger.warning(
+                    "\tFailed to flatten %s/%s after %.1fs",
+                    pool,
+                    name,
+                    duration,
+                )
+                continue
+            self.pending.remove(child)
+            logger.info(
+                "\tFlattened %s/%s: %d MiB in %.1fs",
+                pool,
+                name,
+                size // 2**20,
+                duration,
+            )
+        self.save()
+
+    def _merge(self, saved, discovered):
+        """Merges a persisted queue with the currently existing children.
+
+        Children which are not listed anymore have been flattened or
+        deleted in the meantime and are dropped.
+        """
+        current = {(pool, name) for pool, name, _ in discovered}
+        resumed = [c for c in saved if (c[0], c[1]) in current]
+        if len(resumed) < len(saved):
+            logger.info(
+                "\tDropping %d queued flattens of vanished children",
+                len(saved) - len(resumed),
+            )
+        known = {(pool, name) for pool, name, _ in resumed}
+        new = [c for c in discovered if (c[0], c[1]) not in known]
+        logger.info(
+            "\tResuming %d pending flattens, %d new children",
+            len(resumed),
+            len(new),
+        )
+        return sorted(resumed + new, key=lambda x: x[2])
+
+    def run(self):
+        self._progress = supports_progress(rbd.Image.flatten)
+        saved = self.load()
+        pending = self.discover()
+        if saved is not None:
+            pending = self._merge(saved, pending)
+        self.pending = list(pending)
+        self.save()
+        running = set()
+        with concurrent.futures.ThreadPoolExecutor(
+            self.concurrency, thread_name_prefix=self.base.release
+        ) as pool:
+            for child in pending:
+                if len(running) >= self.concurrency:
+                    done, running = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    self._finished(done)
+                    if self.throttle:
+                        # give Ceph room catch up with I/O
+                        self.throttle.wait()
+                running.add(pool.submit(self._flatten, child))
+            done, _ = concurrent.futures.wait(running)
+            self._finished(done)
+        flattened = [r for r in self.report if r[2]]
+        if flattened:
+            logger.info(
+                "\tFlattened %d images (%d MiB) in %.1fs total worker time",
+                len(flattened),
+                sum(child[2] for child, _, _ in flattened) // 2**20,
+                sum(duration for _, duration, _ in flattened),
+            )
+        failed = len(self.report) - len(flattened)
+        if failed:
+            logger.warning(
+                "\tFailed to flatten %d images, keeping them queued", failed
+            )
+        return self.report
+
+
+class Limits:
+    """Bounds work shared by branches that are processed in parallel.
+
+    Streaming a new image needs a download and a writer slot, flattening
+    child images needs a writer slot.
+    """
+
+    def __init__(self, downloads=1, writers=1):
+        self.download = threading.BoundedSemaphore(downloads)
+        self.write = threading.BoundedSemaphore(writers)
 
 
 class BaseImage:
@@ -171,8 +736,19 @@ class BaseImage:
     rbd = None
     image = None
 
-    def __init__(self, release):
+    def __init__(
+        self,
+        release,
+        latency_target=50,
+        throttle_stats=None,
+        flatten_concurrency=4,
+        limits=None,
+    ):
         self.release = release
+        self.flatten_concurrency = flatten_concurrency
+        self.limits = limits or Limits()
+        self.latency_target = latency_target
+        self.throttle_stats = throttle_stats
 
     def __enter__(self):
         """Context manager to maintain Ceph connection.
@@ -184,6 +760,22 @@ class BaseImage:
         )
         self.cluster.connect()
         self.ioctx = self.cluster.open_ioctx(CEPH_POOL)
+        self.write_throttle = Throttle(
+            "write",
+            self.cluster,
+            self.latency_target,
+            base=0.01,
+            max_delay=1,
+            stats=self.throttle_stats,
+        )
+        self.flatten_throttle = Throttle(
+            "flatten",
+            self.cluster,
+            self.latency_target,
+            base=5,
+            max_delay=120,
+            stats=self.throttle_stats,
+        )
         self.rbd = rbd.RBD()
 
         if self.release not in self.rbd.list(self.ioctx):
@@ -245,28 +837,61 @@ class BaseImage:
     def _snapshot_names(self):
         return [x["name"] for x in self.image.list_snaps()]
 
+    def _manifest_object(self, snapshot):
+        return "{}@{}.manifest".format(self.release, snapshot)
+
     @property
-    def volume(self):
-        return "{}/{}".format(CEPH_POOL, self.release)
+    def _dirty_object(self):
+        """Marks that the image has been written since its last snapshot."""
+        return "{}.dirty".format(self.release)
 
-    @contextlib.contextmanager
-    def mapped(self):
-        dev = subprocess.check_output(
-            ["rbd", "--id", CEPH_CLIENT, "map", self.volume]
-        )
-        dev = dev.decode().strip()
-        assert stat.S_ISBLK(os.stat(dev).st_mode)
+    def _object_exists(self, name):
         try:
-            yield dev
-        finally:
-            subprocess.check_call(["rbd", "--id", CEPH_CLIENT, "unmap", dev])
+            self.ioctx.stat(name)
+        except rados.ObjectNotFound:
+            return False
+        return True
+
+    def load_manifest(self):
+        """Returns the manifest matching the current image content.
 
-    def store_in_ceph(self, img):
-        """Updates image data from uncompressed image file."""
+        Returns None if there is no trustworthy manifest. Callers must
+        fall back to reading and verifying the image then.
+        """
+        snaps = sorted(self.image.list_snaps(), key=lambda x: x["id"])
+        if not snaps:
+            return None
+        if self._object_exists(self._dirty_object):
+            logger.info("\tImage modified since last snapshot, verifying")
+            return None
+        name = self._manifest_object(snaps[-1]["name"])
+        try:
+            size, _mtime = self.ioctx.stat(name)
+            return Manifest.loads(self.ioctx.read(name, size))
+        except rados.ObjectNotFound:
+            logger.info("\tNo manifest found, verifying")
+        except ValueError:
+            logger.warning("\tCorrupted manifest %s, verifying", name)
+        return None
+
+    def save_manifest(self, snapshot, manifest):
+        self.ioctx.write_full(
+            self._manifest_object(snapshot), manifest.dumps()
+        )
+        self.ioctx.remove_object(self._dirty_object)
+
+    def store_in_ceph(self, stream, manifest=None):
+        """Updates image data from a stream of uncompressed blocks.
+
+        Returns the manifest of the new image content.
+        """
         logger.info("\tStoring in volume %s/%s", CEPH_POOL, self.release)
-        self.image.resize(os.stat(img).st_size)
-        with self.mapped() as blockdev:
-            delta_update(img, blockdev)
+        self.ioctx.write_full(self._dirty_object, b"")
+        manifest = delta_update(
+            stream, self.image, manifest, throttle=self.write_throttle
+        )
+        self.image.resize(stream.size)
+        return manifest
 
     def newest_hydra_build(self):
         """Checks Hydra for the newest release.
@@ -320,39 +945,23 @@ class BaseImage:
         logger.info(
             "\tHave builds: \n\t\t{}".format("\n\t\t".join(current_snapshots))
         )
-        logger.info("\tDownloading build: {}".format(name))
-        td, filename = download_image(build_id)
-        uncompressed = filename[0 : filename.rfind(".lz4")]
-        subprocess.check_call(["unlz4", "-q", filename, uncompressed])
-        os.unlink(filename)
-        self.store_in_ceph(uncompressed)
+        with self.limits.download, self.limits.write:
+            logger.info("\tDownloading build: {}".format(name))
+            manifest = self.store_in_ceph(
+                ImageStream(build_id), self.load_manifest()
+            )
         logger.info("\tCreating snapshot %s", name)
         self.image.create_snap(name)
         self.image.protect_snap(name)
+        self.save_manifest(name, manifest)
 
     def flatten(self):
         """Decouple VMs created from their base snapshots."""
         logger.debug("Flattening child images for %s", self.release)
-        for snap in self.image.list_snaps():
-            snap = rbd.Image(self.ioctx, self.release, snap["name"])
-            for child_pool, child_image in snap.list_children():
-                logger.info(
-                    "\tFlattening {}/{}".format(child_pool, child_image)
-                )
-                try:
-                    pool = self.cluster.open_ioctx(child_pool)
-                    image = rbd.Image(pool, child_image)
-                    image.flatten()
-                except Exception:
-                    logger.exception(
-                        "Error trying to flatten {}/{}".format(
-                            child_pool, child_image
-                        )
-                    )
-                finally:
-                    image.close()
-                    pool.close()
-                time.sleep(5)  # give Ceph room catch up with I/O
+        with self.limits.write:
+            FlattenScheduler(
+                self, self.flatten_concurrency, self.flatten_throttle
+            ).run()
 
     def purge(self):
         """Delete old images, but keep the last three.
@@ -384,32 +993,75 @@ class BaseImage:
             try:
                 self.image.unprotect_snap(snap["name"])
                 self.image.remove_snap(snap["name"])
+                self.ioctx.remove_object(self._manifest_object(snap["name"]))
+            except rados.ObjectNotFound:
+                pass
             except Exception:
                 logger.exception("Error trying to purge snapshot:")
 
 
-def load_vm_images():
+def update_branch(branch, **kw):
+    """Updates, flattens and purges a single branch.
+
+    Returns (status, duration) with status being one of "ok", "locked" or
+    "failed". Errors are logged but do not affect other branches.
+    """
+    threading.current_thread().name = branch
+    started = time.monotonic()
+    logger.info("Updating branch {}".format(branch))
+    try:
+        with BaseImage(branch, **kw) as image:
+            image.update()
+            image.flatten()
+            image.purge()
+    except LockingError:
+        status = "locked"
+    except Exception:
+        logger.exception(
+            "An error occured while updating branch `{}`".format(branch)
+        )
+        status = "failed"
+    else:
+        status = "ok"
+    return status, time.monotonic() - started
+
+
+def load_vm_images(
+    latency_target=50,
+    throttle_stats=None,
+    flatten_concurrency=4,
+    parallel_downloads=2,
+    parallel_writers=2,
+):
     level = logging.INFO
     try:
         if int(os.environ.get("VERBOSE", 0)):
             level = logging.DEBUG
     except Exception:
         pass
-    logging.basicConfig(level=level, format="%(message)s")
+    logging.basicConfig(level=level, format="[%(threadName)s] %(message)s")
     requests_log = logging.getLogger("urllib3")
     requests_log.setLevel(logging.WARNING)
     requests_log.propagate = True
-    try:
-        for branch in RELEASES:
-            logger.info("Updating branch {}".format(branch))
-            with BaseImage(branch) as image:
-                image.update()
-                image.flatten()
-                image.purge()
-    except LockingError:
-        sys.exit(69)
-    except Exception:
-        logger.exception(
-            "An error occured while updating branch `{}`".format(branch)
-        )
+    limits = Limits(parallel_downloads, parallel_writers)
+    with concurrent.futures.ThreadPoolExecutor(len(RELEASES)) as pool:
+        futures = {
+            branch: pool.submit(
+                update_branch,
+                branch,
+                latency_target=latency_target,
+                throttle_stats=throttle_stats,
+                flatten_concurrency=flatten_concurrency,
+                limits=limits,
+            )
+            for branch in RELEASES
+        }
+    results = {branch: f.result() for branch, f in futures.items()}
+    logger.info("Branch timings:")
+    for branch, (status, duration) in results.items():
+        logger.info("\t%-25s %-6s %8.1fs", branch, status, duration)
+    statuses = set(status for status, _ in results.values())
+    if "failed" in statuses:
         sys.exit(1)
+    if "locked" in statuses:
+        sys.exit(69)
@@ -1,19 +1,20 @@
 """Update the in-core cephx client keys from the keyring file."""
 
 import base64
+import collections
 import datetime
 import hashlib
 import json
 import logging
 import re
 import struct
-import subprocess
 import sys
-import tempfile
 import textwrap
+import time
 
 import fc.util.configfile
 import fc.util.directory
+from fc.ceph.api import Cluster
 
 #####################
 # Ceph key management
@@ -87,24 +88,37 @@ class InstalledKey(object):
         raise TypeError(f"Invalid comparison with {other!r}")
 
 
+def _text(output):
+    if isinstance(output, bytes):
+        output = output.decode("ascii")
+    return output
+
+
 class InstalledKeys(object):
-    """Interface to cephx' live (in-core) key store."""
+    """Interface to cephx' live (in-core) key store.
+
+    Changed keys are collected by `ensure()` and imported together by
+    `commit()`, all over a single monitor connection.
+    """
 
     known_keys = None
     seen_entities = None
 
-    def __init__(self):
+    def __init__(self, cluster=None):
+        self.cluster = cluster or Cluster(ceph_id="admin")
+        self.started = time.time()
         self.known_keys = {}
-        out = subprocess.check_output(
-            ["ceph", "auth", "list", "-f", "json"],
-            stderr=subprocess.PIPE,
-        )
+        out, _ = self.cluster.ceph(["auth", "list"], ignore_dry_run=True)
         data = json.loads(out)["auth_dump"]
         for record in data:
             self.known_keys[record["entity"]] = InstalledKey.from_mon_data(
                 record
             )
         self.seen_entities = set()
+        self.pending = []
+        self.stats = collections.Counter(
+            updated=0, unchanged=0, stub=0, deleted=0
+        )
 
     def ensure(self, keyconfig):
         print(f"\n{keyconfig.entity}:")
@@ -114,39 +128,44 @@ class InstalledKeys(object):
         if keyconfig.stub:
             # Stubs are recorded so we do not delete them but are a NOOP.
             print("\tNOOP (Key is a stub.)")
+            self.stats["stub"] += 1
             return
 
         if keyconfig.entity in self.known_keys:
             known_key = self.known_keys[keyconfig.entity]
             if known_key == keyconfig:
                 print("\tNOOP (Key in store and matching.)")
+                self.stats["unchanged"] += 1
                 return
             else:
                 print("\tUPDATE (Key in store but not matching.)")
         else:
             print("\tUPDATE (Key not in store)")
 
-        # FYI No need (and no ability) to manage the umask here as tempfile
-        # ensures this that temporary files are private by default.
-        tmp_keyring = tempfile.NamedTemporaryFile(mode="w+")
-        tmp_keyring.write(
+        self.pending.append(
             f"""
 [{keyconfig.entity}]
     key = "{keyconfig.key.to_string()}"
     {keyconfig.render_capabilities()}
 """
         )
-        tmp_keyring.flush()
+
+    def commit(self):
+        """Import all keys updated by `ensure()` with a single call."""
+        if not self.pending:
+            return
+        keyring = "".join(self.pending)
+        print(f"\nImporting {len(self.pending)} key(s)")
         try:
-            output = subprocess.check_output(
-                ["ceph", "auth", "import", "-i", tmp_keyring.name],
-                stderr=subprocess.STDOUT,
-            ).decode("ascii")
+            _, output = self.cluster.ceph(
+                ["auth", "import"], inbuf=keyring.encode("ascii")
+            )
         except Exception as e:
-            print(textwrap.indent(e.output.decode("ascii", "\t")))
+            print(textwrap.indent(str(e), "\t"))
             raise
-        else:
-            print(textwrap.indent(output, "\t"))
+        print(textwrap.indent(_text(output), "\t"))
+        self.stats["updated"] += len(self.pending)
+        self.pending = []
 
     def purge(self):
         """Delete keys that are not required any longer.
@@ -159,17 +178,23 @@ class InstalledKeys(object):
         KEEP = re.compile(r"^(mon\.|osd\..+|client.admin)$")
         entities_to_delete -= set(filter(KEEP.match, entities_to_delete))
 
-        for entity in entities_to_delete:
+        for entity in sorted(entities_to_delete):
             print(f"Deleting key for {entity}")
             try:
-                output = subprocess.check_output(
-                    ["ceph", "auth", "del", entity], stderr=subprocess.STDOUT
-                ).decode("ascii")
+                _, output = self.cluster.ceph(["auth", "del", entity])
             except Exception as e:
-                print(textwrap.indent(e.output.decode("ascii", "\t")))
+                print(textwrap.indent(str(e), "\t"))
                 raise
-            else:
-                print(textwrap.indent(output, "\t"))
+            print(textwrap.indent(_text(output), "\t"))
+            self.stats["deleted"] += 1
+
+    def report(self):
+        print(
+            "\n{updated} updated, {unchanged} unchanged, {stub} stubs, "
+            "{deleted} deleted in {duration:.1f}s".format(
+                duration=time.time() - self.started, **self.stats
+            )
+        )
 
 
 class KeyConfig(object):
@@ -269,20 +294,34 @@ class KeyManager(object):
             # them as they have a different generation mechanism.
             stub = node["parameters"]["environment_class"] != "NixOS"
 
-            self.mon_update_single_client_key(
+            self._ensure_client_keys(
                 node["name"],
                 node["roles"],
                 node["parameters"]["secret_salt"],
                 stub,
             )
 
+        self._commit()
         if self.errors:
             print("Encountered errors. See log / output")
             sys.exit(1)
 
         self.keystore.purge()
+        self.keystore.report()
 
     def mon_update_single_client_key(self, id, roles, secret_salt, stub=False):
+        self._ensure_client_keys(id, roles, secret_salt, stub)
+        self._commit()
+        self.keystore.report()
+
+    def _commit(self):
+        try:
+            self.keystore.commit()
+        except Exception:
+            logging.exception("", exc_info=True)
+            self.errors = True
+
+    def _ensure_client_keys(self, id, roles, secret_salt, stub=False):
         # Check which keys to install:
         keys_to_install = set()
 
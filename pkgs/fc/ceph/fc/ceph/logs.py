@@ -1,48 +1,213 @@
 """Slow requests histogram tool.
 
-Reads a ceph.log file and filters by lines matching a given RE (default:
+Reads ceph.log files and filters by lines matching a given RE (default:
 slow request). For all filtered lines that contain an OSD identifier,
 the OSD identifier is counted. Prints a top-N list of OSDs having slow
 requests. Useful for identifying slacky OSDs.
+
+Optionally breaks the counts down into time buckets (overall and per
+OSD) and outputs everything as JSON for correlating with incidents.
 """
 
-import argparse
 import collections
+import concurrent.futures
+import datetime
 import gzip
+import json
 import re
 
-R_OSD = re.compile(r"osd\.[0-9]+")
+R_OSD = re.compile(rb"osd\.[0-9]+")
+R_TIMESTAMP = re.compile(rb"(\d{4})-(\d\d)-(\d\d)[ T](\d\d):(\d\d)")
+REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+CHUNKSIZE = 2**20
+
+
+class Filter(object):
+    """Matches byte lines against a RE.
+
+    Plain strings are matched with a substring search, which is much
+    cheaper than a regex.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        if REGEX_SPECIAL & set(pattern):
+            self.literal = None
+            # Finds candidates in whole chunks. They are checked against
+            # their line again, as matches may span multiple lines.
+            self.regex = re.compile(pattern.encode(), re.MULTILINE)
+            self.line_regex = re.compile(pattern.encode())
+            # These anchor at the start or end of the searched string,
+            # which is only a line when searching line by line.
+            self.per_line = "\\A" in pattern or "\\Z" in pattern
+        else:
+            self.literal = pattern.encode()
+            self.regex = self.line_regex = None
+            self.per_line = False
+
+    def search(self, line):
+        if self.literal is not None:
+            return self.literal in line
+        return self.line_regex.search(line) is not None
+
+    def lines(self, data):
+        """Yields the lines of `data` that match.
+
+        Searches the whole chunk instead of looking at each line.
+        """
+        if self.per_line:
+            yield from filter(self.search, data.splitlines())
+            return
+        pos = 0
+        while True:
+            if self.literal is not None:
+                start = data.find(self.literal, pos)
+                if start < 0:
+                    return
+            else:
+                m = self.regex.search(data, pos)
+                if not m:
+                    return
+                start = m.start()
+            line_start = data.rfind(b"\n", 0, start) + 1
+            line_end = data.find(b"\n", start)
+            if line_end < 0:
+                line_end = len(data)
+            line = data[line_start:line_end]
+            if self.literal is not None or self.line_regex.search(line):
+                yield line
+            pos = line_end + 1
+
+
+class SlowRequests(object):
+    """Counters of slow requests per OSD and per time bucket."""
+
+    def __init__(self, bucket_minutes=10):
+        self.bucket_minutes = bucket_minutes
+        self.osds = collections.Counter()
+        self.buckets = collections.Counter()
+        self.osd_buckets = collections.defaultdict(collections.Counter)
+        self._bucket_cache = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_bucket_cache"] = {}
+        return state
+
+    def add(self, osd, bucket):
+        self.osds[osd] += 1
+        if bucket:
+            self.buckets[bucket] += 1
+            self.osd_buckets[bucket][osd] += 1
 
+    def update(self, other):
+        self.osds.update(other.osds)
+        self.buckets.update(other.buckets)
+        for bucket, osds in other.osd_buckets.items():
+            self.osd_buckets[bucket].update(osds)
 
-def read(logfile, include, exclude):
-    i_filter = re.compile(include) if include else None
-    e_filter = re.compile(exclude) if exclude else None
+    def bucket(self, line):
+        """Returns the start of the time bucket `line` was logged in."""
+        # Lines logged in the same minute share a bucket.
+        minute = line[:16]
+        if minute not in self._bucket_cache:
+            self._bucket_cache[minute] = self._bucket(line)
+        return self._bucket_cache[minute]
+
+    def _bucket(self, line):
+        m = R_TIMESTAMP.match(line)
+        if not m:
+            return None
+        year, month, day, hour, minute = (int(x) for x in m.groups())
+        minutes = hour * 60 + minute
+        hour, minute = divmod(minutes - minutes % self.bucket_minutes, 60)
+        return datetime.datetime(year, month, day, hour, minute).strftime(
+            "%Y-%m-%d %H:%M"
+        )
+
+    def as_dict(self):
+        return {
+            "bucket_minutes": self.bucket_minutes,
+            "osds": dict(self.osds.most_common()),
+            "buckets": dict(sorted(self.buckets.items())),
+            "osd_buckets": {
+                bucket: dict(osds.most_common())
+                for bucket, osds in sorted(self.osd_buckets.items())
+            },
+        }
+
+
+def chunks(f):
+    """Yields chunks of complete lines."""
+    rest = b""
+    while True:
+        data = f.read(CHUNKSIZE)
+        if not data:
+            break
+        data = rest + data
+        end = data.rfind(b"\n") + 1
+        if not end:
+            rest = data
+            continue
+        rest = data[end:]
+        yield data[:end]
+    if rest:
+        yield rest
+
+
+def read(logfile, include, exclude, bucket_minutes=10):
+    """Counts slow requests in a single (optionally gzipped) log file."""
+    i_filter = Filter(include) if include else None
+    e_filter = Filter(exclude) if exclude else None
+    result = SlowRequests(bucket_minutes)
     if logfile.endswith(".gz"):
         f = gzip.open(logfile, mode="rb")
     else:
         f = open(logfile, mode="rb")
-    osds = []
-    for line in f:
-        line = line.decode().strip()
-        if i_filter and not i_filter.search(line):
-            continue
-        if e_filter and e_filter.search(line):
-            continue
-        m = R_OSD.search(line)
-        if m:
-            osds.append(m.group(0))
-    f.close()
-    return osds
+    with f:
+        for chunk in chunks(f):
+            lines = i_filter.lines(chunk) if i_filter else chunk.splitlines()
+            for line in lines:
+                if e_filter and e_filter.search(line):
+                    continue
+                m = R_OSD.search(line)
+                if m:
+                    result.add(m.group(0).decode(), result.bucket(line))
+    return result
+
+
+def analyze(filenames, include, exclude, bucket_minutes=10, workers=None):
+    """Counts slow requests in all files using parallel processes."""
+    result = SlowRequests(bucket_minutes)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(read, f, include, exclude, bucket_minutes)
+            for f in filenames
+        ]
+        for future in futures:
+            result.update(future.result())
+    return result
 
 
 class LogTasks(object):
-    def slowreq_histogram(self, include, exclude, first_n, filenames):
-        incidents = collections.defaultdict(int)
-        for f in filenames:
-            osds = read(f, include, exclude)
-            for o in osds:
-                incidents[o] += 1
-        hist = [(i, o) for o, i in incidents.items()]
+    def slowreq_histogram(
+        self,
+        include,
+        exclude,
+        first_n,
+        filenames,
+        bucket_minutes=10,
+        buckets=False,
+        json_output=False,
+        workers=None,
+    ):
+        result = analyze(
+            filenames, include, exclude, bucket_minutes, workers or None
+        )
+        if json_output:
+            print(json.dumps(result.as_dict(), indent=2))
+            return
+        hist = [(i, o) for o, i in result.osds.items()]
         max_incidents = max([x[0] for x in hist], default=0)
         n = 1
         for i, osd in sorted(hist, reverse=True):
@@ -51,3 +216,14 @@ class LogTasks(object):
             if n >= first_n:
                 break
             n += 1
+        if not buckets:
+            return
+        print()
+        max_incidents = max(result.buckets.values(), default=0)
+        for bucket, i in sorted(result.buckets.items()):
+            hist_bar = "*" * int(35 * i / max_incidents)
+            worst = ", ".join(
+                f"{osd} ({count})"
+                for osd, count in result.osd_buckets[bucket].most_common(3)
+            )
+            print(f"{bucket:>16} - {i:>7} - {hist_bar:<35} {worst}")
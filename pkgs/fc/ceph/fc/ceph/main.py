@@ -42,7 +42,12 @@ def main(args=sys.argv[1:]):
     parser_activate = osd_sub.add_parser(
         "create", help="Create activate an OSD."
     )
-    parser_activate.add_argument("device", help="Blockdevice to use")
+    parser_activate.add_argument(
+        "devices",
+        metavar="device",
+        nargs="+",
+        help="Blockdevice(s) to use, one OSD per device",
+    )
     parser_activate.add_argument(
         "--journal",
         default="external",
@@ -57,6 +62,12 @@ def main(args=sys.argv[1:]):
     parser_activate.add_argument(
         "--crush-location", default=f"host={hostname}"
     )
+    parser_activate.add_argument(
+        "--parallel",
+        type=int,
+        default=4,
+        help="work on up to N OSDs at the same time (default: %(default)s)",
+    )
     parser_activate.set_defaults(action="create")
 
     parser_activate = osd_sub.add_parser(
@@ -66,6 +77,12 @@ def main(args=sys.argv[1:]):
         "ids",
         help="IDs of OSD to activate. Use `all` to activate all local OSDs.",
     )
+    parser_activate.add_argument(
+        "--parallel",
+        type=int,
+        default=4,
+        help="work on up to N OSDs at the same time (default: %(default)s)",
+    )
     parser_activate.set_defaults(action="activate")
 
     parser_deactivate = osd_sub.add_parser(
@@ -86,6 +103,13 @@ def main(args=sys.argv[1:]):
         help="IDs of OSDs to reactivate (activate and deactivate). "
         "Use `all` to reactivate all local OSDs.",
     )
+    parser_reactivate.add_argument(
+        "--stats",
+        metavar="PATH",
+        default="/var/log/ceph/fc-ceph-restart.log",
+        help="append per-OSD restart durations as JSON lines to PATH "
+        "(default: %(default)s)",
+    )
     parser_reactivate.set_defaults(action="reactivate")
 
     parser_rebuild = osd_sub.add_parser(
@@ -100,6 +124,12 @@ def main(args=sys.argv[1:]):
         "ids",
         help="IDs of OSD to migrate. Use `all` to rebuild all local OSDs.",
     )
+    parser_rebuild.add_argument(
+        "--parallel",
+        type=int,
+        default=4,
+        help="work on up to N OSDs at the same time (default: %(default)s)",
+    )
     parser_rebuild.set_defaults(action="rebuild")
 
     parser_prepare_journal = osd_sub.add_parser(
@@ -194,7 +224,7 @@ def main(args=sys.argv[1:]):
         "slowreq-histogram",
         help="""Slow requests histogram tool.
 
-Reads a ceph.log file and filters by lines matching a given RE (default:
+Reads ceph.log files and filters by lines matching a given RE (default:
 slow request). For all filtered lines that contain an OSD identifier,
 the OSD identifier is counted. Prints a top-N list of OSDs having slow
 requests. Useful for identifying slacky OSDs.""",
@@ -212,7 +242,33 @@ requests. Useful for identifying slacky OSDs.""",
         help='exclude lines included by -i (default: "%(default)s")',
     )
     slowreq_histogram.add_argument(
-        "-n", "--first-n", help="output N worst OSDs", default=20
+        "-n", "--first-n", help="output N worst OSDs", type=int, default=20
+    )
+    slowreq_histogram.add_argument(
+        "-b",
+        "--buckets",
+        action="store_true",
+        help="also output slow requests per time bucket",
+    )
+    slowreq_histogram.add_argument(
+        "--bucket-minutes",
+        type=int,
+        default=10,
+        help="size of time buckets in minutes (default: %(default)s)",
+    )
+    slowreq_histogram.add_argument(
+        "--json",
+        dest="json_output",
+        action="store_true",
+        help="output counts per OSD, time bucket and OSD per time bucket "
+        "as JSON",
+    )
+    slowreq_histogram.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="number of worker processes (default: number of CPUs)",
     )
     slowreq_histogram.add_argument(
         "filenames",
@@ -233,16 +289,65 @@ requests. Useful for identifying slacky OSDs.""",
     parser_load_vm_images = maint_sub.add_parser(
         "load-vm-images", help="Load VM images from Hydra into cluster."
     )
+    parser_load_vm_images.add_argument(
+        "--latency-target",
+        type=int,
+        default=50,
+        help="throttle writes to keep OSD commit/apply latency below "
+        "this many milliseconds (default: %(default)s)",
+    )
+    parser_load_vm_images.add_argument(
+        "--throttle-stats",
+        metavar="PATH",
+        default="/var/log/ceph/fc-ceph-throttle.log",
+        help="append throttle adjustments as JSON lines to PATH "
+        "(default: %(default)s)",
+    )
+    parser_load_vm_images.add_argument(
+        "--flatten-concurrency",
+        type=int,
+        default=4,
+        help="flatten up to N child images at the same time "
+        "(default: %(default)s)",
+    )
+    parser_load_vm_images.add_argument(
+        "--parallel-downloads",
+        type=int,
+        default=2,
+        help="download up to N branch images at the same time "
+        "(default: %(default)s)",
+    )
+    parser_load_vm_images.add_argument(
+        "--parallel-writers",
+        type=int,
+        default=2,
+        help="write or flatten up to N branches at the same time "
+        "(default: %(default)s)",
+    )
     parser_load_vm_images.set_defaults(action="load_vm_images")
 
     parser_purge_old_snapshots = maint_sub.add_parser(
         "purge-old-snapshots", help="Purge outdated snapshots."
     )
+    parser_purge_old_snapshots.add_argument(
+        "--parallel",
+        type=int,
+        default=4,
+        help="remove up to N images of a pool at the same time "
+        "(default: %(default)s)",
+    )
     parser_purge_old_snapshots.set_defaults(action="purge_old_snapshots")
 
     parser_clean_deleted_vms = maint_sub.add_parser(
         "clean-deleted-vms", help="Remove disks from deleted VMs."
     )
+    parser_clean_deleted_vms.add_argument(
+        "--parallel",
+        type=int,
+        default=4,
+        help="remove up to N images of a pool at the same time "
+        "(default: %(default)s)",
+    )
     parser_clean_deleted_vms.set_defaults(action="clean_deleted_vms")
 
     parser_enter = maint_sub.add_parser(
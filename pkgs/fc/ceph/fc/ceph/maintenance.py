@@ -7,6 +7,7 @@ import sys
 import fc.ceph.images
 import fc.util.directory
 from fc.ceph.api import Cluster, Pools
+from fc.ceph.api.pools import DeletionPlan
 
 
 class ResourcegroupPoolEquivalence(object):
@@ -30,66 +31,54 @@ class ResourcegroupPoolEquivalence(object):
 
 
 class VolumeDeletions(object):
-    def __init__(self, directory, cluster):
+    def __init__(self, directory, cluster, parallel=4):
         self.directory = directory
         self.pools = Pools(cluster)
+        self.parallel = parallel
 
     def ensure(self):
+        plan = DeletionPlan(self.parallel)
         deletions = self.directory.deletions("vm")
         for name, node in list(deletions.items()):
             print(name, node)
             if "hard" not in node["stages"]:
                 continue
-            for pool in self.pools:
-                try:
-                    images = list(pool.images)
-                except KeyError:
-                    # The pool doesn't exist. Ignore. Nothing to delete anyway.
-                    continue
-
-                for image in ["{}.root", "{}.swap", "{}.tmp"]:
-                    image = image.format(name)
-                    base_image = None
-                    for rbd_image in images:
-                        if rbd_image.image != image:
-                            continue
-                        if not rbd_image.snapshot:
-                            base_image = rbd_image
-                            continue
-                        # This is a snapshot of the volume itself.
-                        print(
-                            "Purging snapshot {}/{}@{}".format(
-                                pool.name, image, rbd_image.snapshot
-                            )
-                        )
-                        pool.snap_rm(rbd_image)
-                    if base_image is None:
-                        continue
-                    print("Purging volume {}/{}".format(pool.name, image))
-                    pool.image_rm(base_image)
+            for image in ["{}.root", "{}.swap", "{}.tmp"]:
+                image = image.format(name)
+                for pool, rbd_images in self.pools.index.lookup(image):
+                    for rbd_image in rbd_images:
+                        plan.scanned += 1
+                        plan.add(pool, rbd_image)
+        plan.execute()
+        plan.report()
+        return plan
 
 
 class MaintenanceTasks(object):
-    def load_vm_images(self):
-        fc.ceph.images.load_vm_images()
+    def load_vm_images(self, **kw):
+        fc.ceph.images.load_vm_images(**kw)
 
-    def purge_old_snapshots(self):
+    def purge_old_snapshots(self, parallel=4):
         pools = Pools(Cluster())
-        for pool in pools:
-            for image in pool.images:
-                if image.is_outdated_snapshot:
-                    print(
-                        "removing snapshot {}/{}".format(pool.name, image.name)
-                    )
-                    pool.snap_rm(image)
-
-    def clean_deleted_vms(self):
+        plan = DeletionPlan(parallel)
+        for pool, snapshot in pools.index.snapshots():
+            plan.scanned += 1
+            if snapshot.is_outdated_snapshot:
+                plan.add(pool, snapshot)
+        plan.execute()
+        plan.report()
+        if plan.failed:
+            sys.exit(1)
+
+    def clean_deleted_vms(self, parallel=4):
         ceph = Cluster()
         directory = fc.util.directory.connect()
-        volumes = VolumeDeletions(directory, ceph)
-        volumes.ensure()
+        volumes = VolumeDeletions(directory, ceph, parallel)
+        plan = volumes.ensure()
         rpe = ResourcegroupPoolEquivalence(directory, ceph)
         rpe.ensure()
+        if plan.failed:
+            sys.exit(1)
 
     def _ensure_maintenance_volume(self):
         subprocess.run(
@@ -11,17 +11,81 @@ import sys
 import tempfile
 import threading
 import time
-from subprocess import PIPE, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE, STDOUT, CalledProcessError
 from subprocess import run as run_orig
 
+from fc.ceph.api import Cluster
+
+_cluster = None
+
+JOURNAL_VG_LOCK = threading.Lock()
+
+# Per-thread output prefix, see `run_parallel()`.
+_output = threading.local()
+
+
+class PrefixedOutput(object):
+    """Wraps a stream and prefixes each line with the thread's prefix."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        prefix = getattr(_output, "prefix", "")
+        if not prefix:
+            return self.stream.write(data)
+        *lines, _output.partial = (
+            getattr(_output, "partial", "") + data
+        ).split("\n")
+        with self.lock:
+            for line in lines:
+                self.stream.write(f"{prefix}{line}\n")
+        return len(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
 
 def run(*args, **kw):
     print(args, kw, flush=True)
-    return run_orig(*args, **kw)
+    if not getattr(_output, "prefix", "") or "stdout" in kw:
+        return run_orig(*args, **kw)
+    # Pass the output through our prefixing stdout.
+    check = kw.pop("check", False)
+    result = run_orig(*args, stdout=PIPE, stderr=STDOUT, **kw)
+    print(result.stdout.decode("utf-8", "replace"), end="", flush=True)
+    if check:
+        result.check_returncode()
+    return result
+
+
+def cluster():
+    global _cluster
+    if _cluster is None:
+        _cluster = Cluster(ceph_id="admin")
+    return _cluster
+
+
+def ceph(*args, check=False):
+    """Runs a ceph command, preferably without forking the CLI."""
+    print((["ceph"] + list(args),), flush=True)
+    stdout, stderr, returncode = cluster().ceph(
+        list(args), accept_failure=True
+    )
+    if check and returncode:
+        raise CalledProcessError(
+            returncode, ["ceph"] + list(args), stdout, stderr
+        )
+    return stdout
 
 
 def run_ceph(*args):
-    return run_json(["ceph", "-f", "json"] + list(args))
+    return json.loads(ceph(*args, check=True))
 
 
 def run_json(*args, **kw):
@@ -54,6 +118,39 @@ def lvs():
     return run_json(["lvs", "--reportformat", "json"])["report"][0]["lv"]
 
 
+class LVMSnapshot(object):
+    """LVM and block device state, queried once and shared by many OSDs.
+
+    Lookups that miss the snapshot (e.g. for volumes created after it
+    was taken) return None and callers fall back to querying directly.
+    """
+
+    def __init__(self):
+        self.lvs = query_lvm("lvs", "-o", "lv_name,vg_name")
+        self.pvs = query_lvm("pvs", "--all", "-o", "pv_name,vg_name")
+        self.blockdevices = {
+            device["name"]: device
+            for device in run_json(
+                ["lsblk", "-J", "-l", "-o", "name,pkname,mountpoint"]
+            )["blockdevices"]
+        }
+
+    def lv_vg(self, lv_name):
+        for lv in self.lvs:
+            if lv["LV"] == lv_name:
+                return lv["VG"]
+        return None
+
+    def vg_lvs(self, vg_name):
+        return [lv for lv in self.lvs if lv["VG"] == vg_name]
+
+    def vg_pvs(self, vg_name):
+        return [pv for pv in self.pvs if pv["VG"] == vg_name]
+
+    def blockdevice(self, name):
+        return self.blockdevices.get(name)
+
+
 def find_vg_for_mon():
     vgsys = False
     for vg in vgs():
@@ -121,6 +218,207 @@ def wait_for_clean_cluster():
         time.sleep(5)
 
 
+class PGStatWatcher(object):
+    """Follows PG states via `pg stat` over the shared mon connection.
+
+    Polling the monitors over an established connection is cheap, so we
+    look often and react as soon as the states change.
+    """
+
+    # PG state flags that don't matter when waiting for recovery.
+    IGNORE = {"scrubbing", "deep", "snaptrim", "snaptrim_wait"}
+    INACTIVE = {"stale", "peering", "down", "incomplete"}
+
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.states = {}
+
+    def poll(self):
+        out, _ = cluster().ceph(["pg", "stat"], ignore_dry_run=True)
+        data = json.loads(out)
+        data = data.get("pg_summary", data)
+        self.states = {
+            s["name"]: s["num"] for s in data.get("num_pg_by_state", [])
+        }
+        return self.states
+
+    def _count(self, predicate):
+        return sum(
+            num
+            for name, num in self.states.items()
+            if predicate(set(name.split("+")))
+        )
+
+    @property
+    def inactive(self):
+        """Number of PGs that can't serve I/O."""
+        return self._count(
+            lambda state: "active" not in state or state & self.INACTIVE
+        )
+
+    @property
+    def unclean(self):
+        """Number of PGs that are degraded, recovering, ... ."""
+        return self._count(
+            lambda state: state - self.IGNORE != {"active", "clean"}
+        )
+
+    def osds_up(self, ids):
+        out, _ = cluster().ceph(["osd", "dump"], ignore_dry_run=True)
+        up = {osd["osd"]: osd["up"] for osd in json.loads(out)["osds"]}
+        return all(up.get(id_) for id_ in ids)
+
+    def wait(self, condition, since, timeout):
+        """Waits until `condition(self)` holds.
+
+        Returns the seconds passed since `since`.
+        """
+        summary = None
+        while True:
+            self.poll()
+            if condition(self):
+                return time.time() - since
+            if self.states != summary:
+                summary = self.states
+                print(
+                    ", ".join(
+                        f"{num} {name}"
+                        for name, num in sorted(summary.items())
+                    ),
+                    flush=True,
+                )
+            if time.time() - since > timeout:
+                raise TimeoutError(f"Cluster did not settle within {timeout}s")
+            time.sleep(self.interval)
+
+
+def restart_batches(ids, crush):
+    """Groups OSDs into batches that may be restarted at the same time.
+
+    OSDs below the same bucket of the smallest failure domain used by
+    any CRUSH rule never hold more than one copy of a PG. With rules
+    distributing over OSDs directly, each OSD forms its own batch.
+    """
+    type_ids = {t["name"]: t["type_id"] for t in crush["types"]}
+    domains = [
+        step["type"]
+        for rule in crush["rules"]
+        for step in rule["steps"]
+        if step["op"].startswith("choose")
+    ]
+    if not domains:
+        return [[id_] for id_ in ids]
+    domain = min(domains, key=lambda t: type_ids.get(t, 0))
+    if not type_ids.get(domain, 0):
+        return [[id_] for id_ in ids]
+
+    buckets = {}
+    parents = {}
+    for bucket in crush["buckets"]:
+        if "~" in bucket["name"]:
+            # Shadow buckets for device classes.
+            continue
+        buckets[bucket["id"]] = bucket
+        for item in bucket["items"]:
+            parents[item["id"]] = bucket["id"]
+
+    batches = {}
+    for id_ in ids:
+        key = ("osd", id_)
+        node = id_
+        while node in parents:
+            node = parents[node]
+            if buckets[node]["type_name"] == domain:
+                key = node
+                break
+        batches.setdefault(key, []).append(id_)
+    return list(batches.values())
+
+
+class RollingRestart(object):
+    """Restarts OSDs batch by batch with `noout` set.
+
+    After each batch we wait until all PGs are active again (peering)
+    and until no more PGs are unclean than before the restart
+    (recovery). Durations are recorded per OSD as JSON lines in `stats`.
+    """
+
+    PEERING_TIMEOUT = 15 * 60
+    RECOVERY_TIMEOUT = 60 * 60
+
+    def __init__(self, ids, stats=None, watcher=None):
+        self.ids = ids
+        self.stats = stats
+        self.watcher = watcher or PGStatWatcher()
+
+    def run(self):
+        batches = restart_batches(self.ids, run_ceph("osd", "crush", "dump"))
+        print(f"Restarting OSDs in batches: {batches}")
+        flags = run_ceph("osd", "dump")["flags"].split(",")
+        if "noout" not in flags:
+            ceph("osd", "set", "noout", check=True)
+        try:
+            for batch in batches:
+                self.restart(batch)
+        finally:
+            if "noout" not in flags:
+                ceph("osd", "unset", "noout", check=True)
+
+    def restart(self, batch):
+        self.watcher.poll()
+        unclean = self.watcher.unclean
+        started = time.time()
+        records = {id_: {"osd": id_, "batch": batch} for id_ in batch}
+
+        def restart_osd(id_):
+            record = records[id_]
+            try:
+                osd = OSD(id_)
+                osd.deactivate(flush=False)
+                record["stop"] = time.time() - started
+                osd.activate()
+                record["start"] = time.time() - started
+            except Exception as e:
+                print(e)
+                record["error"] = str(e)
+
+        threads = [
+            threading.Thread(target=restart_osd, args=(id_,)) for id_ in batch
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        running = [id_ for id_ in batch if "error" not in records[id_]]
+        peering = recovery = None
+        try:
+            peering = self.watcher.wait(
+                lambda w: w.osds_up(running) and not w.inactive,
+                started,
+                self.PEERING_TIMEOUT,
+            )
+            print(f"Batch {batch}: PGs active after {peering:.1f}s")
+            recovery = self.watcher.wait(
+                lambda w: w.unclean <= unclean,
+                started,
+                self.RECOVERY_TIMEOUT,
+            )
+            print(f"Batch {batch}: PGs recovered after {recovery:.1f}s")
+        finally:
+            for record in records.values():
+                record["time"] = started
+                record["peering"] = peering
+                record["recovery"] = recovery
+                self.record(record)
+
+    def record(self, record):
+        if not self.stats:
+            return
+        with open(self.stats, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
 def find_mountpoint(path):
     for line in open("/etc/fstab", encoding="ascii").readlines():
         line = line.strip()
@@ -152,6 +450,57 @@ def kill(pid_file):
     print()
 
 
+def run_parallel(function, items, max_workers, name=str):
+    """Calls `function(item)` for all items in a bounded worker pool.
+
+    Output is prefixed with the item's name. Errors are printed and do
+    not stop the other items. Ends with a timing summary.
+    """
+    results = {}
+
+    def task(item):
+        _output.prefix = f"[{name(item)}] "
+        started = time.time()
+        status = "ok"
+        try:
+            function(item)
+        except Exception as e:
+            print(e)
+            status = "failed"
+        finally:
+            if getattr(_output, "partial", ""):
+                print()
+            _output.prefix = ""
+        results[item] = (status, time.time() - started)
+
+    stdout = sys.stdout
+    sys.stdout = PrefixedOutput(stdout)
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            list(executor.map(task, items))
+    finally:
+        sys.stdout = stdout
+    print("Timings:")
+    for item in items:
+        status, duration = results[item]
+        print(f"\t{name(item):<25} {status:<6} {duration:8.1f}s")
+    return results
+
+
+def create_osd(device, journal, journal_size, crush_location):
+    assert "=" in crush_location
+    assert journal in ["internal", "external"]
+    assert os.path.exists(device)
+
+    print("Creating OSD ...")
+
+    id_ = int(run_ceph("osd", "create")["osdid"])
+    print(f"OSDID={id_}")
+
+    osd = OSD(id_)
+    osd.create(device, journal, journal_size, crush_location)
+
+
 class OSDManager(object):
     def __init__(self):
         self.local_osd_ids = self._list_local_osd_ids()
@@ -185,29 +534,29 @@ class OSDManager(object):
                 )
         return ids
 
-    def create(self, device, journal, journal_size, crush_location):
-        assert "=" in crush_location
-        assert journal in ["internal", "external"]
-        assert os.path.exists(device)
-
-        print("Creating OSD ...")
-
-        id_ = int(run_ceph("osd", "create")["osdid"])
-        print(f"OSDID={id_}")
-
-        osd = OSD(id_)
-        osd.create(device, journal, journal_size, crush_location)
+    def create(
+        self, devices, journal, journal_size, crush_location, parallel=4
+    ):
+        results = run_parallel(
+            lambda device: create_osd(
+                device, journal, journal_size, crush_location
+            ),
+            devices,
+            parallel,
+        )
+        if any(status != "ok" for status, _ in results.values()):
+            sys.exit(1)
 
-    def activate(self, ids):
+    def activate(self, ids, parallel=4):
         ids = self._parse_ids(ids)
         run(["systemctl", "start", "fc-blockdev"])
-
-        for id_ in ids:
-            try:
-                osd = OSD(id_)
-                osd.activate()
-            except Exception as e:
-                print(e)
+        snapshot = LVMSnapshot()
+        run_parallel(
+            lambda id_: OSD(id_, snapshot).activate(),
+            ids,
+            parallel,
+            name=lambda id_: f"osd.{id_}",
+        )
 
     def destroy(self, ids):
         ids = self._parse_ids(ids, allow_non_local=f"DESTROY {ids}")
@@ -235,27 +584,20 @@ class OSDManager(object):
         for thread in threads:
             thread.join()
 
-    def reactivate(self, ids):
+    def reactivate(self, ids, stats=None):
         ids = self._parse_ids(ids)
+        wait_for_clean_cluster()
+        RollingRestart(ids, stats).run()
 
-        for id_ in ids:
-            wait_for_clean_cluster()
-            try:
-                osd = OSD(id_)
-                osd.deactivate(flush=False)
-                osd.activate()
-            except Exception as e:
-                print(e)
-
-    def rebuild(self, ids, journal_size):
+    def rebuild(self, ids, journal_size, parallel=4):
         ids = self._parse_ids(ids)
-
-        for id_ in ids:
-            try:
-                osd = OSD(id_)
-                osd.rebuild(journal_size)
-            except Exception as e:
-                print(e)
+        snapshot = LVMSnapshot()
+        run_parallel(
+            lambda id_: OSD(id_, snapshot).rebuild(journal_size),
+            ids,
+            parallel,
+            name=lambda id_: f"osd.{id_}",
+        )
 
     def prepare_journal(self, device):
         if not os.path.exists(device):
@@ -317,8 +659,9 @@ class OSD(object):
     MKFS_XFS_OPTS = ["-m", "crc=1,finobt=1", "-i", "size=2048", "-K"]
     MOUNT_XFS_OPTS = "nodev,nosuid,noatime,nodiratime,logbsize=256k"
 
-    def __init__(self, id):
+    def __init__(self, id, snapshot=None):
         self.id = id
+        self.snapshot = snapshot
 
         self.MAPPED_NAME = f"vgosd--{self.id}-ceph--osd--{self.id}"
         self.MOUNTPOINT = f"/srv/ceph/osd/ceph-{self.id}"
@@ -335,6 +678,10 @@ class OSD(object):
         self.name = f"osd.{id}"
 
     def _locate_journal_lv(self):
+        if self.snapshot:
+            lvm_journal_vg = self.snapshot.lv_vg(self.lvm_journal)
+            if lvm_journal_vg:
+                return f"/dev/{lvm_journal_vg}/{self.lvm_journal}"
         try:
             lvm_journal_vg = query_lvm(
                 "lvs",
@@ -351,6 +698,9 @@ class OSD(object):
             )
 
     def is_mounted(self):
+        device = self.snapshot and self.snapshot.blockdevice(self.MAPPED_NAME)
+        if device:
+            return self._check_mountpoint(device["mountpoint"] or "")
         result = run(
             ["lsblk", "-o", "name,mountpoint", "-r"], stdout=PIPE, check=True
         )
@@ -362,19 +712,20 @@ class OSD(object):
             result = dict(zip(keys, line.strip().split(" ")))
             result.setdefault("mountpoint", "")
             if result["name"] == self.MAPPED_NAME:
-                if result["mountpoint"] == self.MOUNTPOINT:
-                    return True
-                elif not result["mountpoint"]:
-                    return False
-                else:
-                    raise RuntimeError(
-                        f"OSD {self.id} mounted at unexpected mountpoint "
-                        f'{result["mountpoint"]}'
-                    )
+                return self._check_mountpoint(result["mountpoint"])
         raise RuntimeError(
             f"Mapped volume {self.MAPPED_NAME} not found for OSD {self.id}"
         )
 
+    def _check_mountpoint(self, mountpoint):
+        if mountpoint == self.MOUNTPOINT:
+            return True
+        elif not mountpoint:
+            return False
+        raise RuntimeError(
+            f"OSD {self.id} mounted at unexpected mountpoint {mountpoint}"
+        )
+
     def activate(self):
         # Relocating OSDs: create journal if missing?
         print(f"Activating OSD {self.id}...")
@@ -460,28 +811,31 @@ class OSD(object):
 
         # External journal
         if journal == "external":
-            # - Find suitable journal VG: the one with the most free bytes
-            lvm_journal_vg = query_lvm(
-                "vgs",
-                "-S",
-                "vg_name=~^vgjnl[0-9][0-9]$",
-                "-o",
-                "vg_name,vg_free",
-                "-O",
-                "-vg_free",
-            )[0]["VG"]
-            print(f"Creating external journal on {lvm_journal_vg} ...")
-            run(
-                [
-                    "lvcreate",
-                    "-W",
-                    "y",
-                    f"-L{journal_size}",
-                    f"-n{self.lvm_journal}",
-                    lvm_journal_vg,
-                ],
-                check=True,
-            )
+            # Parallel creations must not pick the same VG based on the
+            # same free space.
+            with JOURNAL_VG_LOCK:
+                # - Find suitable journal VG: the one with the most free bytes
+                lvm_journal_vg = query_lvm(
+                    "vgs",
+                    "-S",
+                    "vg_name=~^vgjnl[0-9][0-9]$",
+                    "-o",
+                    "vg_name,vg_free",
+                    "-O",
+                    "-vg_free",
+                )[0]["VG"]
+                print(f"Creating external journal on {lvm_journal_vg} ...")
+                run(
+                    [
+                        "lvcreate",
+                        "-W",
+                        "y",
+                        f"-L{journal_size}",
+                        f"-n{self.lvm_journal}",
+                        lvm_journal_vg,
+                    ],
+                    check=True,
+                )
             lvm_journal_path = f"/dev/{lvm_journal_vg}/{self.lvm_journal}"
         elif journal == "internal":
             print(f"Creating internal journal on {self.lvm_vg} ...")
@@ -572,16 +926,13 @@ class OSD(object):
             check=True,
         )
 
-        run(
-            [
-                "ceph",
-                "osd",
-                "crush",
-                "add",
-                self.name,
-                str(weight),
-                crush_location,
-            ],
+        ceph(
+            "osd",
+            "crush",
+            "add",
+            self.name,
+            str(weight),
+            crush_location,
             check=True,
         )
 
@@ -591,30 +942,30 @@ class OSD(object):
         print(f"Rebuilding OSD {self.id} from scratch")
 
         # What's the physical disk?
-        pvs = query_lvm("pvs", "-S", f"vg_name={self.lvm_vg}", "--all")
+        if self.snapshot:
+            pvs = self.snapshot.vg_pvs(self.lvm_vg)
+        else:
+            pvs = query_lvm("pvs", "-S", f"vg_name={self.lvm_vg}", "--all")
         if not len(pvs) == 1:
             raise ValueError(
                 f"Unexpected number of PVs in OSD's RG: {len(pvs)}"
             )
         pv = pvs[0]["PV"]
         # Find the parent
-        candidates = run(
-            ["lsblk", pv, "-o", "name,pkname", "-r"], stdout=PIPE, check=True
-        )
-        candidates = candidates.stdout.decode("ascii").splitlines()
-        candidates.pop(0)
-
-        for line in candidates:
-            name, pkname = line.split()
-            if name == pv.split("/")[-1]:
-                device = f"/dev/{pkname}"
-                break
-        else:
-            raise ValueError(f"Could not find parent for PV: {pv}")
+        device = None
+        if self.snapshot:
+            blockdevice = self.snapshot.blockdevice(pv.split("/")[-1])
+            if blockdevice and blockdevice["pkname"]:
+                device = f"/dev/{blockdevice['pkname']}"
+        if not device:
+            device = self._find_parent_device(pv)
         print(f"device={device}")
 
         # Is the journal internal or external?
-        lvs = query_lvm("lvs", "-S", f"vg_name={self.lvm_vg}")
+        if self.snapshot:
+            lvs = self.snapshot.vg_lvs(self.lvm_vg)
+        else:
+            lvs = query_lvm("lvs", "-S", f"vg_name={self.lvm_vg}")
         if len(lvs) == 1:
             journal = "external"
         elif len(lvs) == 2:
@@ -641,9 +992,20 @@ class OSD(object):
             f"--crush-location={crush_location}"
         )
 
-        # This is an "interesting" turn-around ...
-        manager = OSDManager()
-        manager.create(device, journal, journal_size, crush_location)
+        create_osd(device, journal, journal_size, crush_location)
+
+    def _find_parent_device(self, pv):
+        candidates = run(
+            ["lsblk", pv, "-o", "name,pkname", "-r"], stdout=PIPE, check=True
+        )
+        candidates = candidates.stdout.decode("ascii").splitlines()
+        candidates.pop(0)
+
+        for line in candidates:
+            name, pkname = line.split()
+            if name == pv.split("/")[-1]:
+                return f"/dev/{pkname}"
+        raise ValueError(f"Could not find parent for PV: {pv}")
 
     def destroy(self):
         print(f"Destroying OSD {self.id} ...")
@@ -654,13 +1016,13 @@ class OSD(object):
             print(e)
 
         # Remove from crush map
-        run(["ceph", "osd", "crush", "remove", self.name])
+        ceph("osd", "crush", "remove", self.name)
         # Remove authentication
-        run(["ceph", "auth", "del", self.name])
+        ceph("auth", "del", self.name)
         # Delete OSD object
         while True:
             try:
-                run(["ceph", "osd", "rm", str(self.id)], check=True)
+                ceph("osd", "rm", str(self.id), check=True)
             except CalledProcessError as e:
                 # OSD is still shutting down, keep trying.
                 if e.returncode == errno.EBUSY:
@@ -902,7 +1264,7 @@ class Monitor(object):
         except Exception:
             pass
 
-        run(["ceph", "mon", "remove", self.id])
+        ceph("mon", "remove", self.id)
         run(["umount", self.mon_dir])
 
         if lvm_data_device:
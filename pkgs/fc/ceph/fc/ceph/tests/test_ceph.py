@@ -34,6 +34,34 @@ def cluster(monkeypatch):
     return fc.ceph.api.cluster.Cluster(ceph_id="admin")
 
 
+@pytest.fixture
+def removals(monkeypatch):
+    """Records removals done through the rbd bindings as rbd CLI args."""
+    calls = mock.Mock()
+
+    class Image(object):
+        def __init__(self, ioctx, name):
+            self.spec = "{}/{}".format(ioctx, name)
+
+        def remove_snap(self, snap):
+            calls(["snap", "rm", "{}@{}".format(self.spec, snap)])
+
+        def close(self):
+            pass
+
+    class RBD(object):
+        def remove(self, ioctx, name):
+            calls(["rm", "{}/{}".format(ioctx, name)])
+
+    rbd = fc.ceph.api.pools.rbd
+    monkeypatch.setattr(rbd, "Image", Image, raising=False)
+    monkeypatch.setattr(rbd, "RBD", RBD, raising=False)
+    monkeypatch.setattr(
+        fc.ceph.api.pools.Pool, "ioctx", property(lambda self: self.name)
+    )
+    return calls
+
+
 @pytest.fixture
 def pools(cluster, monkeypatch):
     monkeypatch.setattr(
@@ -52,19 +80,30 @@ def pools(cluster, monkeypatch):
         )
         images["{}.swap".format(name)] = RBDImage("{}.swap".format(name), 100)
         images["{}.tmp".format(name)] = RBDImage("{}.tmp".format(name), 100)
+
+    def images(pool):
+        return images_hdd if pool.name == "rbd.hdd" else images_ssd
+
+    monkeypatch.setattr(
+        fc.ceph.api.pools.Pool,
+        "image_names",
+        lambda self: set(i.image for i in images(self).values()),
+    )
     monkeypatch.setattr(
         fc.ceph.api.pools.Pool,
-        "load",
-        lambda self: images_hdd if self.name == "rbd.hdd" else images_ssd,
+        "_query_image",
+        lambda self, name: [
+            i for i in images(self).values() if i.image == name
+        ],
     )
     return fc.ceph.api.pools.Pools(cluster)
 
 
-def test_node_deletion(fake_directory, cluster, pools):
-    v = fc.ceph.maintenance.VolumeDeletions(fake_directory, cluster)
-    v.ensure()
+def test_node_deletion(fake_directory, cluster, pools, removals):
+    v = fc.ceph.maintenance.VolumeDeletions(fake_directory, cluster, 1)
+    plan = v.ensure()
 
-    assert cluster.rbd.call_args_list == [
+    assert removals.call_args_list == [
         # hard
         mock.call(["snap", "rm", "rbd.hdd/node03.root@snap1"]),
         mock.call(["rm", "rbd.hdd/node03.root"]),
@@ -76,3 +115,53 @@ def test_node_deletion(fake_directory, cluster, pools):
         mock.call(["rm", "rbd.ssd/node04.swap"]),
         mock.call(["rm", "rbd.ssd/node04.tmp"]),
     ]
+    assert (plan.scanned, plan.deleted, plan.failed) == (8, 8, 0)
+    assert not cluster.rbd.called
+
+
+def test_parallel_node_deletion_removes_snapshots_first(
+    fake_directory, cluster, pools, removals
+):
+    v = fc.ceph.maintenance.VolumeDeletions(fake_directory, cluster, 4)
+    v.ensure()
+
+    calls = [c[0][0] for c in removals.call_args_list]
+    assert len(calls) == 8
+    for node, pool in [("node03", "rbd.hdd"), ("node04", "rbd.ssd")]:
+        snap = ["snap", "rm", "{}/{}.root@snap1".format(pool, node)]
+        assert calls.index(snap) < calls.index(
+            ["rm", "{}/{}.root".format(pool, node)]
+        )
+
+
+def test_deletion_updates_listing_in_place(cluster, pools, removals):
+    pool = pools["rbd.hdd"]
+    assert len(pool.images) == 8
+    pool.snap_rm(pool["node01.root@snap1"])
+    pool.image_rm(pool["node01.root"])
+    assert set(i.name for i in pool.images) == set(
+        [
+            "node01.swap",
+            "node01.tmp",
+            "node03.root",
+            "node03.root@snap1",
+            "node03.swap",
+            "node03.tmp",
+        ]
+    )
+
+
+def test_failed_deletion_is_counted(fake_directory, cluster, pools, removals):
+    removals.side_effect = lambda args: 1 / ("node03.swap" not in args[-1])
+    v = fc.ceph.maintenance.VolumeDeletions(fake_directory, cluster)
+    plan = v.ensure()
+    assert (plan.scanned, plan.deleted, plan.failed) == (8, 7, 1)
+
+
+def test_dry_run_removes_nothing(fake_directory, pools, removals):
+    cluster = fc.ceph.api.cluster.Cluster(ceph_id="admin", dry_run=True)
+    pools.cluster = cluster
+    v = fc.ceph.maintenance.VolumeDeletions(fake_directory, cluster)
+    plan = v.ensure()
+    assert not removals.called
+    assert plan.deleted == 8
@@ -0,0 +1,584 @@
+import hashlib
+import json
+import threading
+import time
+
+import fc.ceph.images
+import lz4.frame
+import mock
+import pytest
+from fc.ceph.images import (
+    BLOCKSIZE,
+    RESIZE_STEP,
+    AioWriter,
+    FlattenScheduler,
+    ImageStream,
+    Manifest,
+    Throttle,
+    decompress_lz4,
+    delta_update,
+    rechunk,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_stutter(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda t: None)
+
+
+class FakeImage:
+    """In-memory stand-in for rbd.Image with block granular allocation."""
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.allocated = set()
+        self.reads = []
+        self.discards = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self.flushed = False
+
+    def size(self):
+        return len(self.data)
+
+    def resize(self, size):
+        del self.data[size:]
+        self.data.extend(bytes(size - len(self.data)))
+
+    def read(self, offset, length):
+        self.reads.append(offset // BLOCKSIZE)
+        return bytes(self.data[offset : offset + length])
+
+    def _complete(self, oncomplete):
+        self.inflight += 1
+        self.max_inflight = max(self.inflight, self.max_inflight)
+        completion = mock.Mock()
+        completion.get_return_value.return_value = 0
+
+        def run():
+            time.sleep(0.001)
+            self.inflight -= 1
+            oncomplete(completion)
+
+        threading.Thread(target=run).start()
+
+    def aio_write(self, data, offset, oncomplete):
+        self.data[offset : offset + len(data)] = data
+        self.allocated.add(offset // BLOCKSIZE)
+        self._complete(oncomplete)
+
+    def aio_discard(self, offset, length, oncomplete):
+        self.data[offset : offset + length] = bytes(length)
+        self.allocated.discard(offset // BLOCKSIZE)
+        self.discards.append(offset // BLOCKSIZE)
+        self._complete(oncomplete)
+
+    def diff_iterate(self, offset, length, from_snapshot, iterate_cb):
+        for block in sorted(self.allocated):
+            iterate_cb(block * BLOCKSIZE, BLOCKSIZE, True)
+
+    def flush(self):
+        self.flushed = True
+
+
+@pytest.fixture
+def source():
+    """Image content of 4 blocks, the first one being empty."""
+    return [bytes([i]) * BLOCKSIZE for i in range(4)]
+
+
+def test_verify_mode_copies_image(source):
+    image = FakeImage(4 * BLOCKSIZE)
+    manifest = delta_update(source, image)
+    assert image.data == b"".join(source)
+    assert image.flushed
+    assert len(manifest) == 4
+    assert manifest.digests[1] == Manifest.digest(b"\1" * BLOCKSIZE)
+
+
+def test_verify_mode_reads_allocated_blocks_only(source):
+    image = FakeImage(4 * BLOCKSIZE)
+    delta_update(source, image)
+    source[2] = bytes([42]) * BLOCKSIZE
+    delta_update(source, image)
+    assert image.reads == [1, 2, 3]
+    assert image.data == b"".join(source)
+
+
+def test_zero_blocks_are_discarded(source):
+    image = FakeImage(4 * BLOCKSIZE)
+    image.data[:] = b"\1" * len(image.data)
+    image.allocated.update(range(4))
+    delta_update(source, image)
+    assert image.discards == [0]
+    assert image.data == b"".join(source)
+
+
+def test_manifest_mode_writes_changed_blocks_only(source):
+    image = FakeImage(4 * BLOCKSIZE)
+    manifest = delta_update(source, image)
+    source[2] = bytes([42]) * BLOCKSIZE
+    # Blocks unchanged according to the manifest must not be touched even
+    # if the destination differs.
+    image.data[BLOCKSIZE] = 23
+    new_manifest = delta_update(source, image, manifest)
+    assert image.reads == []
+    assert [image.data[i * BLOCKSIZE] for i in range(4)] == [0, 23, 42, 3]
+    assert new_manifest.digests[2] == Manifest.digest(bytes([42]) * BLOCKSIZE)
+
+
+def test_manifest_mode_writes_blocks_beyond_manifest(source):
+    image = FakeImage(4 * BLOCKSIZE)
+    manifest = delta_update(source, image)
+    manifest.digests = manifest.digests[:2]
+    image.resize(2 * BLOCKSIZE)
+    delta_update(source, image, manifest)
+    assert image.data[: 4 * BLOCKSIZE] == b"".join(source)
+
+
+def test_delta_update_grows_image(source):
+    image = FakeImage(BLOCKSIZE)
+    delta_update(source, image)
+    assert image.size() == RESIZE_STEP
+
+
+def test_delta_update_bounds_inflight_requests(source):
+    image = FakeImage(4 * BLOCKSIZE)
+    delta_update(source * 4, image, max_inflight=2)
+    assert image.max_inflight <= 2
+
+
+class SlowImage(FakeImage):
+    """Completes requests after a delay, optionally with an error."""
+
+    ret = 0
+
+    def _complete(self, oncomplete):
+        self.inflight += 1
+        completion = mock.Mock()
+        completion.get_return_value.return_value = self.ret
+
+        def run():
+            threading.Event().wait(0.05)
+            self.inflight -= 1
+            oncomplete(completion)
+
+        threading.Thread(target=run).start()
+
+
+def test_delta_update_drains_requests_on_source_error(source):
+    def blocks():
+        yield from source
+        raise IOError("source stream broken")
+
+    image = SlowImage(4 * BLOCKSIZE)
+    with pytest.raises(IOError):
+        delta_update(blocks(), image)
+    assert image.inflight == 0
+    assert not image.flushed
+
+
+def test_delta_update_raises_aio_errors(source):
+    image = SlowImage(4 * BLOCKSIZE)
+    image.ret = -5
+    with pytest.raises(RuntimeError):
+        delta_update(source * 4, image, max_inflight=2)
+    assert image.inflight == 0
+
+
+def test_aio_writer_keeps_slots_on_errors():
+    image = FakeImage(BLOCKSIZE)
+    writer = AioWriter(image, max_inflight=2)
+    writer.errors.append(-5)
+    with pytest.raises(RuntimeError):
+        writer.write(b"a", 0)
+    writer.errors.clear()
+    image.aio_discard = mock.Mock(side_effect=ValueError)
+    with pytest.raises(ValueError):
+        writer.discard(0, 1)
+    # All slots are available again.
+    for _ in range(2):
+        assert writer.slots.acquire(timeout=1)
+
+
+def test_manifest_roundtrip():
+    manifest = Manifest(
+        digests=[Manifest.digest(b"a"), Manifest.digest(b"\n")]
+    )
+    assert Manifest.loads(manifest.dumps()).digests == manifest.digests
+
+
+def test_manifest_detects_corruption():
+    data = bytearray(Manifest(digests=[Manifest.digest(b"a")]).dumps())
+    data[-1] ^= 0xFF
+    with pytest.raises(ValueError):
+        Manifest.loads(bytes(data))
+
+
+def test_manifest_rejects_garbage():
+    with pytest.raises(ValueError):
+        Manifest.loads(b'{"version": 1}\n')
+
+
+def test_rechunk():
+    assert list(rechunk([b"abc", b"de", b"", b"fghij"], 4)) == [
+        b"abcd",
+        b"efgh",
+        b"ij",
+    ]
+
+
+def test_decompress_lz4_bounds_output_size():
+    data = lz4.frame.compress(b"\0" * (3 * BLOCKSIZE + 1))
+    chunks = [data[i : i + 1000] for i in range(0, len(data), 1000)]
+    output = list(decompress_lz4(chunks))
+    assert max(len(x) for x in output) <= BLOCKSIZE
+    assert b"".join(output) == b"\0" * (3 * BLOCKSIZE + 1)
+
+
+def test_decompress_lz4_concatenated_frames():
+    data = lz4.frame.compress(b"foo") + lz4.frame.compress(b"bar")
+    assert b"".join(decompress_lz4([data])) == b"foobar"
+
+
+def test_decompress_lz4_detects_truncation():
+    data = lz4.frame.compress(b"foo" * 1000)
+    with pytest.raises(RuntimeError):
+        list(decompress_lz4([data[:-10]]))
+
+
+@pytest.fixture
+def hydra(monkeypatch):
+    image = bytes(range(256)) * (BLOCKSIZE // 128 + 3)
+    compressed = lz4.frame.compress(image)
+    buildproduct = {
+        "filesize": len(compressed),
+        "sha256hash": hashlib.sha256(compressed).hexdigest(),
+    }
+    monkeypatch.setattr(
+        fc.ceph.images, "hydra_build_info", lambda build_id: buildproduct
+    )
+    response = mock.Mock()
+    response.iter_content = lambda size: (
+        compressed[i : i + size] for i in range(0, len(compressed), size)
+    )
+    monkeypatch.setattr(
+        fc.ceph.images.requests, "get", lambda url, stream: response
+    )
+    return image, buildproduct
+
+
+def test_image_stream(hydra):
+    image, _ = hydra
+    stream = ImageStream(1234, queue_size=1)
+    result = list(stream)
+    assert [len(x) for x in result] == [BLOCKSIZE, BLOCKSIZE, 768]
+    assert b"".join(result) == image
+    assert stream.size == len(image)
+
+
+def test_image_stream_verifies_checksum(hydra):
+    _, buildproduct = hydra
+    buildproduct["sha256hash"] = "foo"
+    with pytest.raises(RuntimeError):
+        list(ImageStream(1234))
+
+
+def test_image_stream_can_be_aborted(hydra):
+    stream = iter(ImageStream(1234, queue_size=1))
+    next(stream)
+    stream.close()
+
+
+class FakeCluster:
+    def __init__(self):
+        self.latencies = []
+
+    def mon_command(self, cmd, inbuf):
+        assert json.loads(cmd)["prefix"] == "osd perf"
+        infos = [
+            {
+                "id": i,
+                "perf_stats": {"commit_latency_ms": l, "apply_latency_ms": 1},
+            }
+            for i, l in enumerate(self.latencies)
+        ]
+        return 0, json.dumps({"osd_perf_infos": infos}).encode(), ""
+
+
+def test_throttle_uses_slowest_osd():
+    cluster = FakeCluster()
+    cluster.latencies = [3, 70, 12]
+    assert Throttle("test", cluster, 50, 1, 8).osd_latency() == 70
+
+
+def test_throttle_adapts_delay_to_latency(tmpdir):
+    cluster = FakeCluster()
+    stats = str(tmpdir / "stats")
+    throttle = Throttle("test", cluster, 50, 1, 8, stats=stats)
+    delays = []
+    for latencies in [[60], [60], [60], [60], [40], [10], [10], [10], [10]]:
+        cluster.latencies = latencies
+        throttle.adjust()
+        delays.append(throttle.delay)
+    assert delays == [2, 4, 8, 8, 8, 4, 2, 1, 0.5]
+    cluster.latencies = [60]
+    throttle.delay = 0
+    throttle.adjust()
+    assert throttle.delay == 1
+    with open(stats) as f:
+        assert len(f.readlines()) == 10
+
+
+def test_throttle_keeps_delay_if_latency_unknown():
+    cluster = FakeCluster()
+    cluster.mon_command = lambda cmd, inbuf: (-1, b"", "error")
+    throttle = Throttle("test", cluster, 50, 1, 8)
+    throttle.adjust()
+    assert throttle.delay == 1
+
+
+def test_throttle_samples_periodically(monkeypatch):
+    cluster = FakeCluster()
+    throttle = Throttle("test", cluster, 50, 1, 8, interval=60)
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    cluster.latencies = [10]
+    throttle.wait()
+    cluster.latencies = [100]
+    throttle.wait()
+    assert sleeps == [0.5, 0.5]
+
+
+class FakeIoctx:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def stat(self, name):
+        if name not in self.objects:
+            raise fc.ceph.images.rados.ObjectNotFound(name)
+        return len(self.objects[name]), 0
+
+    def read(self, name, length):
+        return self.objects[name][:length]
+
+    def write_full(self, name, data):
+        self.objects[name] = data
+
+    def remove_object(self, name):
+        if name not in self.objects:
+            raise fc.ceph.images.rados.ObjectNotFound(name)
+        del self.objects[name]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def base(monkeypatch):
+    """Base image with two snapshots and three children."""
+    children = {
+        "build-1": [("rbd.ssd", "vm1.root"), ("rbd.hdd", "vm2.root")],
+        "build-2": [("rbd.hdd", "vm3.root")],
+    }
+    sizes = {"vm1.root": 30, "vm2.root": 10, "vm3.root": 20}
+    flattened = []
+
+    class Image:
+        def __init__(self, ioctx, name, snapshot=None, read_only=False):
+            self.name = name
+            self.snapshot = snapshot
+
+        def list_children(self):
+            return children[self.snapshot]
+
+        def size(self):
+            return sizes[self.name] * 2**20
+
+        def flatten(self, on_progress=None):
+            if self.name == "vm3.root":
+                raise RuntimeError()
+            if on_progress:
+                on_progress(1, 1)
+            flattened.append(self.name)
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(fc.ceph.images.rbd, "Image", Image, raising=False)
+    base = mock.Mock()
+    base.release = "fc-test"
+    base.ioctx = FakeIoctx({})
+    base.cluster.open_ioctx = FakeIoctx
+    base.image.list_snaps.return_value = [
+        {"name": "build-1"},
+        {"name": "build-2"},
+    ]
+    base.flattened = flattened
+    return base
+
+
+def test_flatten_scheduler_flattens_smallest_first(base):
+    report = FlattenScheduler(base, concurrency=1).run()
+    assert base.flattened == ["vm2.root", "vm1.root"]
+    assert [(c[1], c[2] // 2**20, ok) for c, _, ok in report] == [
+        ("vm2.root", 10, True),
+        ("vm3.root", 20, False),
+        ("vm1.root", 30, True),
+    ]
+    # The failed child is kept for the next run.
+    assert json.loads(base.ioctx.objects["fc-test.flatten"])["pending"] == [
+        ["rbd.hdd", "vm3.root", 20971520]
+    ]
+
+
+def test_flatten_scheduler_runs_concurrently(base):
+    report = FlattenScheduler(base, concurrency=3).run()
+    assert len(report) == 3
+    assert sorted(base.flattened) == ["vm1.root", "vm2.root"]
+
+
+def test_flatten_scheduler_resumes_persisted_queue(base):
+    base.ioctx.objects["fc-test.flatten"] = json.dumps(
+        {
+            "pending": [
+                ["rbd.ssd", "vm1.root", 31457280],
+                # flattened or deleted in the meantime
+                ["rbd.ssd", "vm9.root", 1048576],
+            ]
+        }
+    ).encode()
+    report = FlattenScheduler(base, concurrency=1).run()
+    # Children created since the queue was saved are not missed.
+    assert base.flattened == ["vm2.root", "vm1.root"]
+    assert [(c[1], ok) for c, _, ok in report] == [
+        ("vm2.root", True),
+        ("vm3.root", False),
+        ("vm1.root", True),
+    ]
+
+
+def test_flatten_scheduler_retries_failed_children(base, monkeypatch):
+    FlattenScheduler(base).run()
+    assert "fc-test.flatten" in base.ioctx.objects
+    base.flattened.clear()
+    image = fc.ceph.images.rbd.Image
+    monkeypatch.setattr(image, "flatten", lambda self: None)
+    report = FlattenScheduler(base).run()
+    assert all(ok for _, _, ok in report)
+    assert base.ioctx.objects == {}
+
+
+def test_flatten_scheduler_does_not_mask_type_errors(base, monkeypatch):
+    calls = []
+
+    def flatten(self, on_progress=None):
+        calls.append(on_progress)
+        raise TypeError("bug")
+
+    monkeypatch.setattr(fc.ceph.images.rbd.Image, "flatten", flatten)
+    report = FlattenScheduler(base, concurrency=1).run()
+    assert not any(ok for _, _, ok in report)
+    # Not retried without progress callback.
+    assert len(calls) == 3
+    assert all(calls)
+
+
+def test_supports_progress():
+    def new(on_progress=None):
+        pass
+
+    def old():
+        pass
+
+    def cython(*args):
+        """flatten(self, on_progress=None)"""
+
+    # Like Cython functions which do not expose a signature.
+    cython.__signature__ = "broken"
+
+    assert fc.ceph.images.supports_progress(new)
+    assert not fc.ceph.images.supports_progress(old)
+    assert fc.ceph.images.supports_progress(cython)
+    assert not fc.ceph.images.supports_progress(max)
+
+
+def test_flatten_scheduler_skips_vanished_children(base, monkeypatch):
+    image = fc.ceph.images.rbd.Image
+    size = image.size
+
+    def vanished(self):
+        if self.name == "vm2.root":
+            raise fc.ceph.images.rbd.ImageNotFound("vm2.root")
+        return size(self)
+
+    monkeypatch.setattr(image, "size", vanished)
+    report = FlattenScheduler(base, concurrency=1).run()
+    assert base.flattened == ["vm1.root"]
+    assert [c[1] for c, _, _ in report] == ["vm3.root", "vm1.root"]
+
+
+def test_flatten_scheduler_persists_remaining_queue(base):
+    scheduler = FlattenScheduler(base)
+    scheduler.pending = scheduler.discover()
+    scheduler.save()
+    assert json.loads(base.ioctx.objects["fc-test.flatten"])["pending"] == [
+        ["rbd.hdd", "vm2.root", 10485760],
+        ["rbd.hdd", "vm3.root", 20971520],
+        ["rbd.ssd", "vm1.root", 31457280],
+    ]
+
+
+class FakeBaseImage:
+    def __init__(self, release, **kw):
+        self.release = release
+
+    def __enter__(self):
+        if self.release == "locked":
+            raise fc.ceph.images.LockingError()
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def update(self):
+        if self.release == "broken":
+            raise RuntimeError()
+
+    def flatten(self):
+        pass
+
+    def purge(self):
+        pass
+
+
+@pytest.fixture
+def fake_base_image(monkeypatch):
+    monkeypatch.setattr(fc.ceph.images, "BaseImage", FakeBaseImage)
+    monkeypatch.setattr(fc.ceph.images.logging, "basicConfig", mock.Mock())
+
+
+def test_load_vm_images_isolates_branch_errors(fake_base_image, monkeypatch):
+    monkeypatch.setattr(
+        fc.ceph.images, "RELEASES", ["a", "broken", "locked", "b"]
+    )
+    updated = []
+    monkeypatch.setattr(
+        FakeBaseImage, "purge", lambda self: updated.append(self.release)
+    )
+    with pytest.raises(SystemExit) as e:
+        fc.ceph.images.load_vm_images()
+    assert e.value.code == 1
+    assert sorted(updated) == ["a", "b"]
+
+
+def test_load_vm_images_reports_locking_errors(fake_base_image, monkeypatch):
+    monkeypatch.setattr(fc.ceph.images, "RELEASES", ["a", "locked"])
+    with pytest.raises(SystemExit) as e:
+        fc.ceph.images.load_vm_images()
+    assert e.value.code == 69
+
+
+def test_load_vm_images_succeeds(fake_base_image, monkeypatch):
+    monkeypatch.setattr(fc.ceph.images, "RELEASES", ["a", "b"])
+    fc.ceph.images.load_vm_images()
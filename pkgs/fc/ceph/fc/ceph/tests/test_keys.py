@@ -0,0 +1,122 @@
+import json
+
+import fc.ceph.api.cluster
+import pytest
+from fc.ceph.keys import ClientKey, InstalledKeys, RGWKey
+
+
+class FakeRados(object):
+    def __init__(self, auth_dump):
+        self.auth_dump = auth_dump
+        self.commands = []
+
+    def mon_command(self, cmd, inbuf):
+        command = json.loads(cmd)
+        self.commands.append((command["prefix"], command, inbuf))
+        if command["prefix"] == "auth list":
+            return 0, json.dumps({"auth_dump": self.auth_dump}).encode(), ""
+        if command["prefix"] == "auth import":
+            return 0, b"", "imported keyring"
+        return 0, b"", "updated"
+
+
+def client_key(id, secret):
+    key = ClientKey(id)
+    key.key.secret = secret
+    key.stub = False
+    return key
+
+
+def mon_data(keyconfig):
+    return {
+        "entity": keyconfig.entity,
+        "key": keyconfig.key.to_string(),
+        "caps": keyconfig.capabilities,
+    }
+
+
+@pytest.fixture
+def rados():
+    return FakeRados(
+        [
+            mon_data(client_key("same", b"1" * 16)),
+            mon_data(client_key("changed", b"1" * 16)),
+            mon_data(client_key("stale", b"1" * 16)),
+            {"entity": "client.admin", "key": "", "caps": {}},
+            {"entity": "mon.", "key": "", "caps": {}},
+            {"entity": "osd.1", "key": "", "caps": {}},
+        ]
+    )
+
+
+@pytest.fixture
+def keys(rados):
+    cluster = fc.ceph.api.cluster.Cluster(ceph_id="admin")
+    cluster._rados = rados
+    return InstalledKeys(cluster)
+
+
+def test_changed_keys_are_imported_in_one_call(keys, rados, capsys):
+    keys.ensure(client_key("same", b"1" * 16))
+    keys.ensure(client_key("changed", b"2" * 16))
+    keys.ensure(client_key("new", b"3" * 16))
+    stub = client_key("old", b"4" * 16)
+    stub.stub = True
+    keys.ensure(stub)
+    out, _ = capsys.readouterr()
+    assert out == (
+        "\nclient.same:\n\tNOOP (Key in store and matching.)\n"
+        "\nclient.changed:\n\tUPDATE (Key in store but not matching.)\n"
+        "\nclient.new:\n\tUPDATE (Key not in store)\n"
+        "\nclient.old:\n\tNOOP (Key is a stub.)\n"
+    )
+
+    keys.commit()
+    imports = [c for c in rados.commands if c[0] == "auth import"]
+    assert len(imports) == 1
+    keyring = imports[0][2].decode("ascii")
+    assert "[client.changed]" in keyring
+    assert "[client.new]" in keyring
+    assert "[client.same]" not in keyring
+    assert "[client.old]" not in keyring
+    assert keys.stats == {
+        "updated": 2,
+        "unchanged": 1,
+        "stub": 1,
+        "deleted": 0,
+    }
+
+
+def test_commit_without_changes_does_nothing(keys, rados):
+    keys.ensure(client_key("same", b"1" * 16))
+    keys.commit()
+    assert [c[0] for c in rados.commands] == ["auth list"]
+
+
+def test_purge_deletes_unseen_keys_over_one_connection(keys, rados):
+    keys.ensure(client_key("same", b"1" * 16))
+    keys.ensure(client_key("changed", b"1" * 16))
+    keys.purge()
+    deletions = [c[1] for c in rados.commands if c[0] == "auth del"]
+    assert deletions == [
+        {"prefix": "auth del", "format": "json", "entity": "client.stale"}
+    ]
+    assert keys.stats["deleted"] == 1
+
+
+def test_report(keys, capsys):
+    keys.ensure(client_key("same", b"1" * 16))
+    keys.report()
+    out, _ = capsys.readouterr()
+    assert out.endswith("0 updated, 1 unchanged, 0 stubs, 0 deleted in 0.0s\n")
+
+
+def test_rgw_key_capabilities_in_keyring(keys, rados):
+    key = RGWKey("gw")
+    key.key.secret = b"5" * 16
+    key.stub = False
+    keys.ensure(key)
+    keys.commit()
+    keyring = rados.commands[-1][2].decode("ascii")
+    assert "[client.radosgw.gw]" in keyring
+    assert 'caps mon = "allow rwx"' in keyring
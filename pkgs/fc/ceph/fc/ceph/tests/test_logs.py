@@ -0,0 +1,142 @@
+import gzip
+import json
+
+import pytest
+from fc.ceph.logs import Filter, LogTasks, analyze, read
+
+LOG = b"""\
+2021-03-01 12:01:02.123456 osd.12 10.0.0.1:6800/1234 567 : cluster [WRN] \
+slow request 30.5 seconds old, received at 2021-03-01 12:00:31: \
+osd_op(client.1 rbd_data.1 [write]) currently waiting for subops from 3,7
+2021-03-01 12:04:59.000000 osd.12 10.0.0.1:6800/1234 568 : cluster [WRN] \
+slow request 31.5 seconds old, received at 2021-03-01 12:04:27: \
+osd_op(client.1 rbd_data.2 [write]) currently commit_sent
+2021-03-01 12:09:59.000000 osd.3 10.0.0.2:6800/1234 12 : cluster [WRN] \
+slow request 32.5 seconds old, received at 2021-03-01 12:09:27: \
+osd_op(client.1 rbd_data.3 [write]) currently started
+2021-03-01 12:10:00.000000 osd.3 10.0.0.2:6800/1234 13 : cluster [WRN] \
+slow request 33.5 seconds old, received at 2021-03-01 12:09:27: \
+osd_op(client.1 rbd_data.3 [write]) currently waiting for degraded object
+2021-03-01 12:10:01.000000 mon.0 10.0.0.3:6789/0 100 : cluster [INF] \
+pgmap v1: 64 pgs: 64 active+clean
+2021-03-01 12:11:00.000000 osd.7 10.0.0.3:6800/1234 14 : cluster [WRN] \
+slow request 30.1 seconds old, received at 2021-03-01 12:10:30: \
+osd_op(client.1 rbd_data.3 [write]) currently sub_op_commit_rec
+"""
+
+INCLUDE = "slow request "
+EXCLUDE = "waiting for (degraded object|subops)"
+
+
+@pytest.fixture
+def logfiles(tmpdir):
+    plain = str(tmpdir / "ceph.log")
+    with open(plain, "wb") as f:
+        f.write(LOG)
+    compressed = str(tmpdir / "ceph.log.1.gz")
+    with gzip.open(compressed, "wb") as f:
+        f.write(LOG)
+    return [plain, compressed]
+
+
+def test_filter_uses_substring_for_plain_patterns():
+    f = Filter(INCLUDE)
+    assert f.literal == b"slow request "
+    assert f.search(b"... slow request 30 seconds ...")
+    f = Filter(EXCLUDE)
+    assert f.literal is None
+    assert f.search(b"currently waiting for subops from 3")
+    assert not f.search(b"currently started")
+
+
+def test_read_counts_osds_and_buckets(logfiles):
+    result = read(logfiles[0], INCLUDE, EXCLUDE)
+    assert result.osds == {"osd.12": 1, "osd.3": 1, "osd.7": 1}
+    assert result.buckets == {"2021-03-01 12:00": 2, "2021-03-01 12:10": 1}
+    assert result.osd_buckets["2021-03-01 12:00"] == {
+        "osd.12": 1,
+        "osd.3": 1,
+    }
+
+
+def test_read_gzip(logfiles):
+    assert read(logfiles[1], INCLUDE, None).osds == {
+        "osd.12": 2,
+        "osd.3": 2,
+        "osd.7": 1,
+    }
+
+
+def test_read_hourly_buckets(logfiles):
+    result = read(logfiles[0], INCLUDE, EXCLUDE, bucket_minutes=60)
+    assert result.buckets == {"2021-03-01 12:00": 3}
+
+
+def test_read_lines_across_chunks(logfiles, monkeypatch):
+    monkeypatch.setattr("fc.ceph.logs.CHUNKSIZE", 7)
+    assert sum(read(logfiles[0], INCLUDE, EXCLUDE).osds.values()) == 3
+
+
+def test_analyze_merges_files(logfiles):
+    result = analyze(logfiles, INCLUDE, EXCLUDE, workers=2)
+    assert result.osds == {"osd.12": 2, "osd.3": 2, "osd.7": 2}
+    assert result.buckets == {"2021-03-01 12:00": 4, "2021-03-01 12:10": 2}
+
+
+def test_histogram_output(logfiles, capsys):
+    LogTasks().slowreq_histogram(
+        INCLUDE, EXCLUDE, 2, logfiles, buckets=True, workers=1
+    )
+    out, _ = capsys.readouterr()
+    lines = out.splitlines()
+    assert len(lines) == 5
+    assert lines[0].split(" - ")[1].strip() == "2"
+    assert lines[3].startswith("2021-03-01 12:00 -       4 - ")
+
+
+def test_json_output(logfiles, capsys):
+    LogTasks().slowreq_histogram(
+        INCLUDE, EXCLUDE, 20, logfiles, json_output=True, workers=1
+    )
+    out, _ = capsys.readouterr()
+    data = json.loads(out)
+    assert data["bucket_minutes"] == 10
+    assert data["osds"] == {"osd.12": 2, "osd.3": 2, "osd.7": 2}
+    assert data["osd_buckets"]["2021-03-01 12:10"] == {"osd.7": 2}
+
+
+def test_filter_lines():
+    data = b"a slow request 1\nnothing\nslow request 2\nlast slow request"
+    assert list(Filter("slow request").lines(data)) == [
+        b"a slow request 1",
+        b"slow request 2",
+        b"last slow request",
+    ]
+    assert list(Filter("^slow req.*").lines(data)) == [b"slow request 2"]
+
+
+def test_filter_lines_does_not_match_across_lines():
+    data = b"osd.1 slow\nrequest 1\nosd.2 slow request 2\nosd.3 x\n"
+    assert list(Filter(r"slow\s+request").lines(data)) == [
+        b"osd.2 slow request 2"
+    ]
+    assert list(Filter(r"slow[^#]*osd\.3").lines(data)) == []
+    assert list(Filter(r"1\n").lines(data)) == []
+
+
+def test_filter_lines_finds_match_behind_cross_line_candidate():
+    data = b"x a\nb a b\n"
+    # The leftmost chunk match "a\nb" starts in the first line.
+    assert list(Filter(r"a\s+b").lines(data)) == [b"b a b"]
+
+
+def test_filter_lines_string_anchors_apply_per_line():
+    data = b"foo\nslow request 1\nslow request 2 foo\n"
+    assert list(Filter(r"\Aslow").lines(data)) == [
+        b"slow request 1",
+        b"slow request 2 foo",
+    ]
+    assert list(Filter(r"foo\Z").lines(data)) == [
+        b"foo",
+        b"slow request 2 foo",
+    ]
@@ -0,0 +1,286 @@
+import json
+
+import fc.ceph.manage
+import pytest
+from fc.ceph.manage import PGStatWatcher, RollingRestart, restart_batches
+
+
+def crush_map(domain):
+    return {
+        "types": [
+            {"type_id": 0, "name": "osd"},
+            {"type_id": 1, "name": "host"},
+            {"type_id": 3, "name": "rack"},
+            {"type_id": 10, "name": "root"},
+        ],
+        "rules": [
+            {
+                "rule_name": "replicated_ruleset",
+                "steps": [
+                    {"op": "take", "item": -1},
+                    {"op": "chooseleaf_firstn", "num": 0, "type": domain},
+                    {"op": "emit"},
+                ],
+            }
+        ],
+        "buckets": [
+            {
+                "id": -1,
+                "name": "default",
+                "type_name": "root",
+                "items": [{"id": -2}, {"id": -3}],
+            },
+            {
+                "id": -2,
+                "name": "host1",
+                "type_name": "host",
+                "items": [{"id": 0}, {"id": 1}, {"id": 2}],
+            },
+            {
+                "id": -3,
+                "name": "host2",
+                "type_name": "host",
+                "items": [{"id": 3}, {"id": 4}],
+            },
+            {
+                "id": -4,
+                "name": "host1~ssd",
+                "type_name": "host",
+                "items": [{"id": 0}],
+            },
+        ],
+    }
+
+
+def test_batches_by_host():
+    assert restart_batches([0, 1, 2, 3], crush_map("host")) == [
+        [0, 1, 2],
+        [3],
+    ]
+
+
+def test_batches_by_osd_restart_one_at_a_time():
+    assert restart_batches([0, 1], crush_map("osd")) == [[0], [1]]
+
+
+def test_batches_use_smallest_failure_domain():
+    crush = crush_map("rack")
+    crush["rules"].append(
+        {"steps": [{"op": "chooseleaf_firstn", "num": 0, "type": "host"}]}
+    )
+    assert restart_batches([0, 3, 4], crush) == [[0], [3, 4]]
+
+
+def test_osds_outside_crush_map_are_restarted_alone():
+    assert restart_batches([0, 7, 8], crush_map("host")) == [[0], [7], [8]]
+
+
+class FakeWatcher(PGStatWatcher):
+    """Replays a sequence of `pg stat` results."""
+
+    def __init__(self, states):
+        super().__init__(interval=0)
+        self.sequence = list(states)
+        self.up = True
+
+    def poll(self):
+        if len(self.sequence) > 1:
+            self.states = self.sequence.pop(0)
+        else:
+            self.states = self.sequence[0]
+        return self.states
+
+    def osds_up(self, ids):
+        return self.up
+
+
+def test_watcher_counts_states():
+    w = FakeWatcher(
+        [
+            {
+                "active+clean": 10,
+                "active+clean+scrubbing+deep": 1,
+                "peering": 2,
+                "stale+active+clean": 1,
+                "active+undersized+degraded": 3,
+            }
+        ]
+    )
+    w.poll()
+    assert w.inactive == 3
+    assert w.unclean == 6
+
+
+def test_watcher_waits_for_condition():
+    w = FakeWatcher(
+        [
+            {"peering": 4},
+            {"peering": 1, "active+clean": 3},
+            {"active+clean": 4},
+        ]
+    )
+    assert w.wait(lambda w: not w.inactive, 0, 10**12) > 0
+    assert w.states == {"active+clean": 4}
+
+
+def test_watcher_times_out():
+    w = FakeWatcher([{"peering": 4}])
+    with pytest.raises(TimeoutError):
+        w.wait(lambda w: not w.inactive, 0, 0)
+
+
+@pytest.fixture
+def restart(monkeypatch, tmpdir):
+    commands = []
+
+    class OSD(object):
+        def __init__(self, id):
+            self.id = id
+
+        def deactivate(self, flush=True):
+            assert not flush
+            commands.append(("stop", self.id))
+
+        def activate(self):
+            commands.append(("start", self.id))
+
+    def run_ceph(*args):
+        if args == ("osd", "crush", "dump"):
+            return crush_map("host")
+        if args == ("osd", "dump"):
+            return {"flags": "sortbitwise"}
+        raise NotImplementedError(args)
+
+    def ceph(*args, check=False):
+        commands.append(args)
+
+    monkeypatch.setattr(fc.ceph.manage, "OSD", OSD)
+    monkeypatch.setattr(fc.ceph.manage, "run_ceph", run_ceph)
+    monkeypatch.setattr(fc.ceph.manage, "ceph", ceph)
+    watcher = FakeWatcher(
+        [
+            {"active+clean": 4},
+            {"peering": 2, "active+clean": 2},
+            {"active+degraded": 1, "active+clean": 3},
+            {"active+clean": 4},
+        ]
+    )
+    stats = str(tmpdir / "restart.log")
+    return RollingRestart([0, 1, 3], stats, watcher), commands, stats
+
+
+def test_rolling_restart(restart):
+    restart, commands, stats = restart
+    restart.run()
+    assert commands[0] == ("osd", "set", "noout")
+    assert commands[-1] == ("osd", "unset", "noout")
+    assert set(commands[1:5]) == set(
+        [("stop", 0), ("start", 0), ("stop", 1), ("start", 1)]
+    )
+    assert commands[5:7] == [("stop", 3), ("start", 3)]
+    with open(stats) as f:
+        records = [json.loads(line) for line in f]
+    assert [r["osd"] for r in records] == [0, 1, 3]
+    assert records[0]["batch"] == [0, 1]
+    assert records[0]["peering"] <= records[0]["recovery"]
+
+
+def test_rolling_restart_keeps_existing_noout(restart, monkeypatch):
+    restart, commands, stats = restart
+    monkeypatch.setattr(
+        fc.ceph.manage,
+        "run_ceph",
+        lambda *args: (
+            {"flags": "noout"} if args == ("osd", "dump") else crush_map("osd")
+        ),
+    )
+    restart.run()
+    assert ("osd", "set", "noout") not in commands
+    assert ("osd", "unset", "noout") not in commands
+
+
+def test_rolling_restart_unsets_noout_on_timeout(restart):
+    restart, commands, stats = restart
+    restart.watcher.up = False
+    restart.PEERING_TIMEOUT = 0
+    with pytest.raises(TimeoutError):
+        restart.run()
+    assert commands[-1] == ("osd", "unset", "noout")
+    with open(stats) as f:
+        records = [json.loads(line) for line in f]
+    assert records[0]["peering"] is None
+
+
+def test_run_parallel_prefixes_output_and_reports_timings(capsys):
+    def work(id_):
+        print(f"working on {id_}")
+        if id_ == 2:
+            raise ValueError("broken disk")
+
+    results = fc.ceph.manage.run_parallel(
+        work, [1, 2], 2, name=lambda id_: f"osd.{id_}"
+    )
+    assert results[1][0] == "ok"
+    assert results[2][0] == "failed"
+    out, _ = capsys.readouterr()
+    lines = out.splitlines()
+    assert "[osd.1] working on 1" in lines
+    assert "[osd.2] working on 2" in lines
+    assert "[osd.2] broken disk" in lines
+    assert lines[-3] == "Timings:"
+    assert lines[-2].split()[:2] == ["osd.1", "ok"]
+    assert lines[-1].split()[:2] == ["osd.2", "failed"]
+
+
+@pytest.fixture
+def snapshot(monkeypatch):
+    def query_lvm(*args):
+        if args[0] == "lvs":
+            return [
+                {"LV": "ceph-osd-1", "VG": "vgosd-1"},
+                {"LV": "ceph-jnl-1", "VG": "vgjnl00"},
+            ]
+        if args[0] == "pvs":
+            return [{"PV": "/dev/sdc1", "VG": "vgosd-1"}]
+        raise NotImplementedError(args)
+
+    def run_json(args):
+        assert args[0] == "lsblk"
+        return {
+            "blockdevices": [
+                {"name": "sdc", "pkname": None, "mountpoint": None},
+                {"name": "sdc1", "pkname": "sdc", "mountpoint": None},
+                {
+                    "name": "vgosd--1-ceph--osd--1",
+                    "pkname": "sdc1",
+                    "mountpoint": "/srv/ceph/osd/ceph-1",
+                },
+            ]
+        }
+
+    monkeypatch.setattr(fc.ceph.manage, "query_lvm", query_lvm)
+    monkeypatch.setattr(fc.ceph.manage, "run_json", run_json)
+    snapshot = fc.ceph.manage.LVMSnapshot()
+
+    def no_queries(*args, **kw):
+        raise AssertionError("unexpected query", args)
+
+    monkeypatch.setattr(fc.ceph.manage, "query_lvm", no_queries)
+    monkeypatch.setattr(fc.ceph.manage, "run", no_queries)
+    return snapshot
+
+
+def test_osd_uses_snapshot(snapshot):
+    osd = fc.ceph.manage.OSD(1, snapshot)
+    assert osd._locate_journal_lv() == "/dev/vgjnl00/ceph-jnl-1"
+    assert osd.is_mounted()
+    assert snapshot.vg_lvs("vgosd-1") == [
+        {"LV": "ceph-osd-1", "VG": "vgosd-1"}
+    ]
+    assert snapshot.blockdevice("sdc1")["pkname"] == "sdc"
+
+
+def test_osd_queries_when_snapshot_misses(snapshot):
+    osd = fc.ceph.manage.OSD(2, snapshot)
+    with pytest.raises(AssertionError):
+        osd._locate_journal_lv()
@@ -1,4 +1,4 @@
-{ pkgs, libyaml, python3Packages, ceph }:
+{ pkgs, libyaml, python3Packages, ceph, sharedcache }:
 
 let
   py = python3Packages;
@@ -12,5 +12,14 @@ in
     propagatedBuildInputs = [
       py.nagiosplugin
       ceph
+      sharedcache
     ];
+
+    checkInputs = [
+      py.pytest
+    ];
+
+    checkPhase = ''
+      pytest fc/check_ceph
+    '';
   }
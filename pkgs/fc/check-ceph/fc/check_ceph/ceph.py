@@ -7,29 +7,86 @@ intended to be run on all Ceph mons.
 import argparse
 import json
 import logging
+import os
 import re
 import subprocess
+import time
 
 import nagiosplugin
+from fc.sharedcache.cache import SharedCache
 
 DEFAULT_LOGFILE = "/var/log/ceph/ceph.log"
+DEFAULT_CEPH_CONF = "/etc/ceph/ceph.conf"
 _log = logging.getLogger("nagiosplugin")
 
 
 class CephStatus(object):
-    """Encapsulates ceph status output and provides easy access."""
-
-    def __init__(self, status_cmd):
+    """Encapsulates ceph status output and provides easy access.
+
+    The status is either retrieved by running `status_cmd` or, with the
+    "rados" backend, by sending a mon command over librados. If `cache`
+    is given, the raw status is shared via this file with concurrent
+    check runs and other local consumers as long as it is not older than
+    `max_age` seconds.
+    """
+
+    def __init__(
+        self,
+        status_cmd,
+        backend="command",
+        cache=None,
+        max_age=30,
+        ceph_id="admin",
+        ceph_conf=DEFAULT_CEPH_CONF,
+    ):
         self.cmd = status_cmd
+        self.backend = backend
+        self.cache = cache
+        self.max_age = max_age
+        self.ceph_id = ceph_id
+        self.ceph_conf = ceph_conf
         self._raw = None
         self.status = None
+        self.cache_hit = False
+        self.fetch_time = 0.0
 
     def query(self):
-        _log.info('querying cluster status with "%s"', self.cmd)
-        self._raw = subprocess.check_output(self.cmd, shell=True).decode()
+        started = time.time()
+        self.cache_hit = False
+        if self.cache:
+            self._raw, self.cache_hit = SharedCache(
+                self.cache, self.max_age, "cluster status"
+            ).get(self.fetch)
+        else:
+            self._raw = self.fetch()
+        self.fetch_time = time.time() - started
         _log.debug("cluster status output:\n%s", self._raw)
         self.status = json.loads(self._raw)
 
+    def fetch(self):
+        """Retrieves the current status from the cluster."""
+        if self.backend == "rados":
+            try:
+                return self._fetch_rados()
+            except Exception as e:
+                _log.warning("rados backend failed (%s), using command", e)
+        _log.info('querying cluster status with "%s"', self.cmd)
+        return subprocess.check_output(self.cmd, shell=True).decode()
+
+    def _fetch_rados(self):
+        import rados
+
+        _log.info("querying cluster status via librados")
+        with rados.Rados(
+            conffile=self.ceph_conf, name="client.{}".format(self.ceph_id)
+        ) as connection:
+            ret, outbuf, outs = connection.mon_command(
+                json.dumps({"prefix": "status", "format": "json"}), b""
+            )
+        if ret:
+            raise RuntimeError("ceph status failed", ret, outs)
+        return outbuf.decode()
+
     @property
     def overall(self):
         return self.status["health"]["overall_status"]
@@ -191,34 +248,119 @@ class Ceph(nagiosplugin.Resource):
             max=100.0,
             context="default",
         )
+        yield nagiosplugin.Metric(
+            "status fetch",
+            float("{:.4f}".format(self.stat.fetch_time)),
+            "s",
+            min=0,
+            context="default",
+        )
+        yield nagiosplugin.Metric(
+            "status cache hit",
+            int(self.stat.cache_hit),
+            min=0,
+            max=1,
+            context="default",
+        )
 
 
 class CephLog(nagiosplugin.Resource):
-    """Scan log file for blocked requests."""
+    """Scan log file for blocked requests.
 
-    def __init__(self, logfile, statefile):
-        self.logfile = logfile
+    Works like `nagiosplugin.LogTail`, but scans raw chunks and stops
+    after `max_bytes` or `max_time` seconds. The rest is left for the
+    next run and reported as backlog.
+    """
+
+    CHUNKSIZE = 2**20
+
+    def __init__(self, logfile, statefile, max_bytes=2**28, max_time=10.0):
+        self.logfile = os.path.abspath(logfile)
         self.cookie = nagiosplugin.Cookie(statefile)
+        self.max_bytes = max_bytes
+        self.max_time = max_time
 
+    marker = b" slow requests"
     r_slow_req = re.compile(
-        r" (\d+) slow requests.*; oldest blocked for > ([0-9.]+) secs"
+        rb" (\d+) slow requests.*; oldest blocked for > ([0-9.]+) secs"
     )
 
-    def probe(self):
+    def lines(self, chunk):
+        """Yields lines of `chunk` containing the marker."""
+        pos = 0
+        while True:
+            start = chunk.find(self.marker, pos)
+            if start < 0:
+                return
+            line_start = chunk.rfind(b"\n", 0, start) + 1
+            line_end = chunk.find(b"\n", start)
+            if line_end < 0:
+                line_end = len(chunk)
+            yield chunk[line_start:line_end]
+            pos = line_end + 1
+
+    def scan(self, f):
+        """Scans complete lines from the current position of `f`.
+
+        Reads at most `max_bytes`, including incomplete lines which are
+        scanned again by the next run. Returns (blocked, oldest, bytes
+        scanned).
+        """
         blocked = 0
         oldest = 0.0
-        _log.info("scanning %s for slow request logs", self.logfile)
-        with nagiosplugin.LogTail(self.logfile, self.cookie) as newlines:
-            for line in newlines:
-                m = self.r_slow_req.search(line.decode())
+        scanned = 0
+        read = 0
+        rest = b""
+        deadline = time.time() + self.max_time
+        while read < self.max_bytes and time.time() < deadline:
+            data = f.read(min(self.CHUNKSIZE, self.max_bytes - read))
+            if not data:
+                break
+            read += len(data)
+            data = rest + data
+            end = data.rfind(b"\n") + 1
+            # Incomplete lines are scanned again in the next round.
+            rest = data[end:]
+            scanned += end
+            for line in self.lines(data[:end]):
+                m = self.r_slow_req.search(line)
                 if not m:
                     continue
                 _log.debug("slow requests: %s", line.strip())
                 blocked = max(blocked, int(m.group(1)))
                 oldest = max(oldest, float(m.group(2)))
+        if not scanned and read >= self.max_bytes:
+            # A single line exceeds the budget. Skip it, otherwise no run
+            # would ever get past it.
+            _log.warning("skipping line longer than %d bytes", read)
+            scanned = read
+        return blocked, oldest, scanned
+
+    def probe(self):
+        _log.info("scanning %s for slow request logs", self.logfile)
+        with self.cookie:
+            with open(self.logfile, "rb") as f:
+                stat = os.fstat(f.fileno())
+                pos = self.cookie.get(self.logfile, {}).get("pos", 0)
+                inode = self.cookie.get(self.logfile, {}).get("inode")
+                if stat.st_ino != inode or stat.st_size < pos:
+                    # Rotated or truncated, start from the beginning.
+                    pos = 0
+                f.seek(pos)
+                blocked, oldest, scanned = self.scan(f)
+                pos += scanned
+                backlog = max(0, os.fstat(f.fileno()).st_size - pos)
+            self.cookie[self.logfile] = dict(inode=stat.st_ino, pos=pos)
+        if backlog:
+            _log.info(
+                "%d bytes of %s left for next run", backlog, self.logfile
+            )
         return [
             nagiosplugin.Metric("req_blocked", blocked, min=0),
             nagiosplugin.Metric("req_blocked_age", oldest, "s", min=0),
+            nagiosplugin.Metric(
+                "log backlog", backlog, "B", min=0, context="default"
+            ),
         ]
 
 
@@ -267,6 +409,32 @@ def main():
         help="execute command to retrieve cluster status "
         '(default: "%(default)s")',
     )
+    argp.add_argument(
+        "-b",
+        "--backend",
+        choices=["command", "rados"],
+        default="command",
+        help="retrieve cluster status by executing the status command or "
+        "via librados (default: %(default)s)",
+    )
+    argp.add_argument(
+        "--id",
+        default="admin",
+        help="ceph client id for the rados backend (default: %(default)s)",
+    )
+    argp.add_argument(
+        "--cache",
+        metavar="PATH",
+        help="share cluster status with other runs via this file",
+    )
+    argp.add_argument(
+        "--cache-max-age",
+        metavar="SEC",
+        type=float,
+        default=30,
+        help="reuse cached cluster status up to SEC seconds "
+        "(default: %(default)s)",
+    )
     argp.add_argument(
         "-l",
         "--log",
@@ -313,6 +481,22 @@ def main():
         default="/var/lib/check_ceph_health.state",
         help="state file for logteil (default: %(default)s)",
     )
+    argp.add_argument(
+        "--max-scan-bytes",
+        metavar="BYTES",
+        type=int,
+        default=2**28,
+        help="scan at most BYTES of new log lines per run "
+        "(default: %(default)s)",
+    )
+    argp.add_argument(
+        "--max-scan-time",
+        metavar="SEC",
+        type=float,
+        default=10,
+        help="stop scanning new log lines after SEC seconds "
+        "(default: %(default)s)",
+    )
     argp.add_argument(
         "-v",
         "--verbose",
@@ -329,7 +513,15 @@ def main():
     )
     args = argp.parse_args()
     check = nagiosplugin.Check(
-        Ceph(CephStatus(args.command)),
+        Ceph(
+            CephStatus(
+                args.command,
+                backend=args.backend,
+                cache=args.cache,
+                max_age=args.cache_max_age,
+                ceph_id=args.id,
+            )
+        ),
         HealthContext("health"),
         nagiosplugin.ScalarContext(
             "nearfull", critical="0:0", fmt_metric="{value} near full osd(s)"
@@ -338,7 +530,12 @@ def main():
     )
     if args.log:
         check.add(
-            CephLog(args.log, args.state),
+            CephLog(
+                args.log,
+                args.state,
+                max_bytes=args.max_scan_bytes,
+                max_time=args.max_scan_time,
+            ),
             nagiosplugin.ScalarContext(
                 "req_blocked", args.warn_requests, args.crit_requests
             ),
@@ -0,0 +1,232 @@
+import fcntl
+import io
+import json
+import os
+import sys
+import threading
+import types
+
+import pytest
+from fc.check_ceph.ceph import CephLog, CephStatus
+
+STATUS = {
+    "health": {"overall_status": "HEALTH_OK", "summary": [], "detail": []},
+    "pgmap": {"data_bytes": 1, "bytes_used": 3, "bytes_avail": 7},
+}
+
+SLOW = (
+    b"2026-10-19 10:00:00.000 mon.0 [WRN] {} slow requests, 1 included "
+    b"below; oldest blocked for > {} secs\n"
+)
+OTHER = b"2026-10-19 10:00:00.000 mon.0 [INF] pgmap v1: 1 pgs: 1 active\n"
+
+
+def slow(blocked, age):
+    return SLOW.replace(b"{}", str(blocked).encode(), 1).replace(
+        b"{}", str(age).encode(), 1
+    )
+
+
+@pytest.fixture
+def command(tmpdir):
+    """Shell command printing STATUS and counting its invocations."""
+    status = tmpdir / "status.json"
+    status.write(json.dumps(STATUS))
+    calls = tmpdir / "calls"
+    return "echo >> {}; cat {}".format(calls, status), calls
+
+
+def count_calls(path):
+    return len(path.read().splitlines()) if path.exists() else 0
+
+
+@pytest.fixture
+def rados(monkeypatch):
+    """Fake librados module recording mon commands."""
+    module = types.ModuleType("rados")
+    module.commands = []
+    module.result = (0, json.dumps(STATUS).encode(), "")
+
+    class Rados:
+        def __init__(self, conffile, name):
+            module.client = (conffile, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def mon_command(self, cmd, inbuf):
+            module.commands.append(json.loads(cmd))
+            return module.result
+
+    module.Rados = Rados
+    monkeypatch.setitem(sys.modules, "rados", module)
+    return module
+
+
+def test_status_command(command):
+    cmd, calls = command
+    status = CephStatus(cmd)
+    status.query()
+    assert status.overall == "HEALTH_OK"
+    assert status.bytes_net_total == 10
+    assert not status.cache_hit
+    assert count_calls(calls) == 1
+
+
+def test_status_rados_backend(command, rados):
+    cmd, calls = command
+    status = CephStatus(cmd, backend="rados", ceph_id="mon", ceph_conf="c")
+    status.query()
+    assert status.overall == "HEALTH_OK"
+    assert rados.client == ("c", "client.mon")
+    assert rados.commands == [{"prefix": "status", "format": "json"}]
+    assert count_calls(calls) == 0
+
+
+def test_status_rados_backend_falls_back_to_command(command, rados):
+    cmd, calls = command
+    rados.result = (-13, b"", "permission denied")
+    status = CephStatus(cmd, backend="rados")
+    status.query()
+    assert status.overall == "HEALTH_OK"
+    assert count_calls(calls) == 1
+
+
+def test_status_cache_shared(command, tmpdir):
+    cmd, calls = command
+    cache = str(tmpdir / "status.cache")
+    first = CephStatus(cmd, cache=cache)
+    first.query()
+    second = CephStatus(cmd, cache=cache)
+    second.query()
+    assert (first.cache_hit, second.cache_hit) == (False, True)
+    assert second.status == STATUS
+    assert count_calls(calls) == 1
+    os.utime(cache, (0, 0))
+    third = CephStatus(cmd, cache=cache, max_age=30)
+    third.query()
+    assert not third.cache_hit
+    assert count_calls(calls) == 2
+
+
+def test_status_cache_lock(command, tmpdir):
+    cmd, calls = command
+    cache = str(tmpdir / "status.cache")
+    status = CephStatus(cmd, cache=cache)
+    with open(cache + ".lock", "a") as lock:
+        # Another check run is querying the cluster.
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        waiting = threading.Thread(target=status.query)
+        waiting.start()
+        waiting.join(0.2)
+        assert waiting.is_alive()
+        with open(cache, "w") as f:
+            json.dump(STATUS, f)
+    waiting.join(5)
+    assert status.cache_hit
+    assert count_calls(calls) == 0
+
+
+@pytest.fixture
+def log(tmpdir):
+    return str(tmpdir / "ceph.log"), str(tmpdir / "state")
+
+
+def metrics(resource):
+    return {m.name: m.value for m in resource.probe()}
+
+
+def test_scan_reports_max_blocked_and_oldest():
+    f = io.BytesIO(OTHER + slow(3, 12.5) + OTHER + slow(1, 40.1) + OTHER)
+    blocked, oldest, scanned = CephLog("log", "state").scan(f)
+    assert blocked == 3
+    assert oldest == 40.1
+    assert scanned == len(f.getvalue())
+
+
+def test_scan_leaves_incomplete_line():
+    f = io.BytesIO(OTHER + slow(3, 12.5)[:-10])
+    blocked, _, scanned = CephLog("log", "state").scan(f)
+    assert blocked == 0
+    assert scanned == len(OTHER)
+
+
+class CountingFile(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def test_scan_budget_includes_incomplete_lines():
+    resource = CephLog("log", "state", max_bytes=1000)
+    resource.CHUNKSIZE = 100
+    f = CountingFile(OTHER + b"x" * 10000)
+    _, _, scanned = resource.scan(f)
+    assert f.bytes_read == 1000
+    assert scanned == len(OTHER)
+
+
+def test_scan_skips_line_exceeding_budget():
+    resource = CephLog("log", "state", max_bytes=1000)
+    resource.CHUNKSIZE = 100
+    f = CountingFile(b"x" * 10000 + b"\n" + slow(2, 1.0))
+    _, _, scanned = resource.scan(f)
+    assert f.bytes_read == 1000
+    assert scanned == 1000
+
+
+def test_probe_continues_at_cookie_position(log):
+    logfile, state = log
+    with open(logfile, "wb") as f:
+        f.write(slow(5, 10.0))
+    assert metrics(CephLog(logfile, state))["req_blocked"] == 5
+    with open(logfile, "ab") as f:
+        f.write(OTHER)
+    m = metrics(CephLog(logfile, state))
+    assert m["req_blocked"] == 0
+    assert m["log backlog"] == 0
+
+
+def test_probe_restarts_after_truncation(log):
+    logfile, state = log
+    with open(logfile, "wb") as f:
+        f.write(OTHER * 10)
+    metrics(CephLog(logfile, state))
+    with open(logfile, "wb") as f:
+        f.write(slow(2, 3.0))
+    assert metrics(CephLog(logfile, state))["req_blocked"] == 2
+
+
+def test_probe_restarts_after_rotation(log):
+    logfile, state = log
+    with open(logfile, "wb") as f:
+        f.write(slow(1, 1.0) + OTHER)
+    metrics(CephLog(logfile, state))
+    os.rename(logfile, logfile + ".1")
+    with open(logfile, "wb") as f:
+        # Larger than the position in the old file.
+        f.write(slow(4, 2.0) + OTHER * 3)
+    assert metrics(CephLog(logfile, state))["req_blocked"] == 4
+
+
+def test_probe_reports_backlog(log):
+    logfile, state = log
+    data = OTHER * 10 + slow(7, 1.0)
+    with open(logfile, "wb") as f:
+        f.write(data)
+    resource = CephLog(logfile, state, max_bytes=len(OTHER) * 4)
+    m = metrics(resource)
+    assert m["req_blocked"] == 0
+    assert m["log backlog"] == len(data) - len(OTHER) * 4
+    resource = CephLog(logfile, state, max_bytes=len(data))
+    m = metrics(resource)
+    assert m["req_blocked"] == 7
+    assert m["log backlog"] == 0
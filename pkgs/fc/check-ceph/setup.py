@@ -13,6 +13,7 @@ setup(
     ],
     packages=["fc.check_ceph"],
     install_requires=[
+        "fc.sharedcache",
         "nagiosplugin",
     ],
     entry_points={
@@ -0,0 +1,134 @@
+"""Benchmark check_haproxy log parsing on a synthetic log.
+
+Usage: python benchmark.py [--lines N] [--prefixes N]
+
+Generates a HAProxy log with random requests below a number of URL
+prefixes and measures how long one check run takes with one -f filter
+per prefix. Also compares extracting the request fields line by line
+via nagiosplugin.LogTail with matching whole mmap chunks. About 6.5
+million lines make up 1 GB.
+"""
+
+import argparse
+import os
+import random
+import re
+import tempfile
+import time
+
+import nagiosplugin
+from fc.check_haproxy.haproxy import HAProxyLog, PrefixIndex
+from fc.check_haproxy.logtail import LogTail
+
+LINE = (
+    "Mar  1 12:00:00 lb haproxy[1234]: 10.0.0.1:4711 "
+    "[01/Mar/2021:12:00:00.123] http-in app/app0 "
+    "0/0/1/{t_r}/{t_tot} {status} 512 - - ---- 1/1/0/0/0 0/0 "
+    '"GET {url} HTTP/1.1"\n'
+)
+
+
+def prefixes(n):
+    return {
+        "p{}".format(i): "/app{}/section{}/".format(i % 7, i) for i in range(n)
+    }
+
+
+def generate(path, lines, url_prefixes):
+    rnd = random.Random(0)
+    urls = list(url_prefixes.values()) + ["/static/", "/"]
+    with open(path, "w") as f:
+        for _ in range(lines):
+            t_tot = int(rnd.lognormvariate(4, 1))
+            f.write(
+                LINE.format(
+                    t_r=t_tot,
+                    t_tot=t_tot,
+                    status=rnd.choice([200, 200, 200, 302, 404, 500]),
+                    url=rnd.choice(urls) + str(rnd.randrange(1000)),
+                )
+            )
+
+
+def parse_lines(logfile, statefile):
+    r_logline = re.compile(HAProxyLog.r_logline.pattern.decode())
+    fields = 0
+    cookie = nagiosplugin.Cookie(statefile)
+    with nagiosplugin.LogTail(logfile, cookie) as lines:
+        for line in lines:
+            match = r_logline.search(line.decode("iso-8859-1"))
+            if match:
+                fields += len(match.groups())
+    return fields
+
+
+def parse_chunks(logfile, statefile):
+    fields = 0
+    cookie = nagiosplugin.Cookie(statefile)
+    with LogTail(logfile, cookie) as chunks:
+        for data, start, end in chunks:
+            for match in HAProxyLog.r_logline.finditer(data, start, end):
+                fields += len(match.groups())
+    return fields
+
+
+def timed(label, func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    print("{:<30} {:8.2f}s".format(label, time.perf_counter() - started))
+    return result
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--lines", type=int, default=1000000)
+    argp.add_argument("--prefixes", type=int, default=50)
+    args = argp.parse_args()
+    url_prefixes = prefixes(args.prefixes)
+    with tempfile.TemporaryDirectory() as tmp:
+        logfile = os.path.join(tmp, "haproxy.log")
+        timed("generate log", generate, logfile, args.lines, url_prefixes)
+        print(
+            "{} lines, {:.0f} MiB, {} prefixes".format(
+                args.lines, os.stat(logfile).st_size / 2**20, args.prefixes
+            )
+        )
+        check = HAProxyLog(
+            logfile,
+            os.path.join(tmp, "state"),
+            ["50", "95"],
+            url_prefixes,
+            ["/static/"],
+        )
+        timed("check run", lambda: list(check.probe()))
+        timed(
+            "parse lines (LogTail)",
+            parse_lines,
+            logfile,
+            os.path.join(tmp, "state.lines"),
+        )
+        timed(
+            "parse chunks (mmap)",
+            parse_chunks,
+            logfile,
+            os.path.join(tmp, "state.chunks"),
+        )
+
+        urls = ["/app3/section{}/1".format(i) for i in range(100000)]
+        index = PrefixIndex(url_prefixes)
+        items = list(url_prefixes.items())
+        timed(
+            "100k URLs, prefix index",
+            lambda: [index.labels(url) for url in urls],
+        )
+        timed(
+            "100k URLs, one test per label",
+            lambda: [
+                [label for label, p in items if url.startswith(p)]
+                for url in urls
+            ],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,14 @@ in
     dontStrip = true;
     propagatedBuildInputs = [
       py.nagiosplugin
+    ];
+
+    checkInputs = [
       py.numpy
+      py.pytest
     ];
+
+    checkPhase = ''
+      pytest fc/check_haproxy
+    '';
   }
@@ -1,61 +1,246 @@
 import argparse
+import calendar
 import datetime
 import itertools
 import logging
 import re
+import time
 
 import nagiosplugin
-import numpy
+
+from .histogram import Histogram
+from .logtail import LogTail
+from .stats import DEFAULT_SOCKET, HAProxyStats
+
+
+class RequestStats(object):
+    """Total time distribution and error count of a class of requests.
+
+    Total times are counted per distinct value first and added to the
+    histogram in bulk, as many requests share the same value.
+    """
+
+    MAX_PENDING = 10000
+
+    def __init__(self):
+        self._t_tot = Histogram()
+        self._pending = {}
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def t_tot(self):
+        self.flush()
+        return self._t_tot
+
+    def flush(self):
+        for value, n in self._pending.items():
+            self._t_tot.add(value, n)
+        self._pending.clear()
+
+    def add(self, t_tot, err):
+        pending = self._pending
+        pending[t_tot] = pending.get(t_tot, 0) + 1
+        self.requests += 1
+        self.errors += err
+        if len(pending) > self.MAX_PENDING:
+            self.flush()
+
+    def update(self, other):
+        self.t_tot.update(other.t_tot)
+        self.requests += other.requests
+        self.errors += other.errors
+
+    def to_dict(self):
+        return {"t_tot": self.t_tot.to_dict(), "errors": self.errors}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats._t_tot = Histogram.from_dict(data["t_tot"])
+        stats.requests = stats._t_tot.count
+        stats.errors = data["errors"]
+        return stats
+
+
+class PrefixIndex(object):
+    """Finds all labels whose URL prefix matches a URL.
+
+    Prefixes are grouped by length, so a lookup costs one dict access per
+    distinct prefix length instead of one comparison per label.
+    """
+
+    def __init__(self, prefixes):
+        by_length = {}
+        for label, prefix in prefixes.items():
+            table = by_length.setdefault(len(prefix), {})
+            table.setdefault(prefix, []).append(label)
+        self.tables = sorted(by_length.items())
+
+    def labels(self, url):
+        result = []
+        for length, table in self.tables:
+            if length > len(url):
+                break
+            labels = table.get(url[:length])
+            if labels:
+                result.extend(labels)
+        return result
 
 
 class HAProxyLog(nagiosplugin.Resource):
     r_logline = re.compile(
-        r'haproxy.*: .* \d+/\d+/\d+/\d+/(\d+) (\d\d\d) .* "\w+ (/\S+) HTTP'
+        rb'haproxy.*: .* \d+/\d+/\d+/\d+/(\d+) (\d\d\d) .* "\w+ (/\S+) HTTP'
     )
+    r_accept_date = re.compile(rb"\[(\d\d)/(\w{3})/(\d{4}):(\d\d):(\d\d):")
+    months = {
+        m: i
+        for i, m in enumerate(
+            b"Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split(), 1
+        )
+    }
 
     def __init__(
-        self, logfile, statefile, percentiles, url_filters, exclude_patterns
+        self,
+        logfile,
+        statefile,
+        percentiles,
+        url_filters,
+        exclude_patterns,
+        window=0,
     ):
         self.logfile = logfile
         self.statefile = statefile
         self.percentiles = percentiles
+        self.window = window
+        self._minutes = {}
         self.url_filters = url_filters or {None: ""}
+        self.index = PrefixIndex(
+            {
+                label: prefix.encode("iso-8859-1")
+                for label, prefix in self.url_filters.items()
+            }
+        )
         if exclude_patterns:
             exclude_patterns = list(
                 map(lambda x: "({})".format(x), exclude_patterns)
             )
-            self.r_exclude = re.compile("|".join(exclude_patterns))
+            self.r_exclude = re.compile(
+                "|".join(exclude_patterns).encode("iso-8859-1")
+            )
         else:
             self.r_exclude = ReNull()
 
+    def minute(self, line):
+        """Returns the minute (since the epoch, local time) of a request."""
+        m = self.r_accept_date.search(line)
+        if not m:
+            return now_minute()
+        key = m.group(0)
+        if key not in self._minutes:
+            day, month, year, hour, minute = m.groups()
+            date = datetime.datetime(
+                int(year),
+                self.months.get(month, 1),
+                int(day),
+                int(hour),
+                int(minute),
+            )
+            self._minutes[key] = calendar.timegm(date.timetuple()) // 60
+        return self._minutes[key]
+
+    def new_slot(self):
+        slot = {label: RequestStats() for label in self.url_filters}
+        slot.setdefault(None, RequestStats())
+        return slot
+
     def parse(self):
-        """Extract tuples (t_tot, is_error, urlpath) from new log lines."""
+        """Aggregate new log lines into RequestStats per URL filter label.
+
+        Stats for all requests are included under the label None. With a
+        sliding window, stats are collected per minute of the request
+        timestamps. Returns a dict minute -> label -> RequestStats.
+        """
         cookie = nagiosplugin.Cookie(self.statefile)
-        records = []
-        with nagiosplugin.LogTail(self.logfile, cookie) as lf:
-            for line in lf:
-                match = self.r_logline.search(line.decode("iso-8859-1"))
-                if not match:
-                    logging.debug("ignoring line: %s", line.strip())
+        slots = {}
+        lookup = self.index.labels
+        filtered = None not in self.url_filters
+        need_line = self.window or not isinstance(self.r_exclude, ReNull)
+        with LogTail(self.logfile, cookie) as chunks:
+            for data, start, end in chunks:
+                for match in self.r_logline.finditer(data, start, end):
+                    if need_line:
+                        line_start = data.rfind(b"\n", start, match.start())
+                        line_end = data.find(b"\n", match.end(), end)
+                        line = data[max(line_start + 1, start) : line_end]
+                        if self.r_exclude.search(line):
+                            logging.debug(
+                                "hit exclude pattern in line: %s", line
+                            )
+                            continue
+                    t_tot, stat, url = match.groups()
+                    t_tot = int(t_tot)
+                    err = stat[0] not in b"23"
+                    minute = self.minute(line) if self.window else 0
+                    slot = slots.get(minute)
+                    if slot is None:
+                        slot = slots[minute] = self.new_slot()
+                    slot[None].add(t_tot, err)
+                    if filtered:
+                        for label in lookup(url):
+                            slot[label].add(t_tot, err)
+        return slots
+
+    def merged(self, slots):
+        stats = self.new_slot()
+        for slot in slots.values():
+            for label, s in slot.items():
+                stats[label].update(s)
+        return stats
+
+    def windowed(self, slots):
+        """Merges new `slots` with those stored in the state file.
+
+        Returns stats over the last `window` minutes and the number of
+        seconds covered. The span starts at the first run or at the oldest
+        minute holding requests, whichever is earlier: the first run may
+        read log lines from before it was started.
+        """
+        now = time.time()
+        oldest = now_minute() - self.window + 1
+        with nagiosplugin.Cookie(self.statefile) as cookie:
+            window = {}
+            for minute, slot in cookie.get("window", {}).items():
+                if int(minute) < oldest:
                     continue
-                if self.r_exclude.search(line.decode("iso-8859-1")):
-                    logging.debug(
-                        "hit exclude pattern in line: %s", line.strip()
-                    )
+                window[int(minute)] = stored = self.new_slot()
+                for label, data in slot.items():
+                    label = label or None
+                    if label in stored:
+                        stored[label] = RequestStats.from_dict(data)
+            for minute, slot in slots.items():
+                if minute < oldest:
                     continue
-                t_tot, stat, url = match.groups()
-                err = not (stat.startswith("2") or stat.startswith("3"))
-                records.append((t_tot, err, url))
-        return numpy.array(
-            records,
-            dtype=[
-                ("t_tot", numpy.int32),
-                ("err", numpy.uint16),
-                ("url", "80a"),
-            ],
-        )
+                stored = window.setdefault(minute, self.new_slot())
+                for label, s in slot.items():
+                    stored[label].update(s)
+            cookie["window"] = {
+                str(minute): {
+                    label or "": s.to_dict()
+                    for label, s in slot.items()
+                    if s.requests
+                }
+                for minute, slot in window.items()
+            }
+            start = cookie.setdefault("window_start", now)
+        local_now = now_minute(now) * 60 + now % 60
+        span = now - start
+        if window:
+            span = max(span, local_now - min(window) * 60)
+        span = min(local_now - oldest * 60, span)
+        return self.merged(window), max(span, 1)
 
-    def request_rate(self, records):
+    def request_rate(self, requests):
         """Create request rate metric (does not depend on url filters).
 
         In its current implementation, the request rate computation lies
@@ -78,30 +263,24 @@ class HAProxyLog(nagiosplugin.Resource):
             timedelta = max((now - last_run).total_seconds(), 1)
             return nagiosplugin.Metric(
                 "rate",
-                len(records) / timedelta,
+                requests / timedelta,
                 "req/s",
                 min=0,
                 context="default",
             )
 
-    def filtered(self, prefix, records):
-        """Return sub-list of `records` where url paths start with `prefix`."""
-        prefix = prefix.encode() if isinstance(prefix, str) else prefix
-        matches = [url.startswith(prefix) for url in records["url"]]
-        return records.compress(matches, axis=0)
-
-    def metrics(self, label, records):
-        """Compute metrics for a set of `records`."""
+    def metrics(self, label, stats):
+        """Compute metrics for a RequestStats object."""
         if label:
             name = lambda metric: "{} {}".format(label, metric)
         else:
             name = lambda metric: metric
-        requests = len(records)
+        requests = stats.requests
         if requests:
             for pct in self.percentiles:
                 yield nagiosplugin.Metric(
                     name("t_tot%s" % pct),
-                    numpy.percentile(records["t_tot"], int(pct)) / 1000,
+                    stats.t_tot.percentile(int(pct)) / 1000,
                     "s",
                     min=0,
                     context="t_tot%s" % pct,
@@ -111,7 +290,7 @@ class HAProxyLog(nagiosplugin.Resource):
                 "no requests found%s - skipping timing metrics",
                 " for " + label if label else "",
             )
-        errors = 100 * numpy.sum(records["err"] / requests) if requests else 0
+        errors = 100 * stats.errors / requests if requests else 0
         yield nagiosplugin.Metric(
             name("http_errors"), errors, "%", 0, 100, context="http_errors"
         )
@@ -120,10 +299,22 @@ class HAProxyLog(nagiosplugin.Resource):
         )
 
     def probe(self):
-        req = self.parse()
-        metrics = [self.request_rate(req)]
-        for label, prefix in self.url_filters.items():
-            metrics += list(self.metrics(label, self.filtered(prefix, req)))
+        slots = self.parse()
+        if self.window:
+            stats, span = self.windowed(slots)
+            rate = nagiosplugin.Metric(
+                "rate",
+                stats[None].requests / span,
+                "req/s",
+                min=0,
+                context="default",
+            )
+        else:
+            stats = self.merged(slots)
+            rate = self.request_rate(stats[None].requests)
+        metrics = [rate]
+        for label in self.url_filters:
+            metrics += list(self.metrics(label, stats[label]))
         return metrics
 
 
@@ -132,12 +323,20 @@ class HAProxyLogSummary(nagiosplugin.Summary):
         self.key = "t_tot%s" % percentiles[0]
 
     def ok(self, results):
+        if "rate" not in results:
+            return super().ok(results)
         summary = "request rate is {}".format(results["rate"].metric.valueunit)
         if self.key in results:
             summary += " - " + str(results[self.key])
         return summary
 
 
+def now_minute(now=None):
+    """Current minute in the same local time scale as log timestamps."""
+    now = datetime.datetime.fromtimestamp(now or time.time())
+    return calendar.timegm(now.timetuple()) // 60
+
+
 class ReNull(object):
     def search(self, str):
         return None
@@ -147,11 +346,15 @@ def parse_args():
     argp = argparse.ArgumentParser(
         epilog="""
 If one or more -f options are given, requests statistics are computed
-independently for each class of requests starting with URLPREFIX. URL prefix
-filtering considers only the first 80 characters of the URL path. If no -f
-options are given, all requests are counted."""
+independently for each class of requests starting with URLPREFIX. If no -f
+options are given, all requests are counted. Percentiles are estimated with a
+relative error of at most 1%.
+
+With --stats-socket, per backend request rate, error ratio, queue length and
+timing averages are read from HAProxy's stats socket. LOGFILE may be omitted
+in this case."""
     )
-    argp.add_argument("logfile", metavar="LOGFILE")
+    argp.add_argument("logfile", metavar="LOGFILE", nargs="?")
     argp.add_argument("--ew", "--error-warning", metavar="RANGE", default="")
     argp.add_argument("--ec", "--error-critical", metavar="RANGE", default="")
     argp.add_argument(
@@ -204,6 +407,32 @@ options are given, all requests are counted."""
         help="filter URLs into labeled buckets and compute "
         "statistics for each bucket",
     )
+    argp.add_argument(
+        "-W",
+        "--window",
+        metavar="MINUTES",
+        type=int,
+        default=0,
+        help="compute statistics over the requests of the last MINUTES "
+        "instead of only those logged since the last run",
+    )
+    argp.add_argument(
+        "-S",
+        "--stats-socket",
+        metavar="PATH",
+        nargs="?",
+        const=DEFAULT_SOCKET,
+        help="query per backend statistics from HAProxy's stats socket "
+        '(default: "%(const)s")',
+    )
+    argp.add_argument(
+        "-b",
+        "--backend",
+        metavar="NAME",
+        action="append",
+        default=[],
+        help="only report these backends from the stats socket",
+    )
     argp.add_argument(
         "-e",
         "--exclude",
@@ -212,7 +441,10 @@ options are given, all requests are counted."""
         default=[],
         help="exclude log lines matching given pattern",
     )
-    return argp.parse_args()
+    args = argp.parse_args()
+    if not args.logfile and not args.stats_socket:
+        argp.error("LOGFILE or --stats-socket required")
+    return args
 
 
 @nagiosplugin.guarded
@@ -227,16 +459,26 @@ def main():
     for pattern in args.exclude:
         exclude_patterns.append(pattern)
     check = nagiosplugin.Check(
-        HAProxyLog(
-            args.logfile,
-            args.state_file,
-            percentiles,
-            url_filters,
-            exclude_patterns,
-        ),
         nagiosplugin.ScalarContext("http_errors", args.ew, args.ec),
         HAProxyLogSummary(percentiles),
     )
+    if args.logfile:
+        check.add(
+            HAProxyLog(
+                args.logfile,
+                args.state_file,
+                percentiles,
+                url_filters,
+                exclude_patterns,
+                args.window,
+            )
+        )
+    if args.stats_socket:
+        check.add(
+            HAProxyStats(
+                args.stats_socket, args.state_file, args.backend or None
+            )
+        )
     for pct, i in zip(percentiles, itertools.count()):
         check.add(
             nagiosplugin.ScalarContext(
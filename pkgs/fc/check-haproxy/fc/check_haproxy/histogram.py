@@ -0,0 +1,91 @@
+"""Streaming percentile estimation with bounded memory.
+
+Values are counted in logarithmically sized buckets so that any
+percentile can be estimated with a relative error of at most `accuracy`.
+The number of buckets only depends on the range of values, not on their
+number. Histograms with the same accuracy can be merged, which allows
+computing percentiles over several independently collected batches.
+"""
+
+import math
+
+DEFAULT_ACCURACY = 0.01
+
+
+class Histogram(object):
+    """Log-bucketed histogram of non-negative values."""
+
+    def __init__(self, accuracy=DEFAULT_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero = 0
+        self.count = 0
+
+    def add(self, value, n=1):
+        self.count += n
+        if value <= 0:
+            self.zero += n
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + n
+
+    def update(self, other):
+        """Merges counts of `other` into this histogram."""
+        if other.accuracy != self.accuracy:
+            raise ValueError(
+                "cannot merge histograms of different accuracy",
+                self.accuracy,
+                other.accuracy,
+            )
+        self.count += other.count
+        self.zero += other.zero
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+
+    def value(self, index):
+        """Representative value of bucket `index`."""
+        return 2 * self.gamma**index / (self.gamma + 1)
+
+    def _rank_value(self, rank):
+        """Estimated value of the `rank`th smallest element (0-based)."""
+        seen = self.zero
+        if seen > rank:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return self.value(index)
+        return self.value(max(self.buckets))
+
+    def percentile(self, pct):
+        """Estimates the `pct`th percentile (0-100).
+
+        Interpolates linearly between the closest ranks like
+        `numpy.percentile`. Returns None if the histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = pct / 100 * (self.count - 1)
+        lower = math.floor(rank)
+        value = self._rank_value(lower)
+        if rank > lower:
+            upper = self._rank_value(lower + 1)
+            value += (upper - value) * (rank - lower)
+        return value
+
+    def to_dict(self):
+        return {
+            "accuracy": self.accuracy,
+            "zero": self.zero,
+            "buckets": {str(i): n for i, n in self.buckets.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        hist = cls(data["accuracy"])
+        hist.zero = data["zero"]
+        hist.buckets = {int(i): n for i, n in data["buckets"].items()}
+        hist.count = hist.zero + sum(hist.buckets.values())
+        return hist
@@ -0,0 +1,69 @@
+"""Access previously unseen parts of a growing log file in large chunks.
+
+Works like `nagiosplugin.LogTail` and shares its cookie format, but maps
+the file into memory instead of creating an object per line. Callers
+get the mapped file along with ranges that consist of complete lines and
+can run bytes regexes over them with `pos` and `endpos`.
+"""
+
+import mmap
+import os
+
+CHUNKSIZE = 2**24
+
+
+class LogTail(object):
+    def __init__(self, path, cookie, chunksize=CHUNKSIZE):
+        self.path = os.path.abspath(path)
+        self.cookie = cookie
+        self.chunksize = chunksize
+        self.pos = 0
+        self.inode = None
+        self._file = None
+        self._map = None
+
+    def __enter__(self):
+        """Seeks to the last seen position and yields new chunks.
+
+        If the log file has been rotated or truncated since the last
+        invocation, it is read from the beginning. A partial last line
+        is left for the next invocation. After leaving the context, the
+        position after the last chunk is saved in the cookie.
+
+        :yields: tuples (data, start, end)
+        """
+        self._file = open(self.path, "rb")
+        self.cookie.open()
+        stat = os.fstat(self._file.fileno())
+        self.inode = stat.st_ino
+        fileinfo = self.cookie.get(self.path, {})
+        if fileinfo.get("inode", -1) == stat.st_ino and stat.st_size >= (
+            fileinfo.get("pos", 0)
+        ):
+            self.pos = fileinfo["pos"]
+        if stat.st_size > self.pos:
+            self._map = mmap.mmap(
+                self._file.fileno(), stat.st_size, access=mmap.ACCESS_READ
+            )
+        return self.chunks(stat.st_size)
+
+    def chunks(self, size):
+        data = self._map
+        while self.pos < size:
+            end = data.rfind(b"\n", self.pos, self.pos + self.chunksize) + 1
+            if not end:
+                # Very long line, or partial line at the end.
+                end = data.find(b"\n", self.pos + self.chunksize, size) + 1
+                if not end:
+                    return
+            start, self.pos = self.pos, end
+            yield data, start, end
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not exc_type:
+            self.cookie[self.path] = dict(inode=self.inode, pos=self.pos)
+            self.cookie.commit()
+        self.cookie.close()
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
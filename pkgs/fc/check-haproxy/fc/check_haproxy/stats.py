@@ -0,0 +1,171 @@
+"""Request statistics from the HAProxy stats socket.
+
+Queries `show info` and `show stat` over HAProxy's local admin socket.
+Counters are compared with the values saved in the state file during the
+last run to compute rates and error ratios per backend.
+"""
+
+import csv
+import logging
+import socket
+import time
+
+import nagiosplugin
+
+DEFAULT_SOCKET = "/run/haproxy/haproxy.sock"
+_log = logging.getLogger("nagiosplugin")
+RESPONSE_CLASSES = ["hrsp_1xx", "hrsp_2xx", "hrsp_3xx", "hrsp_4xx"]
+RESPONSE_CLASSES += ["hrsp_5xx", "hrsp_other"]
+COUNTERS = ["stot", "req_tot"] + RESPONSE_CLASSES
+
+
+def query(path, command, timeout=10):
+    """Sends `command` to the stats socket at `path` and returns output."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(command.encode() + b"\n")
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+    return b"".join(chunks).decode("iso-8859-1")
+
+
+def parse_info(output):
+    info = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition(":")
+        if sep:
+            info[key.strip()] = value.strip()
+    return info
+
+
+def parse_stat(output):
+    """Returns list of dicts, one per proxy/server line of `show stat`."""
+    lines = output.splitlines()
+    if not lines or not lines[0].startswith("# "):
+        raise ValueError("unexpected show stat output", output[:200])
+    lines[0] = lines[0][2:]
+    return [row for row in csv.DictReader(lines) if row.get("pxname")]
+
+
+def number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class HAProxyStats(nagiosplugin.Resource):
+    """Per backend request rate, error ratio, queue and timings."""
+
+    def __init__(self, path, statefile, backends=None):
+        self.path = path
+        self.statefile = statefile
+        self.backends = backends
+
+    def counters(self, row):
+        return {c: number(row.get(c)) for c in COUNTERS}
+
+    def metrics(self, name, row, previous, elapsed):
+        """Computes metrics of a single backend.
+
+        `previous` holds the counters of the last run (or None).
+        """
+        current = self.counters(row)
+        if previous:
+            delta = {}
+            for c, value in current.items():
+                if value is None or previous.get(c) is None:
+                    delta[c] = None
+                elif value < previous[c]:
+                    # Counters have been reset in the meantime.
+                    delta[c] = value
+                else:
+                    delta[c] = value - previous[c]
+            requests = delta["req_tot"]
+            if requests is None:
+                requests = delta["stot"]
+            if requests is not None:
+                yield nagiosplugin.Metric(
+                    "{} rate".format(name),
+                    requests / elapsed,
+                    "req/s",
+                    min=0,
+                    context="default",
+                )
+            responses = [delta[c] for c in RESPONSE_CLASSES]
+            if None not in responses:
+                total = sum(responses)
+                ok = delta["hrsp_2xx"] + delta["hrsp_3xx"]
+                errors = 100 * (total - ok) / total if total else 0
+                yield nagiosplugin.Metric(
+                    "{} http_errors".format(name),
+                    errors,
+                    "%",
+                    0,
+                    100,
+                    context="http_errors",
+                )
+        qcur = number(row.get("qcur"))
+        if qcur is not None:
+            yield nagiosplugin.Metric(
+                "{} queue".format(name), qcur, min=0, context="default"
+            )
+        # Averages over the last 1024 requests in ms.
+        for timing in ["qtime", "ctime", "rtime", "ttime"]:
+            value = number(row.get(timing))
+            if value is not None:
+                yield nagiosplugin.Metric(
+                    "{} {}".format(name, timing),
+                    value / 1000,
+                    "s",
+                    min=0,
+                    context="default",
+                )
+
+    def probe(self):
+        _log.info("querying HAProxy stats socket %s", self.path)
+        info = parse_info(query(self.path, "show info"))
+        rows = parse_stat(query(self.path, "show stat"))
+        now = time.time()
+        uptime = number(info.get("Uptime_sec"))
+        metrics = []
+        conns = number(info.get("CurrConns"))
+        if conns is not None:
+            metrics.append(
+                nagiosplugin.Metric(
+                    "connections", conns, min=0, context="default"
+                )
+            )
+        with nagiosplugin.Cookie(self.statefile) as cookie:
+            state = cookie.get("stats", {})
+            last = state.get("time")
+            elapsed = now - last if last else None
+            if not elapsed or elapsed <= 0:
+                _log.info("no previous stats in state file")
+                previous = {}
+            elif uptime is not None and uptime < elapsed:
+                _log.info("HAProxy restarted since last run")
+                previous = {}
+            else:
+                previous = state.get("backends", {})
+            backends = {}
+            for row in rows:
+                if row.get("svname") != "BACKEND":
+                    continue
+                name = row["pxname"]
+                if self.backends and name not in self.backends:
+                    continue
+                backends[name] = self.counters(row)
+                metrics.extend(
+                    self.metrics(name, row, previous.get(name), elapsed)
+                )
+            cookie["stats"] = {"time": now, "backends": backends}
+        return metrics
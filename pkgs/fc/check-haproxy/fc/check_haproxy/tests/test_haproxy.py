@@ -0,0 +1,179 @@
+import datetime
+import json
+import random
+
+import numpy
+import pytest
+from fc.check_haproxy.haproxy import HAProxyLog, PrefixIndex
+
+LINE = (
+    "Mar  1 12:00:00 lb haproxy[1234]: 10.0.0.1:4711 "
+    "[{date}.123] http-in app/app0 "
+    "0/0/1/{t_r}/{t_tot} {status} 512 - - ---- 1/1/0/0/0 0/0 "
+    '"GET {url} HTTP/1.1"\n'
+)
+
+
+def logline(t_tot, status=200, url="/index.html", minutes_ago=None):
+    if minutes_ago is None:
+        date = "01/Mar/2021:12:00:00"
+    else:
+        date = (
+            datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago)
+        ).strftime("%d/%b/%Y:%H:%M:%S")
+    return LINE.format(
+        date=date,
+        t_r=max(t_tot - 1, 0),
+        t_tot=t_tot,
+        status=status,
+        url=url,
+    )
+
+
+@pytest.fixture
+def requests():
+    rnd = random.Random(42)
+    result = []
+    for _ in range(5000):
+        url = rnd.choice(
+            ["/index.html", "/api/items", "/api/users/1", "/static/x.css"]
+        )
+        status = rnd.choice([200] * 20 + [302, 404, 500])
+        result.append((int(rnd.lognormvariate(4, 1)), status, url))
+    return result
+
+
+@pytest.fixture
+def logfile(tmpdir, requests):
+    path = str(tmpdir / "haproxy.log")
+    with open(path, "w") as f:
+        f.write("Mar  1 12:00:00 lb haproxy[1234]: Proxy app started.\n")
+        for t_tot, status, url in requests:
+            f.write(logline(t_tot, status, url))
+    return path
+
+
+def check(logfile, tmpdir, url_filters=None, exclude=None, window=0):
+    return HAProxyLog(
+        logfile,
+        str(tmpdir / "state"),
+        ["50", "95"],
+        url_filters,
+        exclude,
+        window,
+    )
+
+
+def metrics(log):
+    return {m.name: m.value for m in log.probe()}
+
+
+def assert_percentile(estimate, values, pct):
+    exact = numpy.percentile(values, pct) / 1000
+    assert estimate == pytest.approx(exact, rel=0.01)
+
+
+def test_percentiles_match_exact_values(logfile, tmpdir, requests):
+    result = metrics(check(logfile, tmpdir))
+    t_tot = [r[0] for r in requests]
+    for pct in [50, 95]:
+        assert_percentile(result["t_tot%s" % pct], t_tot, pct)
+    errors = sum(1 for r in requests if r[1] >= 400)
+    assert result["http_errors"] == pytest.approx(100 * errors / len(requests))
+    assert result["requests"] == len(requests)
+
+
+def test_url_filters(logfile, tmpdir, requests):
+    result = metrics(
+        check(logfile, tmpdir, {"api": "/api/", "users": "/api/users/"})
+    )
+    api = [r for r in requests if r[2].startswith("/api/")]
+    users = [r for r in requests if r[2].startswith("/api/users/")]
+    assert result["api requests"] == len(api)
+    assert result["users requests"] == len(users)
+    assert_percentile(result["users t_tot95"], [r[0] for r in users], 95)
+
+
+def test_exclude_patterns(logfile, tmpdir, requests):
+    result = metrics(check(logfile, tmpdir, exclude=["static/", "/api/i"]))
+    expected = [r for r in requests if r[2] in ("/index.html", "/api/users/1")]
+    assert result["requests"] == len(expected)
+
+
+def test_only_new_lines_are_parsed(logfile, tmpdir):
+    log = check(logfile, tmpdir)
+    metrics(log)
+    with open(logfile, "a") as f:
+        f.write(logline(100))
+        f.write(logline(300, status=503))
+    result = metrics(log)
+    assert result["requests"] == 2
+    assert result["http_errors"] == 50
+    assert_percentile(result["t_tot95"], [100, 300], 95)
+
+
+def test_no_requests(logfile, tmpdir):
+    log = check(logfile, tmpdir)
+    metrics(log)
+    result = metrics(log)
+    assert result["requests"] == 0
+    assert "t_tot50" not in result
+
+
+def test_prefix_index_finds_all_matching_labels():
+    index = PrefixIndex(
+        {"all": "/", "api": "/api/", "users": "/api/users/", "v2": "/api/v2"}
+    )
+    assert sorted(index.labels("/api/users/1")) == ["all", "api", "users"]
+    assert sorted(index.labels("/api/v2/x")) == ["all", "api", "v2"]
+    assert index.labels("/index.html") == ["all"]
+    assert index.labels("/ap") == ["all"]
+
+
+def test_prefix_index_same_prefix_for_several_labels():
+    index = PrefixIndex({"a": "/x", "b": "/x"})
+    assert sorted(index.labels("/xyz")) == ["a", "b"]
+
+
+def test_window_reports_over_previous_runs(tmpdir):
+    logfile = str(tmpdir / "haproxy.log")
+    with open(logfile, "w") as f:
+        f.write(logline(1000, minutes_ago=10))
+        f.write(logline(100, minutes_ago=2))
+        f.write(logline(200, url="/api/x", minutes_ago=0))
+    log = check(logfile, tmpdir, {"api": "/api/", "all": "/"}, window=5)
+    result = metrics(log)
+    assert result["all requests"] == 2
+    assert result["api requests"] == 1
+    with open(logfile, "a") as f:
+        f.write(logline(300, status=500, minutes_ago=0))
+    result = metrics(log)
+    assert result["all requests"] == 3
+    assert result["all http_errors"] == pytest.approx(100 / 3)
+    assert_percentile(result["all t_tot50"], [100, 200, 300], 50)
+    assert result["rate"] > 0
+
+
+def test_window_drops_old_minutes_from_state(tmpdir):
+    logfile = str(tmpdir / "haproxy.log")
+    with open(logfile, "w") as f:
+        for minutes_ago in range(10):
+            f.write(logline(100, minutes_ago=minutes_ago))
+    result = metrics(check(logfile, tmpdir, window=3))
+    # May be 2 if the minute changes while running the test.
+    assert result["requests"] in (2, 3)
+    with open(str(tmpdir / "state")) as f:
+        state = json.load(f)
+    assert len(state["window"]) <= 3
+
+
+def test_window_rate_on_first_run(tmpdir):
+    logfile = str(tmpdir / "haproxy.log")
+    with open(logfile, "w") as f:
+        for minutes_ago in range(5):
+            for _ in range(60):
+                f.write(logline(100, minutes_ago=minutes_ago))
+    result = metrics(check(logfile, tmpdir, window=10))
+    assert result["requests"] == 300
+    # 300 requests spread over 4-5 minutes, not within a single second.
+    assert 0.9 <= result["rate"] <= 1.3
@@ -0,0 +1,64 @@
+import json
+import random
+
+import numpy
+import pytest
+from fc.check_haproxy.histogram import Histogram
+
+
+def samples(n, seed):
+    rnd = random.Random(seed)
+    # Mostly fast requests with a long tail, like real response times.
+    return [
+        int(rnd.lognormvariate(4, 1.5)) if rnd.random() > 0.01 else 0
+        for _ in range(n)
+    ]
+
+
+@pytest.mark.parametrize("pct", [0, 1, 50, 90, 95, 99, 99.9, 100])
+def test_percentile_within_accuracy(pct):
+    values = samples(50000, 1)
+    hist = Histogram()
+    for v in values:
+        hist.add(v)
+    exact = numpy.percentile(values, pct)
+    assert hist.percentile(pct) == pytest.approx(exact, rel=hist.accuracy)
+
+
+def test_memory_does_not_depend_on_count():
+    hist = Histogram()
+    for v in samples(100000, 2):
+        hist.add(v)
+    assert hist.count == 100000
+    assert len(hist.buckets) < 1000
+
+
+def test_merged_histograms_equal_single_pass():
+    values = samples(20000, 3)
+    a, b, total = Histogram(), Histogram(), Histogram()
+    for i, v in enumerate(values):
+        (a if i % 2 else b).add(v)
+        total.add(v)
+    a.update(b)
+    assert a.count == total.count
+    assert a.buckets == total.buckets
+    assert a.percentile(95) == total.percentile(95)
+
+
+def test_merge_rejects_different_accuracy():
+    with pytest.raises(ValueError):
+        Histogram(0.01).update(Histogram(0.02))
+
+
+def test_empty_histogram_has_no_percentiles():
+    assert Histogram().percentile(50) is None
+
+
+def test_serialization_roundtrip():
+    hist = Histogram()
+    for v in [0, 1, 10, 100, 1000, 1000]:
+        hist.add(v)
+    copy = Histogram.from_dict(json.loads(json.dumps(hist.to_dict())))
+    assert copy.count == 6
+    assert copy.buckets == hist.buckets
+    assert copy.percentile(50) == hist.percentile(50)
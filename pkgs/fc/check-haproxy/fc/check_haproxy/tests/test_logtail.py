@@ -0,0 +1,68 @@
+import os
+
+import nagiosplugin
+import pytest
+from fc.check_haproxy.logtail import LogTail
+
+
+@pytest.fixture
+def logfile(tmpdir):
+    path = str(tmpdir / "log")
+    with open(path, "wb") as f:
+        f.write(b"one\ntwo\nthree\n")
+    return path
+
+
+def read(logfile, chunksize=1024):
+    cookie = nagiosplugin.Cookie(os.path.dirname(logfile) + "/state")
+    with LogTail(logfile, cookie, chunksize) as chunks:
+        return [bytes(data[start:end]) for data, start, end in chunks]
+
+
+def test_chunks_contain_complete_lines(logfile):
+    assert read(logfile, chunksize=6) == [b"one\n", b"two\n", b"three\n"]
+
+
+def test_long_lines_exceed_chunksize(logfile):
+    assert read(logfile, chunksize=2) == [b"one\n", b"two\n", b"three\n"]
+
+
+def test_only_new_lines_are_read(logfile):
+    assert read(logfile) == [b"one\ntwo\nthree\n"]
+    assert read(logfile) == []
+    with open(logfile, "ab") as f:
+        f.write(b"four\nfi")
+    assert read(logfile) == [b"four\n"]
+    with open(logfile, "ab") as f:
+        f.write(b"ve\n")
+    assert read(logfile) == [b"five\n"]
+
+
+def test_rotated_file_is_read_from_start(logfile):
+    read(logfile)
+    os.rename(logfile, logfile + ".1")
+    with open(logfile, "wb") as f:
+        f.write(b"new\n")
+    assert read(logfile) == [b"new\n"]
+
+
+def test_truncated_file_is_read_from_start(logfile):
+    read(logfile)
+    with open(logfile, "wb") as f:
+        f.write(b"new\n")
+    assert read(logfile) == [b"new\n"]
+
+
+def test_empty_file(tmpdir):
+    path = str(tmpdir / "empty")
+    open(path, "wb").close()
+    assert read(path) == []
+
+
+def test_cookie_compatible_with_nagiosplugin(logfile):
+    read(logfile)
+    with open(logfile, "ab") as f:
+        f.write(b"four\n")
+    cookie = nagiosplugin.Cookie(os.path.dirname(logfile) + "/state")
+    with nagiosplugin.LogTail(logfile, cookie) as lines:
+        assert list(lines) == [b"four\n"]
@@ -0,0 +1,119 @@
+import socketserver
+import threading
+
+import pytest
+from fc.check_haproxy.stats import HAProxyStats, parse_stat, query
+
+HEADER = (
+    "# pxname,svname,qcur,qmax,scur,smax,slim,stot,status,hrsp_1xx,"
+    "hrsp_2xx,hrsp_3xx,hrsp_4xx,hrsp_5xx,hrsp_other,req_tot,qtime,ctime,"
+    "rtime,ttime,\n"
+)
+
+
+def show_stat(stot, hrsp, req_tot, qcur=0):
+    return HEADER + "".join(
+        [
+            "http-in,FRONTEND,,,1,5,2000,{},OPEN,,,,,,,,,,,,\n".format(stot),
+            "app,app0,0,0,0,3,,{},UP,0,{},{},{},{},0,,1,0,20,25,\n".format(
+                stot, *hrsp
+            ),
+            "app,BACKEND,{},2,0,3,200,{},UP,0,{},{},{},{},0,{},1,0,20,25,\n".format(
+                qcur, stot, *hrsp, req_tot
+            ),
+            "tcp,BACKEND,0,0,0,1,200,{},UP,,,,,,,,0,1,0,30,\n".format(stot),
+        ]
+    )
+
+
+class FakeHAProxy(socketserver.ThreadingUnixStreamServer):
+    """Answers stats socket commands with canned output."""
+
+    def __init__(self, path):
+        self.responses = {
+            "show info": "Name: HAProxy\nUptime_sec: 100000\nCurrConns: 7\n",
+            "show stat": show_stat(100, (80, 10, 5, 5), 100),
+        }
+        self.commands = []
+        super().__init__(path, Handler)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline().decode().strip()
+        self.server.commands.append(command)
+        self.wfile.write(self.server.responses[command].encode())
+
+
+@pytest.fixture
+def haproxy(tmpdir):
+    path = str(tmpdir / "haproxy.sock")
+    server = FakeHAProxy(path)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def metrics(haproxy, tmpdir, backends=None):
+    stats = HAProxyStats(
+        haproxy.server_address, str(tmpdir / "state"), backends
+    )
+    return {m.name: m.value for m in stats.probe()}
+
+
+def test_query(haproxy):
+    assert query(haproxy.server_address, "show info").startswith("Name:")
+    assert haproxy.commands == ["show info"]
+
+
+def test_parse_stat():
+    rows = parse_stat(show_stat(1, (1, 0, 0, 0), 1))
+    assert [(r["pxname"], r["svname"]) for r in rows] == [
+        ("http-in", "FRONTEND"),
+        ("app", "app0"),
+        ("app", "BACKEND"),
+        ("tcp", "BACKEND"),
+    ]
+    with pytest.raises(ValueError):
+        parse_stat("Unknown command.\n")
+
+
+def test_first_run_reports_gauges_only(haproxy, tmpdir):
+    result = metrics(haproxy, tmpdir)
+    assert result["connections"] == 7
+    assert result["app queue"] == 0
+    assert result["app ttime"] == 0.025
+    assert result["tcp ttime"] == 0.03
+    assert "app rate" not in result
+    assert "app http_errors" not in result
+
+
+def test_counters_are_diffed_against_last_run(haproxy, tmpdir):
+    metrics(haproxy, tmpdir)
+    haproxy.responses["show stat"] = show_stat(
+        300, (140, 30, 55, 75), 300, qcur=3
+    )
+    result = metrics(haproxy, tmpdir)
+    assert result["app rate"] > 0
+    # 80 of 200 new requests were 2xx/3xx.
+    assert result["app http_errors"] == 60
+    assert result["app queue"] == 3
+    assert result["tcp rate"] > 0
+    assert "tcp http_errors" not in result
+
+
+def test_restart_discards_previous_counters(haproxy, tmpdir):
+    metrics(haproxy, tmpdir)
+    haproxy.responses["show info"] = "Uptime_sec: 0\nCurrConns: 1\n"
+    assert "app rate" not in metrics(haproxy, tmpdir)
+
+
+def test_backend_selection(haproxy, tmpdir):
+    result = metrics(haproxy, tmpdir, ["tcp"])
+    assert "app queue" not in result
+    assert "tcp queue" in result
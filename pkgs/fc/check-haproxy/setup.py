@@ -12,7 +12,7 @@ setup(
         "Programming Language :: Python :: 3.7",
     ],
     packages=["fc.check_haproxy"],
-    install_requires=["nagiosplugin", "numpy"],
+    install_requires=["nagiosplugin"],
     entry_points={
         "console_scripts": [
             "check_haproxy=fc.check_haproxy.haproxy:main",
@@ -8,7 +8,7 @@ rec {
 
   check-age = callPackage ./check-age {};
   # XXX: ceph is broken, needs integration of changes from 21.05
-  # check-ceph = callPackage ./check-ceph {};
+  # check-ceph = callPackage ./check-ceph { inherit sharedcache; };
   check-haproxy = callPackage ./check-haproxy {};
   check-journal = callPackage ./check-journal.nix {};
   check-mongodb = callPackage ./check-mongodb {};
@@ -16,17 +16,19 @@ rec {
   # XXX: ceph is broken, needs integration of changes from 21.05
   # ceph = callPackage ./ceph { inherit blockdev agent util-physical; };
   check-xfs-broken = callPackage ./check-xfs-broken {};
-  blockdev = callPackage ./blockdev {};
+  blockdev = callPackage ./blockdev { inherit megacli-inventory; };
   roundcube-chpasswd = callPackage ./roundcube-chpasswd {};
   roundcube-chpasswd-py = callPackage ./roundcube-chpasswd-py {};
   fix-so-rpath = callPackage ./fix-so-rpath {};
   logcheckhelper = callPackage ./logcheckhelper { };
   # XXX: needs Python 2.7, untested on newer platform versions.
   # megacli = callPackage ./megacli { };
+  megacli-inventory = callPackage ./megacli-inventory { inherit sharedcache; };
   multiping = callPackage ./multiping.nix {};
   secure-erase = callPackage ./secure-erase {};
-  sensuplugins = callPackage ./sensuplugins {};
+  sensuplugins = callPackage ./sensuplugins { inherit megacli-inventory; };
   sensusyntax = callPackage ./sensusyntax {};
+  sharedcache = callPackage ./sharedcache {};
   userscan = callPackage ./userscan.nix {};
   # XXX: ceph is broken, needs integration of changes from 21.05
   # util-physical = callPackage ./util-physical {};
@@ -0,0 +1,22 @@
+{ python3Packages, sharedcache }:
+
+let
+  py = python3Packages;
+
+in
+  py.buildPythonPackage rec {
+    name = "fc-megacli-inventory-${version}";
+    version = "1.0";
+    src = ./.;
+    propagatedBuildInputs = [
+      sharedcache
+    ];
+
+    checkInputs = [
+      py.pytest
+    ];
+
+    checkPhase = ''
+      pytest fc/megacli_inventory
+    '';
+  }
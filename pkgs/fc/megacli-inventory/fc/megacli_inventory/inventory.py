@@ -0,0 +1,224 @@
+"""Shared, cached inventory of MegaRAID controllers.
+
+MegaCli is slow on large controllers and invocations serialize on the
+controller firmware. The inventory queries logical drives with their
+physical drives and the BBU status of all adapters once, parses the
+output and keeps the result in a JSON cache file. Consumers running
+within the cache's max age reuse it instead of calling MegaCli again.
+
+Cache layout::
+
+    {
+        "time": 1700000000.0,
+        "logical_drives": [
+            {"adapter": 0, "id": 0, "properties": {...},
+             "physical_drives": [{...}, ...]},
+            ...
+        ],
+        "bbu": {"present": true, "adapters": [{"adapter": 0, ...}]}
+    }
+
+Properties are MegaCli's "key: value" pairs as printed.
+"""
+
+import argparse
+import json
+import logging
+import re
+import subprocess
+import sys
+import time
+
+from fc.sharedcache.cache import SharedCache
+
+_log = logging.getLogger("nagiosplugin")
+
+DEFAULT_MEGACLI = "MegaCli64"
+DEFAULT_CACHE = "/run/megacli-inventory.json"
+DEFAULT_MAX_AGE = 60
+# MegaCli exit code if there is no BBU.
+NO_BBU = 34
+
+r_adapter = re.compile(r"^Adapter #(\d+)")
+r_bbu_adapter = re.compile(r"^BBU status for Adapter: (\d+)")
+r_pd = re.compile(r"^PD: \d+ Information")
+
+
+def key_values(line):
+    """Splits a MegaCli output line into (key, value) or returns None."""
+    key, sep, val = line.partition(":")
+    key = key.strip()
+    if not sep or not key:
+        return None
+    return key, val.strip()
+
+
+def parse_ldpdinfo(output):
+    """Parses `MegaCli -LdPdInfo -aALL` output into logical drives."""
+    lds = []
+    adapter = 0
+    ld = None
+    target = None
+    for line in output.splitlines():
+        m = r_adapter.match(line)
+        if m:
+            adapter = int(m.group(1))
+            ld = target = None
+            continue
+        if r_pd.match(line) and ld is not None:
+            target = {}
+            ld["physical_drives"].append(target)
+            continue
+        kv = key_values(line)
+        if not kv:
+            continue
+        key, val = kv
+        # Older MegaCli versions say "Virtual Disk".
+        if key in ("Virtual Drive", "Virtual Disk"):
+            ld = {
+                "adapter": adapter,
+                "id": int(val.split()[0]),
+                "properties": {},
+                "physical_drives": [],
+            }
+            lds.append(ld)
+            target = ld["properties"]
+            continue
+        if key == "Exit Code":
+            break
+        if target is not None:
+            target[key] = val
+    return lds
+
+
+def parse_bbu_status(output):
+    """Parses `MegaCli -AdpBbuCmd -GetBbuStatus -aALL` output."""
+    adapters = []
+    current = None
+    for line in output.splitlines():
+        m = r_bbu_adapter.match(line)
+        if m:
+            current = {"adapter": int(m.group(1))}
+            adapters.append(current)
+            continue
+        kv = key_values(line)
+        if current is not None and kv:
+            current.setdefault(*kv)
+    return adapters
+
+
+class Inventory(object):
+    """Adapter, logical and physical drive state, cached in `cache`."""
+
+    def __init__(
+        self, megacli=DEFAULT_MEGACLI, cache=None, max_age=DEFAULT_MAX_AGE
+    ):
+        self.megacli = megacli
+        self.cache = cache
+        self.max_age = max_age
+        self.cache_hit = False
+        self.data = None
+
+    def megacli_output(self, *args, ok=(0,)):
+        cmd = [self.megacli] + list(args)
+        _log.info('querying controller with "%s"', " ".join(cmd))
+        proc = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        if proc.returncode not in ok:
+            raise RuntimeError(
+                "MegaCli failed", cmd, proc.returncode, proc.stdout[-1000:]
+            )
+        return proc.returncode, proc.stdout.decode("ascii", "replace")
+
+    def fetch(self):
+        """Queries the controller."""
+        _, ldpd = self.megacli_output("-LdPdInfo", "-aALL")
+        rc, bbu = self.megacli_output(
+            "-AdpBbuCmd", "-GetBbuStatus", "-aALL", ok=(0, NO_BBU)
+        )
+        return {
+            "time": time.time(),
+            "logical_drives": parse_ldpdinfo(ldpd),
+            "bbu": {
+                "present": rc != NO_BBU,
+                "adapters": parse_bbu_status(bbu),
+            },
+        }
+
+    def _shared_cache(self):
+        return SharedCache(
+            self.cache,
+            self.max_age,
+            "MegaCli inventory",
+            loads=json.loads,
+            dumps=json.dumps,
+        )
+
+    def load(self):
+        if self.data is None:
+            if self.cache:
+                self.data, self.cache_hit = self._shared_cache().get(
+                    self.fetch
+                )
+            else:
+                self.data = self.fetch()
+        return self.data
+
+    def invalidate(self):
+        """Removes the cache, e.g. after changing controller settings."""
+        self.data = None
+        if self.cache:
+            self._shared_cache().invalidate()
+
+    @property
+    def logical_drives(self):
+        return self.load()["logical_drives"]
+
+    @property
+    def bbu(self):
+        return self.load()["bbu"]
+
+
+def main():
+    """Prints the inventory as JSON for consumers outside this package."""
+    a = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    a.add_argument(
+        "-m",
+        "--megacli",
+        metavar="PATH",
+        default=DEFAULT_MEGACLI,
+        help="MegaCli executable (default: %(default)s)",
+    )
+    a.add_argument(
+        "--cache",
+        metavar="PATH",
+        default=DEFAULT_CACHE,
+        help="cache inventory in PATH (default: %(default)s)",
+    )
+    a.add_argument(
+        "--cache-max-age",
+        metavar="SEC",
+        type=float,
+        default=DEFAULT_MAX_AGE,
+        help="query the controller if the cache is older than SEC seconds "
+        "(default: %(default)s)",
+    )
+    a.add_argument(
+        "--invalidate",
+        action="store_true",
+        help="remove the cache instead of printing the inventory",
+    )
+    args = a.parse_args()
+    logging.basicConfig(format="%(message)s")
+    inventory = Inventory(args.megacli, args.cache, args.cache_max_age)
+    if args.invalidate:
+        inventory.invalidate()
+        return
+    try:
+        data = inventory.load()
+    except (OSError, RuntimeError) as e:
+        print("fc-megacli-inventory: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    json.dump(data, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,159 @@
+import json
+import os
+import time
+
+import pytest
+from fc.megacli_inventory.inventory import (
+    Inventory,
+    parse_bbu_status,
+    parse_ldpdinfo,
+)
+
+HERE = os.path.dirname(__file__)
+
+# Replays recorded outputs and counts invocations.
+FAKE_MEGACLI = """\
+#!/bin/sh
+echo "$@" >> {calls}
+case "$1" in
+    -LdPdInfo) cat {ldpdinfo} ;;
+    -AdpBbuCmd) cat {bbu}; exit {bbu_rc} ;;
+esac
+"""
+
+
+def recorded(name):
+    with open(os.path.join(HERE, "megacli", name)) as f:
+        return f.read()
+
+
+@pytest.fixture
+def megacli(tmpdir):
+    def make(bbu="bbu_status.txt", bbu_rc=0):
+        path = str(tmpdir / "MegaCli64")
+        with open(path, "w") as f:
+            f.write(
+                FAKE_MEGACLI.format(
+                    calls=tmpdir / "calls",
+                    ldpdinfo=os.path.join(HERE, "megacli", "ldpdinfo.txt"),
+                    bbu=os.path.join(HERE, "megacli", bbu),
+                    bbu_rc=bbu_rc,
+                )
+            )
+        os.chmod(path, 0o755)
+        return path
+
+    return make
+
+
+def calls(tmpdir):
+    try:
+        return (tmpdir / "calls").read().splitlines()
+    except OSError:
+        return []
+
+
+def test_parse_ldpdinfo():
+    lds = parse_ldpdinfo(recorded("ldpdinfo.txt"))
+    assert [(ld["adapter"], ld["id"]) for ld in lds] == [(0, 0), (0, 1)]
+    assert lds[0]["properties"]["RAID Level"] == (
+        "Primary-1, Secondary-0, RAID Level Qualifier-0"
+    )
+    assert lds[1]["properties"]["Current Cache Policy"] == (
+        "WriteThrough, ReadAheadNone, Cached, No Write Cache if Bad BBU"
+    )
+    assert [
+        [pd["Media Type"] for pd in ld["physical_drives"]] for ld in lds
+    ] == [["Hard Disk Device", "Hard Disk Device"], ["Solid State Device"]]
+    assert lds[0]["physical_drives"][0]["Media Error Count"] == "3"
+    assert lds[0]["physical_drives"][1]["Slot Number"] == "1"
+    # Trailer does not end up in the last PD.
+    assert "Exit Code" not in lds[1]["physical_drives"][0]
+
+
+def test_parse_ldpdinfo_virtual_disk_multiple_adapters():
+    lds = parse_ldpdinfo("""\
+Adapter #0
+
+Virtual Disk: 0 (Target Id: 0)
+State: Optimal
+
+Adapter #1
+
+Virtual Disk: 0 (Target Id: 0)
+State: Degraded
+""")
+    assert [(ld["adapter"], ld["id"]) for ld in lds] == [(0, 0), (1, 0)]
+    assert [ld["properties"]["State"] for ld in lds] == [
+        "Optimal",
+        "Degraded",
+    ]
+    assert lds[0]["physical_drives"] == []
+
+
+def test_parse_bbu_status():
+    (adapter,) = parse_bbu_status(recorded("bbu_status.txt"))
+    assert adapter["adapter"] == 0
+    assert adapter["Battery State"] == "Optimal"
+    assert adapter["Battery Replacement required"] == "No"
+    # First occurrence wins for repeated keys.
+    assert adapter["Voltage"] == "4061 mV"
+
+
+def test_parse_bbu_status_missing():
+    assert parse_bbu_status(recorded("bbu_missing.txt")) == []
+
+
+def test_fetch(megacli, tmpdir):
+    inventory = Inventory(megacli())
+    assert [ld["id"] for ld in inventory.logical_drives] == [0, 1]
+    assert inventory.bbu["present"]
+    assert inventory.bbu["adapters"][0]["Battery State"] == "Optimal"
+    assert calls(tmpdir) == [
+        "-LdPdInfo -aALL",
+        "-AdpBbuCmd -GetBbuStatus -aALL",
+    ]
+
+
+def test_fetch_no_bbu(megacli):
+    inventory = Inventory(megacli("bbu_missing.txt", 34))
+    assert inventory.bbu == {"present": False, "adapters": []}
+
+
+def test_fetch_failure(megacli):
+    with pytest.raises(RuntimeError):
+        Inventory(megacli(bbu_rc=1)).load()
+
+
+def test_cache_shared(megacli, tmpdir):
+    cache = str(tmpdir / "inventory.json")
+    first = Inventory(megacli(), cache)
+    first.load()
+    assert not first.cache_hit
+    second = Inventory(megacli(), cache)
+    assert second.load() == first.load()
+    assert second.cache_hit
+    assert len(calls(tmpdir)) == 2
+    with open(cache) as f:
+        assert json.load(f) == first.load()
+
+
+def test_cache_expired(megacli, tmpdir):
+    cache = str(tmpdir / "inventory.json")
+    Inventory(megacli(), cache).load()
+    old = time.time() - 120
+    os.utime(cache, (old, old))
+    inventory = Inventory(megacli(), cache, max_age=60)
+    inventory.load()
+    assert not inventory.cache_hit
+    assert len(calls(tmpdir)) == 4
+
+
+def test_invalidate(megacli, tmpdir):
+    cache = str(tmpdir / "inventory.json")
+    inventory = Inventory(megacli(), cache)
+    inventory.load()
+    inventory.invalidate()
+    assert not os.path.exists(cache)
+    inventory.load()
+    assert len(calls(tmpdir)) == 4
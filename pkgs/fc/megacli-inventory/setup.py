@@ -0,0 +1,23 @@
+"""Shared, cached inventory of MegaRAID controllers."""
+
+from setuptools import setup
+
+setup(
+    name="fc.megacli_inventory",
+    version="1.0",
+    description=__doc__,
+    url="https://github.com/flyingcircus/nixpkgs",
+    author="Flying Circus Internet Operations GmbH",
+    author_email="mail@flyingcircus.io",
+    license="ZPL",
+    classifiers=[
+        "Programming Language :: Python :: 3.7",
+    ],
+    packages=["fc.megacli_inventory"],
+    install_requires=["fc.sharedcache"],
+    entry_points={
+        "console_scripts": [
+            "fc-megacli-inventory=fc.megacli_inventory.inventory:main",
+        ],
+    },
+)
@@ -0,0 +1,75 @@
+"""Benchmark check_interfaces with a fake sysfs tree.
+
+Usage: python benchmarks/interfaces.py [--interfaces N]
+
+Creates N fake ethernet interfaces and measures a full probe reading
+speed and duplex from sysfs versus one (fake) ethtool call per
+interface. The fake ethtool is a shell script, so the numbers do not
+include the sudo session the real check needs for each call.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from fc.sensuplugins.interfaces import Interfaces
+
+ETHTOOL = """\
+#!/bin/sh
+echo "Settings for $1:"
+echo "	Speed: 10000Mb/s"
+echo "	Duplex: Full"
+echo "	Link detected: yes"
+"""
+
+
+def fake_sysfs(root, count):
+    for i in range(count):
+        path = os.path.join(root, "eth{}".format(i))
+        os.makedirs(path)
+        for attr, value in [
+            ("flags", "0x1003"),
+            ("carrier", "1"),
+            ("speed", "10000"),
+            ("duplex", "full"),
+        ]:
+            with open(os.path.join(path, attr), "w") as f:
+                f.write(value + "\n")
+
+
+def probe(sysfs, ethtool=None):
+    interfaces = Interfaces([], True, [], sysfs=sysfs)
+    if ethtool:
+        interfaces.ethtool = [ethtool]
+        interfaces.query = interfaces.query_ethtool
+    return [(m.name, m.value) for m in interfaces.probe()]
+
+
+def timed(label, func, *args, runs=10):
+    started = time.perf_counter()
+    for _ in range(runs):
+        func(*args)
+    elapsed = (time.perf_counter() - started) / runs
+    print("{:<20} {:8.2f}ms".format(label, elapsed * 1000))
+
+
+def main():
+    argp = argparse.ArgumentParser()
+    argp.add_argument("--interfaces", type=int, default=8)
+    args = argp.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        sysfs = os.path.join(tmp, "net")
+        fake_sysfs(sysfs, args.interfaces)
+        ethtool = os.path.join(tmp, "ethtool")
+        with open(ethtool, "w") as f:
+            f.write(ETHTOOL)
+        os.chmod(ethtool, 0o755)
+        assert probe(sysfs) == probe(sysfs, ethtool)
+        print("{} interfaces".format(args.interfaces))
+        timed("sysfs", probe, sysfs)
+        timed("ethtool", probe, sysfs, ethtool)
+
+
+if __name__ == "__main__":
+    main()
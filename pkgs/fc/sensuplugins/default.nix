@@ -1,4 +1,4 @@
-{ pkgs, libyaml, iproute2, ethtool, python3Packages, megacli }:
+{ pkgs, libyaml, iproute2, ethtool, python3Packages, megacli, megacli-inventory }:
 
 let
   py = python3Packages;
@@ -19,5 +19,14 @@ in
       py.requests_toolbelt
       py.psutil
       py.pyyaml
+      megacli-inventory
     ];
+
+    checkInputs = [
+      py.pytest
+    ];
+
+    checkPhase = ''
+      pytest fc/sensuplugins
+    '';
   }
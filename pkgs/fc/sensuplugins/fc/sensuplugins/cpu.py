@@ -6,54 +6,197 @@ The main feature of this check is:
 - build an average over a period for all CPUs
 - allow selecting specific metrics to match
 
+CPU times are read from /proc/stat. The counters of the last run are
+kept in a state file, so the percentages cover the whole period since
+then. Without usable state, the counters are sampled for a short time.
+
 Could be / should be adapted to a plugin library at some point.
 """
 
 import argparse
+import json
 import logging
 import os
-import subprocess
 import sys
+import tempfile
+import time
 
 _log = logging.getLogger("nagiosplugin")
 
+# Column names as printed by mpstat, in /proc/stat order.
+FIELDS = [
+    "%usr",
+    "%nice",
+    "%sys",
+    "%iowait",
+    "%irq",
+    "%soft",
+    "%steal",
+    "%idle",
+]
+
+
+def read_stat(path="/proc/stat"):
+    """Returns dict of CPU name ("all", "0", "1", ...) -> counters.
+
+    Counters are ordered like FIELDS. Guest time is already included in
+    user time and therefore left out.
+    """
+    cpus = {}
+    with open(path) as f:
+        for line in f:
+            if not line.startswith("cpu"):
+                continue
+            fields = line.split()
+            name = fields[0][3:] or "all"
+            user, nice, system, idle, iowait, irq, softirq, steal = (
+                int(x) for x in (fields[1:9] + ["0"] * 8)[:8]
+            )
+            cpus[name] = [user, nice, system, iowait, irq, softirq, steal]
+            cpus[name].append(idle)
+    return cpus
+
+
+def percentages(before, after):
+    """Computes mpstat-like percentages between two counter snapshots.
+
+    Single counters going backwards (iowait is known to do so) count as
+    zero. CPUs whose counters have been reset altogether, e.g. after a
+    reboot, are left out. Returns None if there is no usable total.
+    """
+    result = {}
+    for cpu, counters in after.items():
+        if cpu not in before:
+            continue
+        if sum(counters) < sum(before[cpu]):
+            continue
+        delta = [max(a - b, 0) for a, b in zip(counters, before[cpu])]
+        total = sum(delta)
+        if not total:
+            continue
+        result[cpu] = {
+            field: 100.0 * d / total for field, d in zip(FIELDS, delta)
+        }
+    if "all" not in result:
+        return None
+    return result
+
+
+def load_state(statefile):
+    try:
+        with open(statefile) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
 
-def get_data(mpstat):
-    output = subprocess.check_output(
-        [mpstat, "5", "6"],
-        env={"LANG": "en_US.utf8", "PATH": os.environ["PATH"]},
-    ).decode("ascii")
-    headings = []
-    fields = []
-    for line in output.splitlines():
-        line = line.split()
-        if "CPU" in line and "%usr" in line:
-            # This is the summary line. This tells us the headings.
-            headings = line[line.index("CPU") + 1 :]
-        if "Average:" in line:
-            fields = line[2:]
+def save_state(statefile, cpus):
+    directory = os.path.dirname(statefile) or "."
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".cpu.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"time": time.time(), "cpus": cpus}, f)
+        os.rename(tmp, statefile)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
-    return dict(zip(headings, fields))
+
+def get_data(statefile, sample, min_interval=1.0, stat="/proc/stat"):
+    """Returns per-CPU percentages since the last run.
+
+    Falls back to sampling for `sample` seconds if there is no usable
+    state or the last run was less than `min_interval` ago.
+    """
+    cpus = read_stat(stat)
+    state = load_state(statefile) if statefile else None
+    data = None
+    if state and time.time() - state["time"] >= min_interval:
+        data = percentages(state["cpus"], cpus)
+    if data is None:
+        _log.info("no usable state, sampling for %s seconds", sample)
+        time.sleep(sample)
+        before, cpus = cpus, read_stat(stat)
+        data = percentages(before, cpus)
+    if statefile:
+        try:
+            save_state(statefile, cpus)
+        except OSError as e:
+            _log.warning("cannot save state: %s", e)
+    return data
 
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument(
-        "--mpstat", metavar="PATH", help="mpstat binary", default="mpstat"
+        "-w",
+        "--warning",
+        type=float,
+        default=10,
+        help="Average steal % considered warning",
     )
+    p.add_argument(
+        "-c",
+        "--critical",
+        type=float,
+        default=15,
+        help="Average steal % considered critical",
+    )
+    p.add_argument(
+        "--state",
+        metavar="PATH",
+        default="/var/tmp/sensu/check_cpu_steal.state",
+        help="keep CPU counters of the last run in PATH "
+        "(default: %(default)s)",
+    )
+    p.add_argument(
+        "--sample",
+        metavar="SEC",
+        type=float,
+        default=1.0,
+        help="sample for SEC seconds if there is no usable state "
+        "(default: %(default)s)",
+    )
+    # Not used anymore, kept for existing check definitions.
+    p.add_argument("--mpstat", help=argparse.SUPPRESS)
     args = p.parse_args()
-    data = get_data(args.mpstat)
-    if "%steal" not in data:
+    data = get_data(args.state, args.sample)
+    if not data:
         print("UNKNOWN - did not find %steal data")
         sys.exit(3)
-    steal = float(data.get("%steal"))
-    if steal >= 15:
-        print("CRITICAL - steal {}% >= 15%".format(steal))
+    average = data["all"]
+    steal = round(average["%steal"], 2)
+    perfdata = [
+        "{}={:.2f}%;;;0;100".format(field[1:], average[field])
+        for field in ["%usr", "%sys", "%iowait"]
+    ]
+    perfdata.insert(
+        0,
+        "steal={:.2f}%;{};{};0;100".format(
+            average["%steal"], args.warning, args.critical
+        ),
+    )
+    cpus = sorted((c for c in data if c != "all"), key=int)
+    perfdata += [
+        "steal_cpu{}={:.2f}%;;;0;100".format(cpu, data[cpu]["%steal"])
+        for cpu in cpus
+    ]
+    perfdata = " | " + " ".join(perfdata)
+    if steal >= args.critical:
+        print(
+            "CRITICAL - steal {}% >= {}%{}".format(
+                steal, args.critical, perfdata
+            )
+        )
         sys.exit(2)
-    if steal >= 10:
-        print("WARNING - steal {}% >= 10%".format(steal))
+    if steal >= args.warning:
+        print(
+            "WARNING - steal {}% >= {}%{}".format(
+                steal, args.warning, perfdata
+            )
+        )
         sys.exit(1)
-    print("OK - steal {}%".format(steal))
+    print("OK - steal {}%{}".format(steal, perfdata))
 
 
 if __name__ == "__main__":
@@ -1,45 +1,89 @@
 import argparse
 import logging
+import os
 import re
 import subprocess
 
 import nagiosplugin
 
+SYSFS_NET = "/sys/class/net"
+
+
+IFF_UP = 0x1
+
+
+def read_sysfs(path):
+    """Returns contents of a sysfs attribute or None if not readable.
+
+    Some attributes (e.g. speed of a link that is down) raise EINVAL.
+    """
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
 
 class Interfaces(nagiosplugin.Resource):
-    def __init__(self, interfaces, auto_detect, exclude):
+    ethtool = ["sudo", "ethtool"]
+
+    def __init__(self, interfaces, auto_detect, exclude, sysfs=SYSFS_NET):
         #: {iface_name: context_name or 'auto', ...}
         self.ifaces = {iface: iface for iface in interfaces}
         self.auto_detect = auto_detect
         self.exclude = exclude
+        self.sysfs = sysfs
+        self._links = None
+
+    @property
+    def links(self):
+        """Link attributes of all interfaces, read in one pass."""
+        if self._links is None:
+            self._links = {}
+            for iface in sorted(os.listdir(self.sysfs)):
+                path = os.path.join(self.sysfs, iface)
+                self._links[iface] = {
+                    attr: read_sysfs(os.path.join(path, attr))
+                    for attr in ["flags", "carrier", "speed", "duplex"]
+                }
+            logging.debug("links=%r", self._links)
+        return self._links
 
     def autodetect(self):
         """Generator for running network interfaces."""
-        cmdline = ["ip", "-o", "link", "show"]
-        logging.info("querying interfaces with %s", " ".join(cmdline))
-        out = subprocess.check_output(cmdline).decode()
-        logging.debug("%s", out)
-        for line in out.split("\n"):
+        for iface, link in self.links.items():
             # only act on eth devices
-            if not re.match(r"\d+:\s+eth\w+", line):
+            if not iface.startswith("eth"):
                 continue
-            m = re.search(r"\d+:\s+([^:@ ]+@)??([^:@ ]+):\s<(.*)>", line)
-            if m:
-                ifname = m.group(2)
-                flags = m.group(3).split(",")
-                if ifname.startswith("eth") and "UP" in flags:
-                    yield ifname
+            if link["flags"] and int(link["flags"], 16) & IFF_UP:
+                yield iface
 
     def exists(self, iface):
-        with open("/proc/net/dev") as dev:
-            for line in dev:
-                if "%s: " % iface in line:
-                    return True
-        logging.debug("%s no found in /proc/net/dev, skipping" % iface)
+        if iface in self.links:
+            return True
+        logging.debug("%s not found in %s, skipping", iface, self.sysfs)
         return False
 
     def query(self, iface):
-        cmdline = ["sudo", "ethtool", iface]
+        link = self.links[iface]
+        if link["carrier"] != "1":
+            # Link down or interface administratively down.
+            speed = 0
+            duplex = (link["duplex"] or "unknown").lower()
+        else:
+            try:
+                speed = int(link["speed"])
+            except (TypeError, ValueError):
+                speed = -1
+            duplex = (link["duplex"] or "unknown").lower()
+            if speed < 0 or duplex == "unknown":
+                logging.info("%s: no speed/duplex in sysfs", iface)
+                return self.query_ethtool(iface)
+        logging.debug("%s: (%i, %s)" % (iface, speed, duplex))
+        return (speed, duplex)
+
+    def query_ethtool(self, iface):
+        cmdline = self.ethtool + [iface]
         logging.info('running "%s"' % " ".join(cmdline))
         stdout = subprocess.check_output(cmdline).decode()
         logging.debug(stdout)
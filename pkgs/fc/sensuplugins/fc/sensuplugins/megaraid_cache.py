@@ -9,43 +9,20 @@ flag. If this flag is set, return CRITICAL unconditionally.
 """
 
 import argparse
-import collections
 import logging
 import os
-import re
-import subprocess
 
 import nagiosplugin
+from fc.megacli_inventory.inventory import (
+    DEFAULT_CACHE,
+    DEFAULT_MAX_AGE,
+    DEFAULT_MEGACLI,
+    Inventory,
+)
 
 _log = logging.getLogger("nagiosplugin")
 
 
-class LdInfo(object):
-    r_virtual_disk = re.compile(r"^Virtual Disk: (\d+)")
-
-    @staticmethod
-    def _query_adapter(command):
-        stdout = subprocess.check_output([command], shell=True).decode()
-        return stdout.splitlines()
-
-    @classmethod
-    def from_megacli(cls, command):
-        disks = collections.defaultdict(list)
-        current_disk = None
-        for line in cls._query_adapter(command):
-            m = cls.r_virtual_disk.match(line)
-            if m:
-                current_disk = int(m.group(1))
-            if current_disk is not None:
-                disks[current_disk].append(line)
-        for diskid, config in disks.items():
-            yield cls(diskid, config)
-
-    def __init__(self, diskid, config):
-        self.diskid = diskid
-        self.config = config
-
-
 class MegaRAIDCache(nagiosplugin.Resource):
     def __init__(self, ld):
         self.ld = ld
@@ -54,24 +31,19 @@ class MegaRAIDCache(nagiosplugin.Resource):
 
     @property
     def diskid(self):
-        return self.ld.diskid
+        return self.ld["id"]
 
     def parse_items(self, policy):
-        return [i.strip() for i in policy.split(",")]
-
-    r_default = re.compile(r"Default Cache Policy: (.*)")
-    r_current = re.compile(r"Current Cache Policy: (.*)")
+        return [i.strip() for i in policy.split(",") if i.strip()]
 
     def parse(self):
-        default_cache = current_cache = []
-        for line in self.ld.config:
-            _log.debug("VD {}: " + line, self.ld.diskid)
-            m = self.r_default.match(line)
-            if m:
-                default_cache = self.parse_items(m.group(1))
-            m = self.r_current.match(line)
-            if m:
-                current_cache = self.parse_items(m.group(1))
+        properties = self.ld["properties"]
+        default_cache = self.parse_items(
+            properties.get("Default Cache Policy", "")
+        )
+        current_cache = self.parse_items(
+            properties.get("Current Cache Policy", "")
+        )
         return set(default_cache), set(current_cache)
 
     def probe(self):
@@ -88,7 +60,7 @@ class MegaRAIDCache(nagiosplugin.Resource):
 
     def __repr__(self):
         return "{}({}, {})".format(
-            self.__class__.__name__, self.diskid, self.ld.config
+            self.__class__.__name__, self.diskid, self.ld
         )
 
     @property
@@ -106,25 +78,20 @@ class FailureCount(nagiosplugin.Resource):
         self.errors = 0
         self.predictive = 0
 
-    r_error_count = re.compile(r"Error Count: (\d+)")
-    r_predictive_failure_count = re.compile(r"Predictive Failure Count: (\d+)")
-
     @property
     def vd(self):
-        return self.ld.diskid
+        return self.ld["id"]
 
     def probe(self):
-        for line in self.ld.config:
-            m = self.r_error_count.search(line)
-            if m:
-                _log.debug("VD %d: %s", self.vd, line.strip())
-                self.errors += int(m.group(1))
-                continue
-            m = self.r_predictive_failure_count.search(line)
-            if m:
-                _log.debug("VD %d: %s", self.vd, line.strip())
-                self.predictive += int(m.group(1))
-                continue
+        for properties in [self.ld["properties"]] + self.ld["physical_drives"]:
+            for key, val in properties.items():
+                # Media and other error counts of the physical drives.
+                if key.endswith("Error Count"):
+                    _log.debug("VD %d: %s: %s", self.vd, key, val)
+                    self.errors += int(val)
+                elif key == "Predictive Failure Count":
+                    _log.debug("VD %d: %s: %s", self.vd, key, val)
+                    self.predictive += int(val)
         return [
             nagiosplugin.Metric(
                 "vd{}_error_count".format(self.vd),
@@ -144,35 +111,27 @@ class FailureCount(nagiosplugin.Resource):
 class BatteryReplace(nagiosplugin.Resource):
     """Check BBU battery replacement status."""
 
-    def __init__(self, command):
-        self.command = command
+    def __init__(self, inventory):
+        self.inventory = inventory
 
     def probe(self):
-        _log.debug('querying battery status with "%s"', self.command)
-        try:
-            stdout = subprocess.check_output(
-                [self.command], shell=True
-            ).decode()
-        except subprocess.CalledProcessError as e:
-            if e.returncode == 34:
-                # adapter without bbu
-                return [nagiosplugin.Metric("battery_replacement", "no")]
-            raise RuntimeError(
-                "failed to query BBU status", e.output, e.returncode
-            )
-        if not "BBU status for Adapter" in stdout:
+        bbu = self.inventory.bbu
+        if not bbu["present"]:
+            # adapter without bbu
+            return [nagiosplugin.Metric("battery_replacement", "no")]
+        if not bbu["adapters"]:
             # There is no adapter (with BBU) here at all. Nothing to report
             return [nagiosplugin.Metric("battery_replacement", "none")]
-        _log.info("battery status: %s", stdout)
-        for line in stdout.splitlines():
-            try:
-                key, val = (w.strip().lower() for w in line.split(":", 1))
-            except ValueError:
-                continue
-            if key == "battery replacement required":
-                return [nagiosplugin.Metric("battery_replacement", val)]
-            if key == "battery state" and val == "unknown":
-                return [nagiosplugin.Metric("battery_replacement", "unknown")]
+        for adapter in bbu["adapters"]:
+            _log.info("battery status: %s", adapter)
+            for key, val in adapter.items():
+                key, val = key.lower(), str(val).lower()
+                if key == "battery replacement required":
+                    return [nagiosplugin.Metric("battery_replacement", val)]
+                if key == "battery state" and val == "unknown":
+                    return [
+                        nagiosplugin.Metric("battery_replacement", "unknown")
+                    ]
         raise RuntimeError("could not find battery replacement flag in output")
 
 
@@ -219,21 +178,30 @@ class MegaRAIDSummary(nagiosplugin.Summary):
 def parse_args():
     a = argparse.ArgumentParser(description=__doc__)
     a.add_argument(
-        "-e",
-        "--execute",
-        metavar="COMMAND",
-        default="MegaCli -LdPdInfo -aALL",
-        help="run this command to obtain the controller's "
-        'status (default: "%(default)s")',
+        "-m",
+        "--megacli",
+        metavar="PATH",
+        default=DEFAULT_MEGACLI,
+        help="MegaCli executable (default: %(default)s)",
     )
     a.add_argument(
-        "-b",
-        "--bbu-exec",
-        metavar="COMMAND",
-        default="MegaCli -AdpBbuCmd -GetBbuStatus -aALL",
-        help="run this command to obtain the BBU's status "
-        '(default: "%(default)s")',
+        "--cache",
+        metavar="PATH",
+        default=DEFAULT_CACHE,
+        help="share controller inventory with other tools via PATH "
+        "(default: %(default)s)",
+    )
+    a.add_argument(
+        "--cache-max-age",
+        metavar="SEC",
+        type=float,
+        default=DEFAULT_MAX_AGE,
+        help="query the controller if the cache is older than SEC seconds "
+        "(default: %(default)s)",
     )
+    # Not used anymore, kept for existing check definitions.
+    a.add_argument("-e", "--execute", help=argparse.SUPPRESS)
+    a.add_argument("-b", "--bbu-exec", help=argparse.SUPPRESS)
     a.add_argument(
         "-w",
         "--warning",
@@ -317,11 +285,15 @@ def main():
         BatteryReplaceContext("battery_replacement"),
         MegaRAIDSummary(),
     )
-    for ldinfo in LdInfo.from_megacli(args.execute):
-        check.add(MegaRAIDCache(ldinfo))
-        check.add(FailureCount(ldinfo))
-    check.add(BatteryReplace(args.bbu_exec))
+    # The inventory is queried before the check runs, so its log messages
+    # need the verbosity applied already.
+    nagiosplugin.Runtime().verbose = args.verbose
+    inventory = Inventory(args.megacli, args.cache, args.cache_max_age)
     try:
+        for ld in inventory.logical_drives:
+            check.add(MegaRAIDCache(ld))
+            check.add(FailureCount(ld))
+        check.add(BatteryReplace(inventory))
         check.main(args.verbose, args.timeout)
     finally:
         if args.remove:
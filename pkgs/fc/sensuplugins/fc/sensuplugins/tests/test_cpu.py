@@ -0,0 +1,80 @@
+import pytest
+from fc.sensuplugins.cpu import FIELDS, percentages, read_stat
+
+STAT = """\
+cpu  1000 10 200 5000 40 0 5 100 0 0
+cpu0 500 5 100 2500 20 0 3 50 0 0
+cpu1 500 5 100 2500 20 0 2 50 0 0
+intr 399403 0 0 0
+ctxt 1520116
+btime 1792437825
+"""
+
+
+@pytest.fixture
+def stat(tmpdir):
+    path = tmpdir / "stat"
+    path.write(STAT)
+    return str(path)
+
+
+def counters(usr=0, nice=0, sys=0, iowait=0, irq=0, soft=0, steal=0, idle=0):
+    return [usr, nice, sys, iowait, irq, soft, steal, idle]
+
+
+def test_read_stat(stat):
+    cpus = read_stat(stat)
+    assert sorted(cpus) == ["0", "1", "all"]
+    assert cpus["all"] == counters(1000, 10, 200, 40, 0, 5, 100, 5000)
+    assert len(cpus["0"]) == len(FIELDS)
+
+
+def test_read_stat_short_lines(tmpdir):
+    # Old kernels do not report steal time.
+    path = tmpdir / "stat"
+    path.write("cpu  1 2 3 4 5\n")
+    assert read_stat(str(path)) == {"all": counters(1, 2, 3, 5, idle=4)}
+
+
+def test_percentages():
+    before = {"all": counters(usr=100, idle=100)}
+    after = {"all": counters(usr=150, steal=20, idle=130)}
+    result = percentages(before, after)
+    assert result["all"]["%usr"] == 50.0
+    assert result["all"]["%steal"] == 20.0
+    assert result["all"]["%idle"] == 30.0
+    assert sum(result["all"].values()) == pytest.approx(100)
+
+
+def test_percentages_counter_going_backwards():
+    before = {"all": counters(usr=100, iowait=50, idle=100)}
+    after = {"all": counters(usr=150, iowait=49, idle=150)}
+    result = percentages(before, after)
+    assert result["all"]["%iowait"] == 0.0
+    assert result["all"]["%usr"] == 50.0
+
+
+def test_percentages_skips_reset_cpu():
+    before = {
+        "all": counters(usr=100, idle=100),
+        "0": counters(usr=50, idle=50),
+        "1": counters(usr=50, idle=50),
+    }
+    after = {
+        "all": counters(usr=200, idle=200),
+        "0": counters(usr=10, idle=10),
+        "1": counters(usr=100, idle=100),
+    }
+    result = percentages(before, after)
+    assert sorted(result) == ["1", "all"]
+
+
+def test_percentages_reboot():
+    before = {"all": counters(usr=1000, idle=1000)}
+    after = {"all": counters(usr=10, idle=10)}
+    assert percentages(before, after) is None
+
+
+def test_percentages_no_time_passed():
+    cpus = {"all": counters(usr=100, idle=100)}
+    assert percentages(cpus, cpus) is None
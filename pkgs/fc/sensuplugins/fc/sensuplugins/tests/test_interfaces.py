@@ -0,0 +1,92 @@
+import os
+
+import nagiosplugin
+import pytest
+from fc.sensuplugins.interfaces import Interfaces
+
+ETHTOOL = """\
+#!/bin/sh
+echo "Settings for $1:"
+echo "	Speed: 1000Mb/s"
+echo "	Duplex: Full"
+echo "	Link detected: yes"
+"""
+
+
+def link(sysfs, iface, **attrs):
+    path = sysfs.join(iface)
+    path.ensure(dir=True)
+    for attr, value in attrs.items():
+        path.join(attr).write(value + "\n")
+
+
+@pytest.fixture
+def sysfs(tmpdir):
+    sysfs = tmpdir.join("net")
+    link(sysfs, "eth0", flags="0x1003", carrier="1", speed="10000")
+    link(sysfs, "eth1", flags="0x1002", carrier="0", duplex="unknown")
+    link(sysfs, "lo", flags="0x9", carrier="1")
+    return sysfs
+
+
+@pytest.fixture
+def ethtool(tmpdir):
+    ethtool = tmpdir.join("ethtool")
+    ethtool.write(ETHTOOL)
+    ethtool.chmod(0o755)
+    return str(ethtool)
+
+
+def metrics(interfaces):
+    return {m.name: m.value for m in interfaces.probe()}
+
+
+def test_link_up(sysfs):
+    link(sysfs, "eth0", duplex="full")
+    interfaces = Interfaces(["eth0"], False, [], sysfs=str(sysfs))
+    assert metrics(interfaces) == {"eth0_spd": 10000, "eth0_dup": "full"}
+
+
+def test_link_down_reports_zero_speed(sysfs):
+    interfaces = Interfaces(["eth1"], False, [], sysfs=str(sysfs))
+    assert metrics(interfaces) == {"eth1_spd": 0, "eth1_dup": "unknown"}
+
+
+@pytest.mark.parametrize("speed", ["-1", None])
+def test_unknown_speed_falls_back_to_ethtool(sysfs, ethtool, speed):
+    if speed:
+        link(sysfs, "eth2", flags="0x1003", carrier="1", speed=speed)
+    else:
+        # Unreadable attribute.
+        link(sysfs, "eth2", flags="0x1003", carrier="1")
+    interfaces = Interfaces(["eth2"], False, [], sysfs=str(sysfs))
+    interfaces.ethtool = [ethtool]
+    assert metrics(interfaces) == {"eth2_spd": 1000, "eth2_dup": "full"}
+
+
+def test_unknown_duplex_falls_back_to_ethtool(sysfs, ethtool):
+    link(sysfs, "eth0", duplex="unknown")
+    interfaces = Interfaces(["eth0"], False, [], sysfs=str(sysfs))
+    interfaces.ethtool = [ethtool]
+    assert metrics(interfaces) == {"eth0_spd": 1000, "eth0_dup": "full"}
+
+
+def test_autodetect_only_up_eth_devices(sysfs):
+    link(sysfs, "eth2", flags="0x1003", carrier="0")
+    link(sysfs, "eth3")
+    interfaces = Interfaces([], True, [], sysfs=str(sysfs))
+    assert list(interfaces.autodetect()) == ["eth0", "eth2"]
+
+
+def test_autodetect_exclude(sysfs):
+    interfaces = Interfaces([], True, ["eth0"], sysfs=str(sysfs))
+    with pytest.raises(
+        nagiosplugin.CheckError, match="no interfaces specified"
+    ):
+        metrics(interfaces)
+
+
+def test_missing_interface_is_skipped(sysfs):
+    link(sysfs, "eth0", duplex="full")
+    interfaces = Interfaces(["eth0", "eth9"], False, [], sysfs=str(sysfs))
+    assert metrics(interfaces) == {"eth0_spd": 10000, "eth0_dup": "full"}
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+from fc.megacli_inventory.inventory import parse_bbu_status, parse_ldpdinfo
+from fc.sensuplugins.megaraid_cache import (
+    BatteryReplace,
+    FailureCount,
+    MegaRAIDCache,
+)
+
+HERE = os.path.dirname(__file__)
+
+
+def recorded(name):
+    with open(os.path.join(HERE, "megacli", name)) as f:
+        return f.read()
+
+
+class FakeInventory(object):
+    def __init__(self, bbu, present=True):
+        self.bbu = {"present": present, "adapters": parse_bbu_status(bbu)}
+
+
+@pytest.fixture
+def lds():
+    return parse_ldpdinfo(recorded("ldpdinfo.txt"))
+
+
+def test_cache_policy(lds):
+    unchanged, degraded = MegaRAIDCache(lds[0]), MegaRAIDCache(lds[1])
+    assert [m.value for m in unchanged.probe()] == [0]
+    assert [m.value for m in degraded.probe()] == [1]
+    assert degraded.missing == "WriteBack"
+    assert degraded.unexpected == "WriteThrough"
+
+
+def test_failure_count(lds):
+    errors, predictive = FailureCount(lds[0]).probe()
+    assert (errors.name, errors.value) == ("vd0_error_count", 4)
+    assert (predictive.name, predictive.value) == ("vd0_predictive_failure", 2)
+    assert [m.value for m in FailureCount(lds[1]).probe()] == [0, 0]
+
+
+def test_battery_ok():
+    inventory = FakeInventory(recorded("bbu_status.txt"))
+    (metric,) = BatteryReplace(inventory).probe()
+    assert metric.value == "no"
+
+
+def test_battery_replacement_required():
+    bbu = recorded("bbu_status.txt").replace(
+        "Battery Replacement required            : No",
+        "Battery Replacement required            : Yes",
+    )
+    (metric,) = BatteryReplace(FakeInventory(bbu)).probe()
+    assert metric.value == "yes"
+
+
+def test_battery_missing():
+    inventory = FakeInventory(recorded("bbu_missing.txt"), present=False)
+    (metric,) = BatteryReplace(inventory).probe()
+    assert metric.value == "no"
+
+
+def test_battery_no_adapter():
+    (metric,) = BatteryReplace(FakeInventory("")).probe()
+    assert metric.value == "none"
+
+
+def test_battery_flag_not_found():
+    inventory = FakeInventory("BBU status for Adapter: 0\nVoltage: OK\n")
+    with pytest.raises(RuntimeError):
+        BatteryReplace(inventory).probe()
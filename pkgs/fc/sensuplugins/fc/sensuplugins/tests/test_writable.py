@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+from fc.sensuplugins.writable import Paths
+
+MAIN = "from fc.sensuplugins.writable import main; main()"
+
+
+@pytest.fixture
+def stuck(tmpdir):
+    """Opening a FIFO for writing blocks until there is a reader."""
+    path = str(tmpdir / "fifo")
+    os.mkfifo(path)
+    yield path
+    # Release the blocked probe thread.
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    os.close(fd)
+
+
+def test_latency(tmpdir):
+    paths = [str(tmpdir / "a"), str(tmpdir / "b")]
+    metrics = list(Paths(paths, 10).probe())
+    assert [m.name for m in metrics] == paths
+    for m in metrics:
+        assert m.context == "latency"
+        assert m.uom == "s"
+        assert 0 <= m.value < 10
+    assert open(paths[0]).read() == "asdf"
+
+
+def test_failed_path(tmpdir):
+    ok, failed = Paths(
+        [str(tmpdir / "a"), str(tmpdir / "missing" / "b")], 10
+    ).probe()
+    assert ok.context == "latency"
+    assert failed.context == "failed"
+    assert "No such file or directory" in failed.value
+
+
+def test_stuck_path_reported_individually(tmpdir, stuck):
+    started = time.monotonic()
+    metrics = list(Paths([stuck, str(tmpdir / "a")], 0.5).probe())
+    assert time.monotonic() - started < 5
+    assert [(m.name, m.context) for m in metrics] == [
+        (stuck, "failed"),
+        (str(tmpdir / "a"), "latency"),
+    ]
+    assert metrics[0].value == "no response after 0.5s"
+
+
+def test_paths_probed_concurrently(tmpdir, stuck):
+    # Both stuck paths share one deadline instead of waiting in turn.
+    other = str(tmpdir / "fifo2")
+    os.mkfifo(other)
+    started = time.monotonic()
+    metrics = list(Paths([stuck, other], 1).probe())
+    assert time.monotonic() - started < 1.9
+    assert [m.context for m in metrics] == ["failed", "failed"]
+    os.close(os.open(other, os.O_RDONLY | os.O_NONBLOCK))
+
+
+def test_deadline_capped_by_timeout(tmpdir, stuck):
+    proc = subprocess.run(
+        [sys.executable, "-c", MAIN, "-t", "2", stuck, str(tmpdir / "a")],
+        stdout=subprocess.PIPE,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+        timeout=30,
+    )
+    out = proc.stdout.decode()
+    assert proc.returncode == 2, out
+    assert "CRITICAL" in out
+    assert "{}: no response after 1s".format(stuck) in out
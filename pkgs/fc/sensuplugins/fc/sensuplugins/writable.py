@@ -1,7 +1,8 @@
 """Check whether paths are writable and responsive.
 
 Takes a list of filenames and verifies (destructively) that they can be written
-and flushed to disk.
+and flushed to disk. Paths are probed concurrently and report their fsync
+latency, so a single hanging filesystem does not hide the state of the others.
 
 """
 
@@ -9,25 +10,84 @@ import argparse
 import logging
 import os
 import sys
+import threading
+import time
 
 import nagiosplugin
 
 _log = logging.getLogger("nagiosplugin")
 
 
-class Path(nagiosplugin.Resource):
-    """Does the actual work of writing to a path."""
+class Probe(threading.Thread):
+    """Writes to a single path and measures the fsync latency.
+
+    Runs as a daemon thread, so a probe stuck in the kernel does not keep
+    the check from exiting.
+    """
 
     def __init__(self, path):
+        super().__init__(name=path, daemon=True)
         self.path = path
+        self.latency = None
+        self.error = None
 
-    def probe(self):
+    def run(self):
         _log.debug("probe: %r", self.path)
-        with open(self.path, "w") as f:
-            f.write("asdf")
-            f.flush()
-            os.fsync(f)
-        return nagiosplugin.Metric(self.path, True, context="null")
+        try:
+            with open(self.path, "w") as f:
+                f.write("asdf")
+                f.flush()
+                started = time.monotonic()
+                os.fsync(f)
+                self.latency = time.monotonic() - started
+        except OSError as e:
+            self.error = e
+
+
+class Paths(nagiosplugin.Resource):
+    """Probes all paths concurrently.
+
+    Paths which do not respond within `deadline` seconds are reported as
+    failed while the other paths still report their latency.
+    """
+
+    def __init__(self, paths, deadline):
+        self.paths = paths
+        self.deadline = deadline
+
+    def probe(self):
+        probes = [Probe(path) for path in self.paths]
+        for probe in probes:
+            probe.start()
+        deadline = time.monotonic() + self.deadline
+        for probe in probes:
+            probe.join(max(0, deadline - time.monotonic()))
+            if probe.is_alive():
+                _log.info("%s: no response", probe.path)
+                yield nagiosplugin.Metric(
+                    probe.path,
+                    "no response after {}s".format(self.deadline),
+                    context="failed",
+                )
+            elif probe.error:
+                yield nagiosplugin.Metric(
+                    probe.path, str(probe.error), context="failed"
+                )
+            else:
+                yield nagiosplugin.Metric(
+                    probe.path,
+                    round(probe.latency, 4),
+                    "s",
+                    min=0,
+                    context="latency",
+                )
+
+
+class Failed(nagiosplugin.Context):
+    """Paths that could not be written are always critical."""
+
+    def evaluate(self, metric, resource):
+        return self.result_cls(nagiosplugin.Critical, metric=metric)
 
 
 class PathSummary(nagiosplugin.Summary):
@@ -68,12 +128,44 @@ calculation.
         type=int,
         help="abort check execution after N seconds",
     )
+    a.add_argument(
+        "-w",
+        "--warning",
+        metavar="RANGE",
+        default="3",
+        help="warning if fsync takes longer than RANGE seconds "
+        "(default: %(default)s)",
+    )
+    a.add_argument(
+        "-c",
+        "--critical",
+        metavar="RANGE",
+        default="10",
+        help="critical if fsync takes longer than RANGE seconds "
+        "(default: %(default)s)",
+    )
+    a.add_argument(
+        "-d",
+        "--deadline",
+        metavar="N",
+        default=20,
+        type=float,
+        help="consider paths not responding within N seconds as failed "
+        "(default: %(default)s)",
+    )
     a.add_argument("paths", type=str, nargs="+", help="paths to check")
 
     args = a.parse_args()
-    check = nagiosplugin.Check(PathSummary())
-    for path in args.paths:
-        check.add(Path(path))
+    deadline = args.deadline
+    if args.timeout:
+        # Stuck paths must be reported before the whole check times out.
+        deadline = min(deadline, max(args.timeout - 1, args.timeout / 2))
+    check = nagiosplugin.Check(
+        Paths(args.paths, deadline),
+        nagiosplugin.ScalarContext("latency", args.warning, args.critical),
+        Failed("failed"),
+        PathSummary(),
+    )
     check.main(args.verbose, args.timeout)
 
     targets = sys.argv[1:]
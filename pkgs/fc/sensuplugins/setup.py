@@ -12,7 +12,13 @@ setup(
     license="ZPL",
     classifiers=["Programming Language :: Python :: 3.7"],
     packages=["fc.sensuplugins"],
-    install_requires=["PyYAML", "nagiosplugin", "psutil", "requests"],
+    install_requires=[
+        "PyYAML",
+        "fc.megacli_inventory",
+        "nagiosplugin",
+        "psutil",
+        "requests",
+    ],
     entry_points={
         "console_scripts": [
             "check_clamav_database=fc.sensuplugins.clamav_database:main",
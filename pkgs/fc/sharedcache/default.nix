@@ -0,0 +1,19 @@
+{ python3Packages }:
+
+let
+  py = python3Packages;
+
+in
+  py.buildPythonPackage rec {
+    name = "fc-sharedcache-${version}";
+    version = "1.0";
+    src = ./.;
+
+    checkInputs = [
+      py.pytest
+    ];
+
+    checkPhase = ''
+      pytest fc/sharedcache
+    '';
+  }
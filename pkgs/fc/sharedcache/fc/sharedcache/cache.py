@@ -0,0 +1,93 @@
+"""Results of expensive queries shared between concurrent processes.
+
+Checks and other local consumers that ask for the same data reuse it
+from a cache file as long as it is not older than its max age. When the
+cache is stale, one process fetches the data while the others wait on a
+lock file next to the cache and then reuse the result.
+"""
+
+import fcntl
+import logging
+import os
+import tempfile
+import time
+
+_log = logging.getLogger("nagiosplugin")
+
+
+class SharedCache(object):
+    """Cache file at `path` which is valid for `max_age` seconds.
+
+    `loads` and `dumps` convert between the data and its text
+    representation in the cache file. `name` describes the data in log
+    messages.
+    """
+
+    def __init__(self, path, max_age, name="data", loads=str, dumps=str):
+        self.path = path
+        self.max_age = max_age
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def read(self):
+        """Returns cached data or None if missing, unreadable or too old."""
+        try:
+            with open(self.path) as f:
+                age = time.time() - os.fstat(f.fileno()).st_mtime
+                if age > self.max_age:
+                    return None
+                data = self.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        _log.info("using cached %s (%.1fs old)", self.name, age)
+        return data
+
+    def write(self, data):
+        """Replaces the cache atomically, readable for other users."""
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(self.path),
+            prefix=".{}.".format(os.path.basename(self.path)),
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.dumps(data))
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def get(self, fetch):
+        """Returns (data, cache hit), calling `fetch` if the cache is stale.
+
+        Falls back to fetching without the cache if the lock file cannot be
+        opened.
+        """
+        data = self.read()
+        if data is not None:
+            return data, True
+        try:
+            lock = open(self.path + ".lock", "a")
+        except OSError as e:
+            _log.warning("cannot use %s cache: %s", self.name, e)
+            return fetch(), False
+        with lock:
+            # Only one process fetches, the others wait and reuse its
+            # result.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self.read()
+            if data is not None:
+                return data, True
+            data = fetch()
+            try:
+                self.write(data)
+            except OSError as e:
+                _log.warning("cannot update %s cache: %s", self.name, e)
+        return data, False
+
+    def invalidate(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,104 @@
+import fcntl
+import json
+import os
+import stat
+import threading
+import time
+
+import pytest
+from fc.sharedcache.cache import SharedCache
+
+
+@pytest.fixture
+def path(tmpdir):
+    return str(tmpdir / "cache.json")
+
+
+class Fetch:
+    def __init__(self, data="fresh"):
+        self.data = data
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.data
+
+
+def test_miss_fetches_and_writes(path):
+    fetch = Fetch()
+    assert SharedCache(path, 60).get(fetch) == ("fresh", False)
+    assert fetch.calls == 1
+    assert open(path).read() == "fresh"
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+
+def test_hit(path):
+    SharedCache(path, 60).get(Fetch())
+    fetch = Fetch("other")
+    assert SharedCache(path, 60).get(fetch) == ("fresh", True)
+    assert fetch.calls == 0
+
+
+def test_expired(path):
+    SharedCache(path, 60).get(Fetch())
+    old = time.time() - 61
+    os.utime(path, (old, old))
+    assert SharedCache(path, 60).get(Fetch("new")) == ("new", False)
+
+
+def test_loads_dumps(path):
+    cache = SharedCache(path, 60, loads=json.loads, dumps=json.dumps)
+    cache.get(Fetch({"a": 1}))
+    assert cache.read() == {"a": 1}
+
+
+def test_corrupted_cache_is_ignored(path):
+    with open(path, "w") as f:
+        f.write("{")
+    cache = SharedCache(path, 60, loads=json.loads, dumps=json.dumps)
+    assert cache.get(Fetch({"a": 1})) == ({"a": 1}, False)
+
+
+def test_unusable_directory_fetches_uncached(tmpdir):
+    cache = SharedCache(str(tmpdir / "missing" / "cache"), 60)
+    fetch = Fetch()
+    assert cache.get(fetch) == ("fresh", False)
+    assert cache.get(fetch) == ("fresh", False)
+    assert fetch.calls == 2
+
+
+def test_write_failure_returns_data(path, monkeypatch):
+    cache = SharedCache(path, 60)
+
+    def fail(data):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(cache, "write", fail)
+    assert cache.get(Fetch()) == ("fresh", False)
+    assert not os.path.exists(path)
+
+
+def test_waiting_process_reuses_result(path):
+    fetch = Fetch()
+    result = []
+    with open(path + ".lock", "a") as lock:
+        # Another process is fetching.
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        waiting = threading.Thread(
+            target=lambda: result.append(SharedCache(path, 60).get(fetch))
+        )
+        waiting.start()
+        waiting.join(0.2)
+        assert waiting.is_alive()
+        SharedCache(path, 60).write("from other")
+    waiting.join(5)
+    assert result == [("from other", True)]
+    assert fetch.calls == 0
+
+
+def test_invalidate(path):
+    cache = SharedCache(path, 60)
+    cache.get(Fetch())
+    cache.invalidate()
+    cache.invalidate()
+    assert not os.path.exists(path)
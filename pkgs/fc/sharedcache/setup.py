@@ -0,0 +1,17 @@
+"""File cache shared between concurrent local processes."""
+
+from setuptools import setup
+
+setup(
+    name="fc.sharedcache",
+    version="1.0",
+    description=__doc__,
+    url="https://github.com/flyingcircus/nixpkgs",
+    author="Flying Circus Internet Operations GmbH",
+    author_email="mail@flyingcircus.io",
+    license="ZPL",
+    classifiers=[
+        "Programming Language :: Python :: 3.7",
+    ],
+    packages=["fc.sharedcache"],
+)